@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# GNOME bulk rename utility
+# Copyright (C) 2010-2012 Holger Berndt <hb@gnome.org>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Benchmark the rename backends on a flat directory of local files.
+
+With --journal, every backend also runs with the rename journal enabled,
+to measure its overhead."""
+
+import sys
+import os
+import os.path
+import time
+import shutil
+import tempfile
+import gettext
+from argparse import ArgumentParser
+
+gettext.install("gnome-bulk-rename")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gnome-bulk-rename"))
+
+from gi.repository import Gio
+from gi.repository import Gtk
+
+import constants
+import rename
+
+
+def create_files(dirname, num_files):
+    """Creates num_files empty files in dirname, and returns a files model for them"""
+    model = Gtk.ListStore(*constants.FILES_MODEL_COLUMNS)
+    dir_uri = Gio.file_new_for_path(dirname).get_uri() + "/"
+    for ii in range(num_files):
+        name = "file{0:07d}".format(ii)
+        path = os.path.join(dirname, name)
+        with open(path, "w"):
+            pass
+        model.append([name, "renamed-" + name, Gio.file_new_for_path(path), "", "", "", "", dir_uri, Gio.FileType.REGULAR])
+    return model
+
+
+def run_rename(model, backend, journal_dir=None):
+    """Runs a rename on model, and returns (seconds, successes, errors)"""
+    results = []
+
+    def done_cb(rename_results):
+        results.append(rename_results)
+        Gtk.main_quit()
+
+    start = time.perf_counter()
+    rename.Rename(model, done_callback=done_cb, backend=backend, journal_dir=journal_dir)
+    Gtk.main()
+    elapsed = time.perf_counter() - start
+    return elapsed, len(results[0].successes), len(results[0].errors)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Benchmark rename backends.")
+    parser.add_argument("--num-files", type=int, default=100000)
+    parser.add_argument("--dir", default=None, help="directory to create the test files in")
+    parser.add_argument("--backends", nargs="+", default=[constants.RENAME_BACKEND_GIO, constants.RENAME_BACKEND_POSIX,
+                                                             constants.RENAME_BACKEND_THREADS,
+                                                             constants.RENAME_BACKEND_IO_URING])
+    parser.add_argument("--journal", action="store_true", help="also run with the rename journal")
+    args = parser.parse_args(argv)
+
+    for backend in args.backends:
+        plain_elapsed = None
+        for with_journal in ((False, True) if args.journal else (False,)):
+            dirname = tempfile.mkdtemp(dir=args.dir)
+            try:
+                model = create_files(dirname, args.num_files)
+                journal_dir = os.path.join(dirname, "journal") if with_journal else None
+                elapsed, num_successes, num_errors = run_rename(model, backend, journal_dir)
+            finally:
+                shutil.rmtree(dirname)
+            if with_journal:
+                label = backend + "+journal"
+                overhead = "  journal overhead {0:+.1f}%".format(100. * (elapsed - plain_elapsed) / plain_elapsed)
+            else:
+                label = backend
+                overhead = ""
+                plain_elapsed = elapsed
+            print("{0:16} {1:8d} files {2:9.3f}s {3:10.0f} renames/s   ({4} errors){5}"
+                  .format(label, args.num_files, elapsed, num_successes / elapsed, num_errors, overhead))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
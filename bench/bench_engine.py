@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# GNOME bulk rename utility
+# Copyright (C) 2010-2012 Holger Berndt <hb@gnome.org>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Compare preview, check, plan and rename through a Gtk.ListStore with the plain list engine.
+
+Both paths use the same previewer and rename backend on a flat directory
+of local files."""
+
+import sys
+import os
+import os.path
+import time
+import shutil
+import tempfile
+import gettext
+from argparse import ArgumentParser
+
+gettext.install("gnome-bulk-rename")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gnome-bulk-rename"))
+
+from gi.repository import Gio
+
+import constants
+import engine
+
+
+class _PrefixPreview:
+    """Preview-like object, works on files models as well as plain rows"""
+
+    def preview(self, model):
+        for row in model:
+            row[1] = "renamed-" + row[0]
+
+
+def create_files(dirname, num_files):
+    names = ["file{0:07d}".format(ii) for ii in range(num_files)]
+    for name in names:
+        with open(os.path.join(dirname, name), "w"):
+            pass
+    return names
+
+
+def run_liststore(dirname, names, backend):
+    """Returns (phase, seconds) tuples for the files model path"""
+    from gi.repository import Gtk
+    import check
+    import rename
+
+    timings = []
+    start = time.perf_counter()
+    model = Gtk.ListStore(*constants.FILES_MODEL_COLUMNS)
+    dir_uri = Gio.file_new_for_path(dirname).get_uri() + "/"
+    for name in names:
+        model.append([name, name, Gio.file_new_for_path(os.path.join(dirname, name)), "", "", "", "", dir_uri,
+                      Gio.FileType.REGULAR])
+    timings.append(("load", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    _PrefixPreview().preview(model)
+    timings.append(("preview", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    check.Checker(model).perform_checks()
+    timings.append(("check", time.perf_counter() - start))
+
+    def done_cb(results):
+        Gtk.main_quit()
+
+    start = time.perf_counter()
+    plan = rename.create_plan(model, backend=backend)
+    timings.append(("plan", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    rename.Rename(model, done_callback=done_cb, plan=plan)
+    Gtk.main()
+    timings.append(("rename", time.perf_counter() - start))
+    return timings
+
+
+def run_engine(dirname, names, backend):
+    """Returns (phase, seconds) tuples for the engine path"""
+    timings = []
+    start = time.perf_counter()
+    dir_uri = Gio.file_new_for_path(dirname).get_uri() + "/"
+    entries = [(dir_uri, name, name) for name in names]
+    timings.append(("load", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    targets = engine.preview(names, _PrefixPreview())
+    entries = [(dir_uri, name, target) for name, target in zip(names, targets)]
+    timings.append(("preview", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    engine.check(entries)
+    timings.append(("check", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    plan = engine.plan(engine.get_rename_infos(entries), backend)
+    timings.append(("plan", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    engine.execute(plan)
+    timings.append(("rename", time.perf_counter() - start))
+    return timings
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Compare the files model path with the plain list engine.")
+    parser.add_argument("--num-files", type=int, default=100000)
+    parser.add_argument("--dir", default=None, help="directory to create the test files in")
+    parser.add_argument("--backend", default=constants.RENAME_BACKEND_POSIX)
+    args = parser.parse_args(argv)
+
+    for label, func in (("liststore", run_liststore), ("engine", run_engine)):
+        dirname = tempfile.mkdtemp(dir=args.dir)
+        try:
+            names = create_files(dirname, args.num_files)
+            timings = func(dirname, names, args.backend)
+        finally:
+            shutil.rmtree(dirname)
+        total = sum(seconds for phase, seconds in timings)
+        print("{0:10} {1:8d} files  ".format(label, args.num_files) +
+              "  ".join("{0} {1:7.3f}s".format(phase, seconds) for phase, seconds in timings) +
+              "  total {0:7.3f}s  {1:10.0f} files/s".format(total, args.num_files / total))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
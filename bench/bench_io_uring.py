@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# GNOME bulk rename utility
+# Copyright (C) 2010-2012 Holger Berndt <hb@gnome.org>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Compare the raw rename paths on a tree of local files: GIO, os.rename,
+and batches of renameat operations on an io_uring.
+
+The files model and the main loop are left out, to measure the cost of the
+calls themselves. The tree is created once, and each method renames all
+files to a new suffix. By default, the tree is created on tmpfs."""
+
+import sys
+import os
+import os.path
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gnome-bulk-rename"))
+
+from gi.repository import Gio
+
+import constants
+import syscalls
+
+
+def create_tree(dirname, num_files, files_per_dir):
+    """Returns a list of (directory path, file names) tuples"""
+    tree = []
+    for ii in range(0, num_files, files_per_dir):
+        path = os.path.join(dirname, "dir{0:05d}".format(ii // files_per_dir))
+        os.mkdir(path)
+        names = ["file{0:07d}".format(jj) for jj in range(ii, min(num_files, ii + files_per_dir))]
+        for name in names:
+            with open(os.path.join(path, name), "w"):
+                pass
+        tree.append((path, names))
+    return tree
+
+
+def rename_gio(tree, old_suffix, new_suffix):
+    for path, names in tree:
+        dir_file = Gio.file_new_for_path(path)
+        for name in names:
+            dir_file.get_child(name + old_suffix).set_display_name(name + new_suffix, None)
+
+
+def rename_os(tree, old_suffix, new_suffix):
+    for path, names in tree:
+        dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for name in names:
+                os.rename(name + old_suffix, name + new_suffix, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def rename_io_uring(tree, old_suffix, new_suffix):
+    ring = syscalls.IoUring(constants.RENAME_IO_URING_ENTRIES)
+    try:
+        for path, names in tree:
+            dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                for ii in range(0, len(names), ring.size):
+                    _check(ring.renameat_batch([(dir_fd, os.fsencode(name + old_suffix), dir_fd,
+                                                 os.fsencode(name + new_suffix), syscalls.RENAME_NOREPLACE)
+                                                for name in names[ii:ii+ring.size]]))
+            finally:
+                os.close(dir_fd)
+    finally:
+        ring.close()
+
+
+def _check(errnos):
+    for err in errnos:
+        if err:
+            raise OSError(err, os.strerror(err))
+
+
+METHODS = {
+    "gio" : rename_gio,
+    "os.rename" : rename_os,
+    "io_uring" : rename_io_uring,
+    }
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Compare GIO, os.rename and io_uring renames.")
+    parser.add_argument("--num-files", type=int, default=1000000)
+    parser.add_argument("--files-per-dir", type=int, default=1000)
+    parser.add_argument("--dir", default="/dev/shm" if os.path.isdir("/dev/shm") else None,
+                        help="directory to create the test tree in")
+    parser.add_argument("--methods", nargs="+", default=list(METHODS), choices=list(METHODS))
+    args = parser.parse_args(argv)
+
+    dirname = tempfile.mkdtemp(dir=args.dir)
+    try:
+        tree = create_tree(dirname, args.num_files, args.files_per_dir)
+        suffix = ""
+        for ii, method in enumerate(args.methods):
+            new_suffix = "-{0}".format(ii)
+            start = time.perf_counter()
+            try:
+                METHODS[method](tree, suffix, new_suffix)
+            except OSError as ee:
+                print("{0:10} not available: {1}".format(method, ee.strerror))
+                continue
+            elapsed = time.perf_counter() - start
+            suffix = new_suffix
+            print("{0:10} {1:8d} files {2:9.3f}s {3:10.0f} renames/s".format(method, args.num_files, elapsed,
+                                                                          args.num_files / elapsed))
+    finally:
+        shutil.rmtree(dirname)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# GNOME bulk rename utility
+# Copyright (C) 2010-2012 Holger Berndt <hb@gnome.org>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Benchmark the rename layering planner on synthetic trees.
+
+Nothing is created on disk, the planner only looks at uris."""
+
+import sys
+import os.path
+import time
+import gettext
+from argparse import ArgumentParser
+
+gettext.install("gnome-bulk-rename")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gnome-bulk-rename"))
+
+from gi.repository import Gio
+
+import engine
+
+
+class _Info:
+    def __init__(self, uri):
+        self.gfile = Gio.file_new_for_uri(uri)
+
+
+def wide_tree(num_entries, base="file:///bench"):
+    """A few directories with lots of files each"""
+    entries = []
+    num_dirs = max(1, num_entries // 1000)
+    for ii in range(num_dirs):
+        entries.append(("{0}/dir{1}".format(base, ii), True))
+    for ii in range(num_entries - num_dirs):
+        entries.append(("{0}/dir{1}/file{2}".format(base, ii % num_dirs, ii), False))
+    return entries
+
+
+def deep_tree(num_entries, base="file:///bench", fanout=2):
+    """A tree of directories with the given fanout, every directory holds one file"""
+    entries = []
+    dirs = [base]
+    while len(entries) < num_entries:
+        new_dirs = []
+        for parent in dirs:
+            for ii in range(fanout):
+                uri = "{0}/d{1}".format(parent, ii)
+                entries.append((uri, True))
+                entries.append((uri + "/f", False))
+                new_dirs.append(uri)
+        dirs = new_dirs
+    return entries[:num_entries]
+
+
+def _quadratic_layers(rename_list, is_directory):
+    """Reference: the planner used before the path trie"""
+    tasks_list = [[el for ii, el in enumerate(rename_list) if not is_directory[ii]]]
+    rename_list = [el for ii, el in enumerate(rename_list) if is_directory[ii]]
+    while rename_list:
+        entries = []
+        for ii, el in enumerate(rename_list):
+            if not any(el2.gfile.has_prefix(el.gfile) and not el2.gfile.equal(el.gfile)
+                       for jj, el2 in enumerate(rename_list) if ii != jj):
+                entries.append(el)
+        rename_list = [el for el in rename_list if el not in entries]
+        tasks_list.append(entries)
+    return [el for el in tasks_list if el]
+
+
+def _time(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Benchmark the rename layering planner.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 30000, 100000])
+    parser.add_argument("--reference-limit", type=int, default=5000,
+                        help="only run the quadratic reference planner up to this size")
+    args = parser.parse_args(argv)
+
+    for name, generator in (("wide", wide_tree), ("deep", deep_tree)):
+        for size in args.sizes:
+            entries = generator(size)
+            infos = [_Info(uri) for uri, is_dir in entries]
+            is_directory = [is_dir for uri, is_dir in entries]
+
+            elapsed, layers = _time(engine._get_rename_layers, infos, is_directory)
+            line = "{0:5} {1:8d} entries {2:4d} layers   trie {3:9.3f}s".format(name, size, len(layers), elapsed)
+            if size <= args.reference_limit:
+                ref_elapsed, ref_layers = _time(_quadratic_layers, infos, is_directory)
+                assert [len(el) for el in ref_layers] == [len(el) for el in layers]
+                line += "   quadratic {0:9.3f}s".format(ref_elapsed)
+            print(line)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
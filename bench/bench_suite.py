@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# GNOME bulk rename utility
+# Copyright (C) 2010-2012 Holger Berndt <hb@gnome.org>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Measure how rename.Rename scales on synthetic trees.
+
+The trees live on a memfs.MemoryFileSystem and are renamed with the memory
+backend, so the numbers show the cost of the rename machinery rather than
+that of the disk. Each run is split into phases:
+
+  info_list      rename._get_rename_info_list on the files model
+  plan           planning of groups and layers
+  execute        rename tasks, everything not counted below
+  task_done      RenameTaskManager._task_done_cb, which relocates earlier
+                 renames below renamed directories
+  model_updates  Rename._apply_updates, which writes results to the model
+
+Results are written as JSON, to compare runs of different commits."""
+
+import sys
+import os
+import os.path
+import time
+import json
+import platform
+import functools
+import itertools
+import subprocess
+import gettext
+from argparse import ArgumentParser
+
+gettext.install("gnome-bulk-rename")
+
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_ROOT_DIR, "gnome-bulk-rename"))
+# the simulated file system lives with the tests
+sys.path.insert(0, os.path.join(_ROOT_DIR, "test"))
+
+from gi.repository import Gio
+from gi.repository import Gtk
+
+import constants
+import engine
+import memfs
+import rename
+
+
+_DEEP_LEVELS = 32
+_CYCLE_LENGTHS = (2, 3, 10)
+_FILES_PER_DIR = 1000
+
+
+def generate_flat(num_entries):
+    """All files in a single directory"""
+    return [("flat/f{0:07d}".format(ii), False, "r{0:07d}".format(ii)) for ii in range(num_entries)]
+
+
+def generate_wide(num_entries):
+    """Many directories with few files each, the directories are renamed as well"""
+    num_dirs = max(1, int(num_entries ** 0.5))
+    entries = [("wide/d{0:05d}".format(ii), True, "e{0:05d}".format(ii)) for ii in range(num_dirs)]
+    entries.extend(("wide/d{0:05d}/f{1:07d}".format(ii % num_dirs, ii), False, "r{0:07d}".format(ii))
+                   for ii in range(num_entries - num_dirs))
+    return entries
+
+
+def generate_deep(num_entries):
+    """Chains of nested directories with a file on each level, everything is renamed"""
+    entries = []
+    for chain in range(max(1, num_entries // (2*_DEEP_LEVELS))):
+        path = "deep/c{0:05d}".format(chain)
+        for level in range(_DEEP_LEVELS):
+            path += "/l{0}".format(level)
+            entries.append((path, True, "m{0}".format(level)))
+            entries.append((path + "/f", False, "g"))
+    return entries[:num_entries]
+
+
+def generate_cycle(num_entries):
+    """Files whose new names are those of other files, in cycles of different lengths"""
+    entries = []
+    lengths = itertools.cycle(_CYCLE_LENGTHS)
+    start = 0
+    while start < num_entries:
+        length = min(next(lengths), num_entries - start)
+        for ii in range(start, start + length):
+            target = start + (ii - start + 1) % length
+            dirname = "cycle/d{0:04d}".format(start // _FILES_PER_DIR)
+            entries.append(("{0}/f{1:07d}".format(dirname, ii), False, "f{0:07d}".format(target)))
+        start += length
+    return entries
+
+
+GENERATORS = {
+    "flat" : generate_flat,
+    "wide" : generate_wide,
+    "deep" : generate_deep,
+    "cycle" : generate_cycle,
+    }
+
+
+def create_tree(entries, latency=0.):
+    """Creates a memory file system with entries, and returns it with a files model for them"""
+    fs = memfs.MemoryFileSystem(latency)
+    model = Gtk.ListStore(*constants.FILES_MODEL_COLUMNS)
+    for path, is_dir, target in entries:
+        if is_dir:
+            fs.add_directory(path)
+            file_type = Gio.FileType.DIRECTORY
+        else:
+            fs.add_file(path)
+            file_type = Gio.FileType.REGULAR
+        dirname, name = os.path.split(path)
+        model.append([name, target, Gio.file_new_for_uri(fs.get_uri(path)), "", "", "", "", fs.get_uri(dirname) + "/",
+                      file_type])
+    return fs, model
+
+
+def _accumulate(timings, phase, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[phase] += time.perf_counter() - start
+    return wrapper
+
+
+def run(model):
+    """Renames model with the memory backend, and returns (timings dictionary, successes, errors)"""
+    timings = dict.fromkeys(("info_list", "plan", "execute", "task_done", "model_updates"), 0.)
+    start = time.perf_counter()
+    infos = rename._get_rename_info_list(model, None)
+    timings["info_list"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plan = engine.plan(infos, memfs.BACKEND)
+    timings["plan"] = time.perf_counter() - start
+
+    results = []
+
+    def done_cb(rename_results):
+        results.append(rename_results)
+        Gtk.main_quit()
+
+    patched = ((engine.RenameTaskManager, "_task_done_cb", "task_done"), (rename.Rename, "_apply_updates", "model_updates"))
+    originals = [getattr(cls, name) for cls, name, phase in patched]
+    for (cls, name, phase), func in zip(patched, originals):
+        setattr(cls, name, _accumulate(timings, phase, func))
+    try:
+        start = time.perf_counter()
+        rename.Rename(model, done_callback=done_cb, plan=plan)
+        if not results:
+            Gtk.main()
+        total = time.perf_counter() - start
+    finally:
+        for (cls, name, phase), func in zip(patched, originals):
+            setattr(cls, name, func)
+    timings["execute"] = total - timings["task_done"] - timings["model_updates"]
+    return timings, len(results[0].successes), len(results[0].errors)
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Time the phases of renaming synthetic trees, and write the results as JSON.")
+    parser.add_argument("--shapes", default=",".join(GENERATORS), help="comma separated list of tree shapes")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="comma separated list of numbers of entries")
+    parser.add_argument("--latency", type=float, default=0., help="seconds per batch of renames on the simulated mount")
+    parser.add_argument("--output", default=None, help="JSON file to write, default is standard output")
+    args = parser.parse_args(argv)
+
+    report = {"commit" : _get_commit(), "python" : platform.python_version(), "latency" : args.latency, "runs" : []}
+    for shape in args.shapes.split(","):
+        for size in [int(el) for el in args.sizes.split(",")]:
+            fs, model = create_tree(GENERATORS[shape](size), args.latency)
+            timings, num_successes, num_errors = run(model)
+            report["runs"].append({"shape" : shape, "size" : len(model), "phases" : timings,
+                                   "successes" : num_successes, "errors" : num_errors})
+            print("{0:6} {1:8d} entries  ".format(shape, len(model)) +
+                  "  ".join("{0} {1:7.3f}s".format(phase, seconds) for phase, seconds in timings.items()),
+                  file=sys.stderr)
+            del fs, model
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as ff:
+            json.dump(report, ff, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,18 +17,31 @@
 
 """Various checks"""
 
+import functools
 
 from gi.repository import Gtk
-from gi.repository import Gio
 from gi.repository import GLib
 
 import constants
+import engine
 
 
 class Checker:
-    """Perform various checks on a model"""
+    """Perform various checks on a model.
 
-    def __init__(self, model):
+    The columns that the checks need are read in a single pass over the
+    model, and the problems are kept in an engine.CheckIndex. Later runs
+    only re-check the rows whose preview changed. Only the icons of rows
+    whose problems changed are written back. The tooltip column keeps the
+    escaped uri of the row, and the problems are rendered on demand by
+    get_tooltip_markup().
+
+    If update_callback is given, the checks whether targets exist already
+    don't block. Their warnings are merged into the model as they arrive,
+    and update_callback is called afterwards. All other checks are done
+    when perform_checks() returns."""
+
+    def __init__(self, model, update_callback=None):
         # results that can be queried
         self.all_names_stay_the_same = True
         self.highest_problem_level = 0
@@ -36,117 +49,159 @@ class Checker:
 
         # common data
         self._model = model
+        self._update_cb = update_callback
 
+        # existence checks of earlier generations are outdated
+        self._generation = 0
 
-    def clear_all_warnings_and_errors(self):
-        for row in self._model:
-            row[constants.FILES_MODEL_COLUMN_ICON_STOCK] = ""
-            row[constants.FILES_MODEL_COLUMN_TOOLTIP] = GLib.markup_escape_text(row[constants.FILES_MODEL_COLUMN_GFILE].get_uri())
+        # state of the last run
+        self._index = None
+        self._names = None
+        self._targets = None
+        self._icons = None
 
 
-    def perform_checks(self):
-        """Run tests. Clears the model first."""
-        self.clear_all_warnings_and_errors()
+    @property
+    def existence_checks_pending(self):
+        return self._index is not None and bool(self._index.pending_existence_checks)
 
-        self._check_if_all_names_stay_the_same()
-        
-        # there can't be any problems in this case
-        if not self.all_names_stay_the_same:
-            # more common data
-            self._list_of_source_uris = [(row[constants.FILES_MODEL_COLUMN_URI_DIRNAME] + row[0]) for row in self._model]
-            self._list_of_target_uris = [(row[constants.FILES_MODEL_COLUMN_URI_DIRNAME] + row[1]) for row in self._model]
 
-            self._dict_source_uri_to_index = {}
-            for ii, uri in enumerate(self._list_of_source_uris):
-                self._dict_source_uri_to_index[uri] = ii
+    def get_tooltip_markup(self, row_index):
+        """Returns the markup lines of the problems of a row, to append to its tooltip"""
+        if self._index is None:
+            return ""
+        return "".join("\n" + self._format_problem(level, msg)
+                       for level, msg in self._index.results.problems.get(row_index, ()))
 
-            self._dict_target_uri_to_indices = {}
-            for ii, uri in enumerate(self._list_of_target_uris):
-                self._dict_target_uri_to_indices.setdefault(uri, []).append(ii)                    
-            
-            # checks
-            self._check_for_empty_targets()
-            self._check_slash_in_target()
-            self._check_for_double_targets()
-            self._check_for_circular_renaming()
-            self._check_for_already_existing_names()
 
+    def get_problems_markup(self):
+        """Returns a markup line for each kind of problem that any row has, errors first"""
+        if self._index is None:
+            return []
+        problems = sorted(self._index.results.problem_rows, key=lambda problem: (-problem[0], problem[1]))
+        return [self._format_problem(level, msg) for level, msg in problems]
 
-    def _check_if_all_names_stay_the_same(self):
-        self.all_names_stay_the_same = True
-        for row in self._model:
-            if row[0] != row[1]:
-                self.all_names_stay_the_same = False
-
-
-    def _check_for_empty_targets(self):
-        msg = "<b>%s:</b> %s" % (_("ERROR"), _("Empty target name"))
-        for ii,row in enumerate(self._model):
-            if row[1] == "":
-                self._model[ii][constants.FILES_MODEL_COLUMN_ICON_STOCK] = Gtk.STOCK_DIALOG_ERROR
-                self.highest_problem_level = max(self.highest_problem_level, 2)
-                self._add_tooltip_msg(ii, msg)
-                
-    def _check_slash_in_target(self):
-        msg = "<b>%s:</b> %s" % (_("ERROR"), _("Slash in target name"))
-        for ii,row in enumerate(self._model):
-            if "/" in row[1]:
-                self._model[ii][constants.FILES_MODEL_COLUMN_ICON_STOCK] = Gtk.STOCK_DIALOG_ERROR
-                self.highest_problem_level = max(self.highest_problem_level, 2)
-                self._add_tooltip_msg(ii, msg)
-        
-                    
-    def _check_for_double_targets(self):
-        """Sets pixbuf and tooltip text. Returns True if double targets exist"""
-        double_uris = []
-        for key,value in self._dict_target_uri_to_indices.items():
-            if len(value) > 1:
-                double_uris.append(key)
-
-        msg = "<b>%s:</b> %s" % (_("ERROR"), _("Double output filepath"))
-        registered = set()
-        for uri in double_uris:
-            for ii in self._dict_target_uri_to_indices[uri]:
-                if ii not in registered:
-                    self._model[ii][constants.FILES_MODEL_COLUMN_ICON_STOCK] = Gtk.STOCK_DIALOG_ERROR
-                    self.highest_problem_level = max(self.highest_problem_level, 2)
-                    self._add_tooltip_msg(ii, msg)
-                    registered.add(ii)
-
-
-    def _check_for_circular_renaming(self):
-        self.circular_uris = set()
-        # we have a circular renaming if one row's source refers to the same uri as another row's target
-        set_of_source_uris = set(self._list_of_source_uris)
-        set_of_target_uris = set(self._list_of_target_uris)
-        possible_circular_uris = set_of_source_uris.intersection(set_of_target_uris)
-        for pu in possible_circular_uris:
-            if len(self._dict_target_uri_to_indices[pu]) > 1 or self._dict_source_uri_to_index[pu] != self._dict_target_uri_to_indices[pu][0]:
-                self.circular_uris.add(pu)
-
-
-    def _check_for_already_existing_names(self):
-        """Check if a target name already exists on the file system, but is not a circular rename"""
-        existing_files = set()
+
+    def cancel(self):
+        """Ignore the outcome of existence checks that are still running"""
+        self._generation += 1
+
+
+    def clear_all_warnings_and_errors(self):
+        self.cancel()
         for row in self._model:
-            if row[0] == row[1] or not row[1]:
-                continue
-            new_name = row[constants.FILES_MODEL_COLUMN_URI_DIRNAME] + row[1]
-            if new_name not in self.circular_uris:
-                parent = Gio.file_new_for_uri(row[constants.FILES_MODEL_COLUMN_URI_DIRNAME])
-                file = parent.get_child_for_display_name(row[1])
-                if file.query_exists(None):
-                    existing_files.add(new_name)
-
-        # mark files
-        msg = "<b>%s:</b> %s" % (_("WARNING"), _("Target filename already exists on the filesystem"))
-        for uri in existing_files:
-            for idx in self._dict_target_uri_to_indices[uri]:
-                if self._model[idx][constants.FILES_MODEL_COLUMN_ICON_STOCK] != Gtk.STOCK_DIALOG_ERROR:
-                    self._model[idx][constants.FILES_MODEL_COLUMN_ICON_STOCK] = Gtk.STOCK_DIALOG_WARNING
-                self._add_tooltip_msg(idx, msg)
-                self.highest_problem_level = max(self.highest_problem_level, 1)
-
-
-    def _add_tooltip_msg(self, row_num, msg):
-        self._model[row_num][constants.FILES_MODEL_COLUMN_TOOLTIP] = self._model[row_num][constants.FILES_MODEL_COLUMN_TOOLTIP] + "\n" + msg
+            row[constants.FILES_MODEL_COLUMN_ICON_STOCK] = ""
+            row[constants.FILES_MODEL_COLUMN_TOOLTIP] = GLib.markup_escape_text(row[constants.FILES_MODEL_COLUMN_GFILE].get_uri())
+        self._index = None
+
+
+    def perform_checks(self, dirty_rows=None):
+        """Run tests, and update the rows whose problems changed.
+
+        dirty_rows is the set of rows whose preview changed since the last
+        run. If it is None, the preview column is compared to that of the last
+        run. The first run, and runs after rows were added, removed, reordered
+        or renamed, check all rows."""
+        changes = None
+        if self._index is not None and len(self._model) == len(self._index):
+            if dirty_rows is None:
+                names, targets = self._read_columns(constants.FILES_MODEL_COLUMN_ORIGINAL,
+                                                    constants.FILES_MODEL_COLUMN_PREVIEW)
+                if names == self._names:
+                    changes = {ii : target for ii, (old_target, target) in enumerate(zip(self._targets, targets))
+                               if target != old_target}
+            else:
+                changes = {}
+                for ii in dirty_rows:
+                    target = self._model[ii][constants.FILES_MODEL_COLUMN_PREVIEW]
+                    if target != self._targets[ii]:
+                        changes[ii] = target
+
+        if changes is None:
+            dir_uris, self._names, self._targets, self._icons = self._read_columns(
+                constants.FILES_MODEL_COLUMN_URI_DIRNAME, constants.FILES_MODEL_COLUMN_ORIGINAL,
+                constants.FILES_MODEL_COLUMN_PREVIEW, constants.FILES_MODEL_COLUMN_ICON_STOCK)
+            self._index = engine.CheckIndex(list(zip(dir_uris, self._names, self._targets)),
+                                            defer_existence=self._update_cb is not None)
+            # rows that have problems now, or had some before
+            rows = set(self._index.results.problems)
+            rows.update(ii for ii, icon in enumerate(self._icons) if icon)
+        else:
+            for ii, target in changes.items():
+                self._targets[ii] = target
+            rows = self._index.set_targets(changes)
+        self._write_back(rows)
+
+        if self._update_cb is not None:
+            self._generation += 1
+            self._start_existence_checks()
+
+
+    def _start_existence_checks(self):
+        """Check the pending target uris of the index, grouped by directory"""
+        by_dir_uri = {}
+        for uri, (dir_uri, target) in self._index.pending_existence_checks.items():
+            by_dir_uri.setdefault(dir_uri, []).append((uri, target))
+        for dir_uri, items in by_dir_uri.items():
+            engine.check_existence_async(dir_uri, [target for uri, target in items],
+                                         functools.partial(self._existence_cb, self._generation, items))
+
+
+    def _existence_cb(self, generation, items, existing):
+        if generation != self._generation:
+            return
+        rows = set()
+        for uri, target in items:
+            rows.update(self._index.set_existence(uri, target in existing))
+        if rows:
+            self._write_back(rows)
+            self._update_cb()
+
+
+    def _write_back(self, rows):
+        """Update the results, and the icons of rows"""
+        results = self._index.results
+        self.all_names_stay_the_same = results.all_names_stay_the_same
+        self.highest_problem_level = results.highest_problem_level
+        self.circular_uris = results.circular_uris
+
+        for ii in sorted(rows):
+            icon = self._get_icon(results.problems.get(ii, ()))
+            if icon != self._icons[ii]:
+                row = self._model[ii]
+                row[constants.FILES_MODEL_COLUMN_ICON_STOCK] = icon
+                # drop rename errors of earlier runs
+                row[constants.FILES_MODEL_COLUMN_TOOLTIP] = GLib.markup_escape_text(row[constants.FILES_MODEL_COLUMN_GFILE].get_uri())
+                self._icons[ii] = icon
+
+
+    def _read_columns(self, *columns):
+        """Returns the given columns of the model as one list each"""
+        if not len(self._model):
+            return [[] for col in columns]
+        try:
+            get_values = self._model.get
+        except AttributeError:
+            # plain lists of rows
+            rows = [[row[col] for col in columns] for row in self._model]
+        else:
+            rows = [get_values(row.iter, *columns) for row in self._model]
+        return [list(column) for column in zip(*rows)]
+
+
+    @staticmethod
+    def _get_icon(problems):
+        """Returns the icon of a row with problems, a list of (level, message) tuples"""
+        highest_level = max((level for level, msg in problems), default=0)
+        if highest_level == engine.PROBLEM_LEVEL_ERROR:
+            return Gtk.STOCK_DIALOG_ERROR
+        elif highest_level == engine.PROBLEM_LEVEL_WARNING:
+            return Gtk.STOCK_DIALOG_WARNING
+        return ""
+
+
+    @staticmethod
+    def _format_problem(level, msg):
+        if level == engine.PROBLEM_LEVEL_ERROR:
+            return "<b>%s:</b> %s" % (_("ERROR"), msg)
+        return "<b>%s:</b> %s" % (_("WARNING"), msg)
@@ -25,7 +25,7 @@ GBR_GTK_TREE_SORTABLE_UNSORTED_SORT_COLUMN_ID = -2
 
 from gi.repository import Gio
 
-FILES_MODEL_COLUMNS = (str, str, Gio.File, str, str, str, str, str)
+FILES_MODEL_COLUMNS = (str, str, Gio.File, str, str, str, str, str, int)
 FILES_MODEL_COLUMN_ORIGINAL = 0         # code relies on that
 FILES_MODEL_COLUMN_PREVIEW = 1          # code relies on that
 FILES_MODEL_COLUMN_GFILE = 2            # code relies on that
@@ -34,6 +34,7 @@ FILES_MODEL_COLUMN_MARKUP_PREVIEW = 4
 FILES_MODEL_COLUMN_ICON_STOCK = 5
 FILES_MODEL_COLUMN_TOOLTIP = 6
 FILES_MODEL_COLUMN_URI_DIRNAME = 7
+FILES_MODEL_COLUMN_FILE_TYPE = 8        # Gio.FileType, not following symlinks
     
 EXTENSIBLE_MODEL_COLUMNS = (str, object, float, bool, str)
 EXTENSIBLE_MODEL_COLUMN_SHORT_DESCRIPTION = 0
@@ -47,6 +48,34 @@ SORT_ID_MANUAL = 0
 FILES_INFO_BAR_RESPONSE_ID_INFO_WARNING = 1
 FILES_INFO_BAR_RESPONSE_ID_INFO_ERROR = 2
 FILES_INFO_BAR_RESPONSE_ID_UNDO = 3
+FILES_INFO_BAR_RESPONSE_ID_CANCEL_RENAME = 4
+
+# number of renames that are kept in flight at the same time
+RENAME_IN_FLIGHT_INITIAL = 16
+RENAME_IN_FLIGHT_MIN = 2
+RENAME_IN_FLIGHT_MAX = 256
+
+# directories whose listings are kept for the "target already exists" check
+CHECK_DIRECTORY_CACHE_MAX = 256
+
+# rows of the files model that are updated per idle callback during rename
+RENAME_MODEL_UPDATE_BATCH_SIZE = 1000
+# seconds between progress reports during rename
+RENAME_PROGRESS_INTERVAL = 0.25
+
+# how renames are carried out
+RENAME_BACKEND_GIO = "gio"      # Gio.File.set_display_name_async for everything
+RENAME_BACKEND_POSIX = "posix"  # renameat relative to the parent directory for local files
+RENAME_BACKEND_THREADS = "threads"  # blocking renames of local files in a thread pool
+RENAME_BACKEND_IO_URING = "io_uring"  # batches of renameat operations on an io_uring, falls back to posix
+
+# thread pool sizes of the threads backend
+RENAME_THREADS_ROTATIONAL = 2
+RENAME_THREADS_MAX = 32
+RENAME_THREADS_DEFAULT = 8      # storage of unknown kind, e.g. network file systems
+
+# submission queue size of the io_uring backend, and number of renames per batch
+RENAME_IO_URING_ENTRIES = 1024
 
 SETTINGS_SCHEMA_NAUTILUS = "org.gnome.nautilus.preferences"
 SETTINGS_NAUTILUS_BULK_RENAME_TOOL = "bulk-rename-tool"
@@ -0,0 +1,2188 @@
+# GNOME bulk rename utility
+# Copyright (C) 2010-2012 Holger Berndt <hb@gnome.org>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Rename engine that works on plain Python sequences.
+
+This module doesn't use GTK. It runs the steps of a bulk rename on lists of
+(directory, name, target) entries: previews, checks, planning and
+execution. The GTK frontend keeps its data in a Gtk.ListStore, and uses
+this module for the actual work.
+"""
+
+import os
+import errno
+import math
+import stat
+import time
+import logging
+import functools
+import collections
+import threading
+import concurrent.futures
+
+from gi.repository import Gio
+from gi.repository import GLib
+
+import constants
+import syscalls
+import journal
+
+# scripts use the engine without the frontend's gettext.install()
+try:
+    _
+except NameError:
+    from gettext import gettext as _
+
+
+_logger = logging.getLogger("gnome.bulk-rename.engine")
+
+
+# problem levels of check()
+PROBLEM_LEVEL_WARNING = 1
+PROBLEM_LEVEL_ERROR = 2
+
+
+def preview(names, previewer):
+    """Returns the list of target names for names.
+
+    previewer is either a function that maps a name to its target name, or
+    a preview-like object (see preview.py), whose preview() is run on rows
+    of [name, target] lists instead of a files model."""
+    if not hasattr(previewer, "preview"):
+        return [previewer(name) for name in names]
+    rows = [[name, name] for name in names]
+    previewer.preview(rows)
+    return [row[1] for row in rows]
+
+
+class CheckResults:
+    """Problems found by check()"""
+
+    def __init__(self):
+        self.all_names_stay_the_same = True
+        self.highest_problem_level = 0
+        self.circular_uris = set()
+        self.problems = {}  # entry index -> list of (level, message) tuples
+        self.problem_rows = {}  # (level, message) -> set of entry indices with that problem
+        self.level_counts = [0, 0, 0]  # number of entries by their highest problem level
+
+
+def check(entries):
+    """Check a list of (directory uri, name, target) entries for problems.
+
+    The directory uri ends with a slash. Returns a CheckResults object. Use
+    a CheckIndex to check again after some targets changed."""
+    return CheckIndex(entries).results
+
+
+class CheckIndex:
+    """Problems of a list of (directory uri, name, target) entries, kept up to
+    date as targets change.
+
+    The uri indices and the outcome of existence checks are kept between
+    updates, so an update costs as much as the entries whose target changed,
+    plus those that share a target uri with them.
+
+    If defer_existence is True, existence checks aren't run. The target uris
+    that need one are collected in pending_existence_checks instead, and
+    the outcome is entered with set_existence()."""
+
+    def __init__(self, entries, defer_existence=False):
+        self.results = CheckResults()
+        # target uri -> (directory uri, target) whose existence is still to be checked
+        self.pending_existence_checks = {}
+
+        self._defer_existence = defer_existence
+
+        self._dir_uris = []
+        self._names = []
+        self._targets = []
+        self._source_uri_to_index = {}
+        self._target_uri_to_indices = {}
+        self._existing_uris = set()     # target uris that exist, and aren't circular
+        self._num_changed = 0           # entries whose name changes
+
+        for ii, (dir_uri, name, target) in enumerate(entries):
+            self._dir_uris.append(dir_uri)
+            self._names.append(name)
+            self._targets.append(target)
+            self._source_uri_to_index[dir_uri + name] = ii
+            self._target_uri_to_indices.setdefault(dir_uri + target, []).append(ii)
+            if name != target:
+                self._num_changed += 1
+        self.results.level_counts[0] = len(self._targets)
+
+        # there can't be any problems in this case
+        if self._num_changed == 0:
+            self._update_summary()
+            return
+        self._update(range(len(self._targets)), list(self._target_uri_to_indices))
+
+
+    def __len__(self):
+        return len(self._targets)
+
+
+    def set_targets(self, changes):
+        """Change the targets of entries. changes is a dictionary of index -> new target.
+
+        Returns the set of indices whose problems may have changed."""
+        uris = set()
+        for ii, target in changes.items():
+            dir_uri = self._dir_uris[ii]
+            old_target = self._targets[ii]
+            if target == old_target:
+                continue
+            old_uri = dir_uri + old_target
+            indices = self._target_uri_to_indices[old_uri]
+            indices.remove(ii)
+            if not indices:
+                del self._target_uri_to_indices[old_uri]
+            new_uri = dir_uri + target
+            self._target_uri_to_indices.setdefault(new_uri, []).append(ii)
+            self._num_changed += (target != self._names[ii]) - (old_target != self._names[ii])
+            self._targets[ii] = target
+            uris.add(old_uri)
+            uris.add(new_uri)
+        return self._update(changes.keys(), uris)
+
+
+    def set_existence(self, uri, exists):
+        """Enter the outcome of a deferred existence check of the target uri uri.
+
+        Returns the set of indices whose problems may have changed. Outcomes
+        for uris that aren't pending anymore are ignored."""
+        if self.pending_existence_checks.pop(uri, None) is None:
+            return set()
+        if exists:
+            self._existing_uris.add(uri)
+        else:
+            self._existing_uris.discard(uri)
+        rows = set(self._target_uri_to_indices.get(uri, ()))
+        for ii in rows:
+            self._set_problems(ii)
+        self._update_summary()
+        return rows
+
+
+    def _update(self, indices, uris):
+        """Re-evaluate the target uris uris, and the problems of indices and of
+        all entries with one of those target uris. Returns the set of re-evaluated indices."""
+        _directory_cache.new_pass()
+        for uri in uris:
+            self._update_target_uri(uri)
+        rows = set(indices)
+        for uri in uris:
+            rows.update(self._target_uri_to_indices.get(uri, ()))
+        for ii in rows:
+            self._set_problems(ii)
+        self._update_summary()
+        return rows
+
+
+    def _update_target_uri(self, uri):
+        """Circularity and existence of a target uri"""
+        # circular renaming: one entry's source is the same uri as another entry's target
+        indices = self._target_uri_to_indices.get(uri)
+        source_index = self._source_uri_to_index.get(uri)
+        if indices and source_index is not None and (len(indices) > 1 or source_index != indices[0]):
+            self.results.circular_uris.add(uri)
+            self._existing_uris.discard(uri)
+            self.pending_existence_checks.pop(uri, None)
+            return
+        self.results.circular_uris.discard(uri)
+
+        # targets that already exist on the file system
+        for ii in indices or ():
+            target = self._targets[ii]
+            if target != self._names[ii] and target and "/" not in target:
+                if self._defer_existence:
+                    # the last known outcome stays until the new one arrives
+                    self.pending_existence_checks[uri] = (self._dir_uris[ii], target)
+                    return
+                if _target_exists(self._dir_uris[ii], target):
+                    self._existing_uris.add(uri)
+                    return
+                break
+        self._existing_uris.discard(uri)
+        self.pending_existence_checks.pop(uri, None)
+
+
+    def _set_problems(self, ii):
+        target = self._targets[ii]
+        problems = []
+        if target == "":
+            problems.append((PROBLEM_LEVEL_ERROR, _("Empty target name")))
+        if "/" in target:
+            problems.append((PROBLEM_LEVEL_ERROR, _("Slash in target name")))
+        uri = self._dir_uris[ii] + target
+        if len(self._target_uri_to_indices[uri]) > 1:
+            problems.append((PROBLEM_LEVEL_ERROR, _("Double output filepath")))
+        if uri in self._existing_uris:
+            problems.append((PROBLEM_LEVEL_WARNING, _("Target filename already exists on the filesystem")))
+
+        results = self.results
+        old_problems = results.problems.pop(ii, ())
+        for problem in old_problems:
+            rows = results.problem_rows[problem]
+            rows.discard(ii)
+            if not rows:
+                del results.problem_rows[problem]
+        for problem in problems:
+            results.problem_rows.setdefault(problem, set()).add(ii)
+        results.level_counts[max((level for level, msg in old_problems), default=0)] -= 1
+        results.level_counts[max((level for level, msg in problems), default=0)] += 1
+        if problems:
+            results.problems[ii] = problems
+
+
+    def _update_summary(self):
+        self.results.all_names_stay_the_same = (self._num_changed == 0)
+        self.results.highest_problem_level = max((level for level in (PROBLEM_LEVEL_WARNING, PROBLEM_LEVEL_ERROR)
+                                                  if self.results.level_counts[level]), default=0)
+
+
+# lookup functions of file systems that GIO doesn't know, see register_file_system()
+_file_system_lookups = []
+
+
+def register_file_system(lookup):
+    """Make the engine use a file system that GIO doesn't know, like the
+    simulated ones of tests and benchmarks.
+
+    lookup(uri) returns an object for uris on that file system, and None for
+    all others. The object answers exists(uri) and query_file_type(uri) for
+    check() and get_rename_infos(). Renaming needs a backend for it, see
+    register_backend()."""
+    _file_system_lookups.append(lookup)
+
+
+def _lookup_file_system(uri):
+    for lookup in _file_system_lookups:
+        fs = lookup(uri)
+        if fs is not None:
+            return fs
+    return None
+
+
+def _target_exists(dir_uri, target):
+    fs = _lookup_file_system(dir_uri)
+    if fs is not None:
+        return fs.exists(Gio.file_new_for_uri(dir_uri).get_child_for_display_name(target).get_uri())
+    names = _directory_cache.get_names(dir_uri)
+    if names is not None:
+        return target in names
+    return Gio.file_new_for_uri(dir_uri).get_child_for_display_name(target).query_exists(None)
+
+
+def check_existence_async(dir_uri, targets, callback):
+    """Find out which of targets exist in the directory dir_uri, without blocking.
+
+    callback is called with the set of existing targets. It is called right
+    away if that is known without I/O, as for registered file systems and
+    directories whose listing is cached."""
+    fs = _lookup_file_system(dir_uri)
+    if fs is not None:
+        callback({target for target in targets if _target_exists(dir_uri, target)})
+        return
+
+    def names_cb(names):
+        if names is not None:
+            callback({target for target in targets if target in names})
+        else:
+            _query_exists_async(dir_uri, targets, callback)
+    _directory_cache.get_names_async(dir_uri, names_cb)
+
+
+def _query_exists_async(dir_uri, targets, callback):
+    """check_existence_async() for directories that can't be listed, one query per target"""
+    existing = set()
+    num_pending = [len(targets)]
+
+    def query_info_async_cb(gfile, result, target):
+        try:
+            gfile.query_info_finish(result)
+        except RuntimeError:
+            pass
+        else:
+            existing.add(target)
+        num_pending[0] -= 1
+        if num_pending[0] == 0:
+            callback(existing)
+
+    if not targets:
+        callback(existing)
+        return
+    directory = Gio.file_new_for_uri(dir_uri)
+    for target in targets:
+        directory.get_child_for_display_name(target).query_info_async(
+            Gio.FILE_ATTRIBUTE_STANDARD_TYPE, Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS, GLib.PRIORITY_DEFAULT, None,
+            query_info_async_cb, target)
+
+
+class _DirectoryCache:
+    """Names in directories, for existence checks without a query per file.
+
+    Each directory is enumerated once. A listing stays valid until the
+    directory monitor reports a change. Where monitoring isn't supported
+    (or monitor is False), the modification time of the directory is
+    compared instead, once per check pass. Monitor events are only
+    delivered while a main loop runs, so renames by the engine clear the
+    cache explicitly."""
+
+    _ATTRIBUTES_MTIME = ",".join([Gio.FILE_ATTRIBUTE_TIME_MODIFIED, Gio.FILE_ATTRIBUTE_TIME_MODIFIED_USEC])
+
+    def __init__(self, max_size=constants.CHECK_DIRECTORY_CACHE_MAX, monitor=True):
+        self._max_size = max_size
+        self._monitor = monitor
+        self._pass = 0
+        # dir uri -> [names, monitor, mtime, pass], least recently used first
+        self._listings = collections.OrderedDict()
+        # dir uri -> _AsyncListing that is running
+        self._pending = {}
+
+
+    def new_pass(self):
+        """Start a check pass. Unmonitored listings are validated again."""
+        self._pass += 1
+
+
+    def get_names(self, dir_uri):
+        """Returns the set of names in dir_uri, or None if it can't be listed"""
+        listing = self._get_listing(dir_uri)
+        if listing is not None and (listing[1] is not None or listing[3] == self._pass):
+            return listing[0]
+        directory = Gio.file_new_for_uri(dir_uri)
+        if listing is not None:
+            if listing[2] is not None and listing[2] == self._query_mtime(directory):
+                listing[3] = self._pass
+                return listing[0]
+
+        monitor = self._create_monitor(directory, dir_uri)
+        # without a monitor, the modification time has to be known before listing
+        mtime = self._query_mtime(directory) if monitor is None else None
+        try:
+            names = {info.get_name() for info in directory.enumerate_children(Gio.FILE_ATTRIBUTE_STANDARD_NAME,
+                                                                              Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS, None)}
+        except RuntimeError as ee:
+            _logger.debug("Could not list {0}: {1}".format(dir_uri, ee.message))
+            if monitor is not None:
+                monitor.cancel()
+            self.invalidate(dir_uri)
+            return None
+        self._store(dir_uri, names, monitor, mtime)
+        return names
+
+
+    def get_names_async(self, dir_uri, callback):
+        """Like get_names(), but calls callback with the result instead of
+        blocking. callback is called right away if the cached listing is
+        known to be valid."""
+        listing = self._get_listing(dir_uri)
+        if listing is not None and (listing[1] is not None or listing[3] == self._pass):
+            callback(listing[0])
+            return
+        job = self._pending.get(dir_uri)
+        if job is None:
+            job = _AsyncListing(self, dir_uri, listing)
+            self._pending[dir_uri] = job
+            job.callbacks.append(callback)
+            job.start()
+        else:
+            job.callbacks.append(callback)
+
+
+    def invalidate(self, dir_uri):
+        listing = self._listings.pop(dir_uri, None)
+        if listing is not None and listing[1] is not None:
+            listing[1].cancel()
+        job = self._pending.get(dir_uri)
+        if job is not None:
+            job.outdated = True
+
+
+    def clear(self):
+        for dir_uri in list(self._listings):
+            self.invalidate(dir_uri)
+        for job in self._pending.values():
+            job.outdated = True
+
+
+    def _get_listing(self, dir_uri):
+        listing = self._listings.get(dir_uri)
+        if listing is not None:
+            self._listings.move_to_end(dir_uri)
+        return listing
+
+
+    def _store(self, dir_uri, names, monitor, mtime):
+        self.invalidate(dir_uri)
+        self._listings[dir_uri] = [names, monitor, mtime, self._pass]
+        while len(self._listings) > self._max_size:
+            self.invalidate(next(iter(self._listings)))
+
+
+    def _create_monitor(self, directory, dir_uri):
+        if not self._monitor:
+            return None
+        try:
+            monitor = directory.monitor_directory(Gio.FileMonitorFlags.NONE, None)
+        except RuntimeError:
+            return None
+        monitor.connect("changed", self._on_changed, dir_uri)
+        return monitor
+
+
+    def _on_changed(self, monitor, gfile, other_gfile, event_type, dir_uri):
+        # content and attribute changes leave the names as they are
+        if event_type in (Gio.FileMonitorEvent.CHANGED, Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+                          Gio.FileMonitorEvent.ATTRIBUTE_CHANGED):
+            return
+        listing = self._listings.get(dir_uri)
+        if listing is not None and listing[1] is monitor:
+            self.invalidate(dir_uri)
+            return
+        job = self._pending.get(dir_uri)
+        if job is not None and job.monitor is monitor:
+            job.outdated = True
+
+
+    def _query_mtime(self, directory):
+        try:
+            info = directory.query_info(self._ATTRIBUTES_MTIME, Gio.FileQueryInfoFlags.NONE, None)
+        except RuntimeError:
+            return None
+        return self._get_mtime(info)
+
+
+    @staticmethod
+    def _get_mtime(info):
+        if not info.has_attribute(Gio.FILE_ATTRIBUTE_TIME_MODIFIED):
+            return None
+        return (info.get_attribute_uint64(Gio.FILE_ATTRIBUTE_TIME_MODIFIED),
+                info.get_attribute_uint32(Gio.FILE_ATTRIBUTE_TIME_MODIFIED_USEC))
+
+
+class _AsyncListing:
+    """A directory listing of _DirectoryCache.get_names_async() that is running.
+
+    An unmonitored listing that is cached is validated by the modification
+    time first. Otherwise the directory is enumerated in chunks. The names
+    are handed to all callbacks, but not cached if the directory changed
+    in the meantime."""
+
+    _NUM_FILES_PER_CHUNK = 1000
+
+    def __init__(self, cache, dir_uri, listing):
+        self.callbacks = []
+        self.monitor = None
+        self.outdated = False
+        self._cache = cache
+        self._dir_uri = dir_uri
+        self._directory = Gio.file_new_for_uri(dir_uri)
+        self._listing = listing
+        self._mtime = None
+        self._names = set()
+
+
+    def start(self):
+        if self._listing is not None and self._listing[2] is not None:
+            self._query_mtime()
+        else:
+            self._enumerate()
+
+
+    def _query_mtime(self):
+        self._directory.query_info_async(_DirectoryCache._ATTRIBUTES_MTIME, Gio.FileQueryInfoFlags.NONE,
+                                         GLib.PRIORITY_DEFAULT, None, self._query_info_async_cb, None)
+
+
+    def _query_info_async_cb(self, directory, result, user_data):
+        try:
+            self._mtime = _DirectoryCache._get_mtime(directory.query_info_finish(result))
+        except RuntimeError:
+            self._mtime = None
+        listing = self._listing
+        self._listing = None
+        if listing is not None:
+            # a cached listing that is still valid
+            if self._mtime is not None and self._mtime == listing[2] and self._cache._listings.get(self._dir_uri) is listing:
+                listing[3] = self._cache._pass
+                self._done(listing[0], store=False)
+                return
+            # changed, list it again with the modification time from before listing
+        self._enumerate_children()
+
+
+    def _enumerate(self):
+        self.monitor = self._cache._create_monitor(self._directory, self._dir_uri)
+        if self.monitor is None:
+            # the modification time has to be known before listing
+            self._query_mtime()
+        else:
+            self._enumerate_children()
+
+
+    def _enumerate_children(self):
+        self._directory.enumerate_children_async(Gio.FILE_ATTRIBUTE_STANDARD_NAME, Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS,
+                                                 GLib.PRIORITY_DEFAULT, None, self._enumerate_children_async_cb, None)
+
+
+    def _enumerate_children_async_cb(self, directory, result, user_data):
+        try:
+            enumerator = directory.enumerate_children_finish(result)
+        except RuntimeError as ee:
+            self._failed(ee)
+            return
+        enumerator.next_files_async(self._NUM_FILES_PER_CHUNK, GLib.PRIORITY_DEFAULT, None, self._next_files_async_cb, None)
+
+
+    def _next_files_async_cb(self, enumerator, result, user_data):
+        try:
+            infos = enumerator.next_files_finish(result)
+        except RuntimeError as ee:
+            enumerator.close_async(GLib.PRIORITY_DEFAULT, None, None, None)
+            self._failed(ee)
+            return
+        if infos:
+            self._names.update(info.get_name() for info in infos)
+            enumerator.next_files_async(self._NUM_FILES_PER_CHUNK, GLib.PRIORITY_DEFAULT, None, self._next_files_async_cb, None)
+        else:
+            enumerator.close_async(GLib.PRIORITY_DEFAULT, None, None, None)
+            self._done(self._names, store=True)
+
+
+    def _failed(self, ee):
+        _logger.debug("Could not list {0}: {1}".format(self._dir_uri, ee.message))
+        if self.monitor is not None:
+            self.monitor.cancel()
+        self._done(None, store=False)
+
+
+    def _done(self, names, store):
+        if self._cache._pending.get(self._dir_uri) is self:
+            del self._cache._pending[self._dir_uri]
+        if store and not self.outdated:
+            self._cache._store(self._dir_uri, names, self.monitor, self._mtime)
+        elif store and self.monitor is not None:
+            self.monitor.cancel()
+        for callback in self.callbacks:
+            callback(names)
+
+
+_directory_cache = _DirectoryCache()
+
+
+def get_rename_infos(entries):
+    """Returns RenameInfo objects for the (directory, name, target) entries whose name changes.
+
+    The directory is a uri ending with a slash, or a local path. The row
+    number of a RenameInfo is the index of its entry. File types of local
+    files and files on registered file systems are determined right away,
+    plan() queries the other ones."""
+    infos = []
+    dir_files = {}
+    for ii, (dirname, name, target) in enumerate(entries):
+        if name == target:
+            continue
+        try:
+            dir_file = dir_files[dirname]
+        except KeyError:
+            dir_file = Gio.file_new_for_commandline_arg(dirname)
+            dir_files[dirname] = dir_file
+        infos.append(RenameInfo(dir_file.get_child_for_display_name(name), name, target, ii))
+
+    for el in infos:
+        path = el.gfile.get_path()
+        if path is None:
+            fs = _lookup_file_system(el.gfile.get_uri())
+            if fs is not None:
+                el.file_type = fs.query_file_type(el.gfile.get_uri())
+            continue
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError:
+            continue
+        if stat.S_ISDIR(mode):
+            el.file_type = Gio.FileType.DIRECTORY
+        elif stat.S_ISLNK(mode):
+            el.file_type = Gio.FileType.SYMBOLIC_LINK
+        else:
+            el.file_type = Gio.FileType.REGULAR
+    return infos
+
+
+class RenamePlan:
+    """The layers in which a list of RenameInfo objects is going to be renamed.
+
+    Planning doesn't touch the file system. File types have to be known
+    already, plan() determines unknown ones first. Files whose type can't be
+    determined either are planned like regular files. A plan can be
+    explained, exported, and executed.
+
+    The renames are grouped by mount. Groups are carried out concurrently,
+    and each group has its own layers."""
+
+    def __init__(self, rename_infos, backend=constants.RENAME_BACKEND_GIO):
+        self.rename_infos = rename_infos
+        self.backend = backend
+        self.groups = _create_rename_groups(rename_infos, backend) if rename_infos else []  # (mount, layers) tuples
+
+    @property
+    def layers(self):
+        """The layers of all groups"""
+        return [layer for mount, layers in self.groups for layer in layers]
+
+    @property
+    def num_renames(self):
+        return len(self.rename_infos)
+
+    @property
+    def num_layers(self):
+        """The number of layers of the group with the most layers"""
+        return max((len(layers) for mount, layers in self.groups), default=0)
+
+    @property
+    def num_steps(self):
+        return sum(len(layer) for layer in self.layers)
+
+    @property
+    def num_temporary_renames(self):
+        return sum(1 for layer in self.layers for el in layer if el.temporary)
+
+    @property
+    def num_exchanges(self):
+        return sum(1 for layer in self.layers for el in layer if el.exchange_with is not None)
+
+
+    def get_directory_counts(self):
+        """Returns a Counter of directory uri -> number of renamed files"""
+        return collections.Counter(el.gfile.get_uri().rpartition("/")[0] for el in self.rename_infos)
+
+
+    def get_mount_counts(self):
+        """Returns a Counter of mount -> number of renamed files.
+
+        Local files are grouped by their mount point in the mount table,
+        other files by the scheme and authority of their uri."""
+        return collections.Counter(_get_mount_keys(self.rename_infos))
+
+
+    def explain(self, max_directories=10):
+        """Returns a human readable description of the plan"""
+        lines = ["{0} renames in {1} steps and {2} layers, using the {3} backend".format(
+            self.num_renames, self.num_steps, self.num_layers, self.backend)]
+        lines.append("{0} temporary renames, {1} exchanges".format(self.num_temporary_renames, self.num_exchanges))
+        mount_counts = self.get_mount_counts()
+        for mount, layers in self.groups:
+            if mount is None:
+                lines.append("all mounts, because of nested mount points:")
+            else:
+                lines.append("mount {0}: {1} renames".format(mount, mount_counts[mount]))
+            for ii, layer in enumerate(layers):
+                lines.append("  layer {0}: {1} steps".format(ii + 1, len(layer)))
+        directory_counts = self.get_directory_counts()
+        lines.append("directories ({0}):".format(len(directory_counts)))
+        for dir_uri, count in directory_counts.most_common(max_directories):
+            lines.append("  {0}: {1}".format(dir_uri, count))
+        if len(directory_counts) > max_directories:
+            lines.append("  ...")
+        return "\n".join(lines)
+
+
+    def to_dict(self):
+        """Returns the plan as a dictionary that can be serialized as JSON.
+
+        Each group has a mount and a list of layers. Layers are lists of
+        [kind, uri, new display name] steps, like in the rename journal."""
+        return {
+            "backend" : self.backend,
+            "num_renames" : self.num_renames,
+            "num_steps" : self.num_steps,
+            "num_temporary_renames" : self.num_temporary_renames,
+            "num_exchanges" : self.num_exchanges,
+            "directories" : dict(self.get_directory_counts()),
+            "mounts" : dict(self.get_mount_counts()),
+            "groups" : [{"mount" : mount, "layers" : [[_describe_step(el) for el in layer] for layer in layers]}
+                        for mount, layers in self.groups],
+        }
+
+
+    def execute(self, done_callback, progress_callback=None, layer_callback=None, max_in_flight=None,
+                journal_dir=None):
+        """Start renaming according to the plan. Returns the RenameTaskManager,
+        see RenameTaskManager.start() for the callbacks.
+
+        An empty plan calls done_callback right away, and returns None."""
+        if not self.rename_infos:
+            done_callback([], [])
+            return None
+        manager = RenameTaskManager(self.rename_infos, max_in_flight, self.backend, journal_dir, self.groups)
+        manager.start(done_callback, progress_callback, layer_callback)
+        return manager
+
+
+def plan(rename_infos, backend=constants.RENAME_BACKEND_GIO):
+    """Returns the RenamePlan for rename_infos.
+
+    Unknown file types, e.g. of remote files, are queried first, as a
+    directory has to be planned after the renames below it."""
+    _query_file_types(rename_infos)
+    return RenamePlan(rename_infos, backend)
+
+
+def _query_file_types(rename_infos):
+    """Determine unknown file types of rename_infos with one batch of queries.
+
+    Runs a GLib main loop until all queries are answered. Types that can't
+    be queried stay unknown."""
+    unknown = [el for el in rename_infos if el.file_type == Gio.FileType.UNKNOWN]
+    if _file_system_lookups:
+        for el in unknown:
+            fs = _lookup_file_system(el.gfile.get_uri())
+            if fs is not None:
+                el.file_type = fs.query_file_type(el.gfile.get_uri())
+        unknown = [el for el in unknown if el.file_type == Gio.FileType.UNKNOWN]
+    if not unknown:
+        return
+
+    loop = GLib.MainLoop()
+    pending = [len(unknown)]
+
+    def query_info_async_cb(gfile, result, rename_info):
+        try:
+            rename_info.file_type = gfile.query_info_finish(result).get_file_type()
+        except RuntimeError as ee:
+            _logger.debug("Could not query file type of {0}: {1}".format(gfile.get_uri(), ee.message))
+        pending[0] -= 1
+        if pending[0] == 0:
+            loop.quit()
+
+    for el in unknown:
+        el.gfile.query_info_async(Gio.FILE_ATTRIBUTE_STANDARD_TYPE, Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS,
+                                  GLib.PRIORITY_DEFAULT, None, query_info_async_cb, el)
+    loop.run()
+
+
+def execute(rename_plan, max_in_flight=None, journal_dir=None, progress_callback=None):
+    """Carry out a RenamePlan, and return when it is done.
+
+    Runs a GLib main loop while renaming. Returns a (successes, errors) tuple
+    of lists of RenameSuccess and RenameError objects."""
+    if not rename_plan.rename_infos:
+        return [], []
+
+    loop = GLib.MainLoop()
+    results = []
+
+    def done_cb(successful_renames_list, errors_list):
+        successes = [el for layer in successful_renames_list for el in layer if not el.rename_info.temporary]
+        errors = [el for layer in errors_list for el in layer]
+        results.append((successes, errors))
+        loop.quit()
+
+    rename_plan.execute(done_cb, progress_callback, max_in_flight=max_in_flight, journal_dir=journal_dir)
+    if not results:
+        loop.run()
+    return results[0]
+
+
+class RunResults:
+    """Results of run()"""
+
+    def __init__(self, targets, check_results):
+        self.targets = targets
+        self.check_results = check_results
+        self.successes = []  # list of RenameSuccess
+        self.errors = []     # list of RenameError
+
+
+def run(entries, previewer=None, **kwargs):
+    """Preview, check and rename (directory, name, target) entries in one go.
+
+    If previewer is given, it replaces the targets of the entries, see
+    preview(). Nothing is renamed if the check finds errors. The backend
+    keyword argument is passed on to plan(), the others to execute().
+    Returns a RunResults object."""
+    if previewer is not None:
+        targets = preview([name for dirname, name, target in entries], previewer)
+        entries = [(dirname, name, target) for (dirname, name, old_target), target in zip(entries, targets)]
+    else:
+        targets = [target for dirname, name, target in entries]
+
+    dir_uris = {}
+    for dirname, name, target in entries:
+        if dirname not in dir_uris:
+            dir_uri = Gio.file_new_for_commandline_arg(dirname).get_uri()
+            dir_uris[dirname] = dir_uri if dir_uri.endswith("/") else dir_uri + "/"
+    results = RunResults(targets, check([(dir_uris[dirname], name, target) for dirname, name, target in entries]))
+    if results.check_results.highest_problem_level >= PROBLEM_LEVEL_ERROR:
+        return results
+
+    backend = kwargs.pop("backend", constants.RENAME_BACKEND_GIO)
+    results.successes, results.errors = execute(plan(get_rename_infos(entries), backend), **kwargs)
+    return results
+
+
+class RenameInfo:
+    """An object representing information about a rename operation."""
+
+    __slots__ = ("gfile", "old_display_name", "new_display_name", "row_number", "file_type",
+                 "temporary", "prerequisite", "exchange_with", "cycle")
+    
+    def __init__(self, gfile, old_display_name, new_display_name, row_number, file_type=Gio.FileType.UNKNOWN):
+        self.gfile = gfile
+        self.old_display_name = old_display_name
+        self.new_display_name = new_display_name
+        self.row_number = row_number
+        self.file_type = file_type
+
+        # set by the planner when breaking up circular renames
+        self.temporary = False      # rename to a temporary name, not reported as success
+        self.prerequisite = None    # RenameInfo that has to succeed before this one is attempted
+        self.exchange_with = None   # RenameInfo whose file is atomically swapped with this one
+        self.cycle = None           # temporary step of the broken up cycle this rename belongs to
+    
+    def __str__(self):
+        return "old/new: {0} - {1}, row {2}, gfile: {3}".format(self.old_display_name, self.new_display_name, self.row_number, self.gfile.get_uri())
+
+
+class RenameError:
+    __slots__ = ("rename_info", "error_msg")
+
+    def __init__(self, rename_info, error_msg):
+        self.rename_info = rename_info
+        self.error_msg = error_msg
+
+
+class RenameSuccess:
+    __slots__ = ("rename_info", "new_gfile")
+
+    def __init__(self, rename_info, new_gfile):
+        self.rename_info = rename_info
+        self.new_gfile = new_gfile
+    
+    def __str__(self):
+        return "new_gfile: {0}, {1}".format(self.new_gfile.get_uri(), str(self.rename_info))
+
+
+
+class _RenameGroup:
+    """The layers of renames on one mount, and the state of running them"""
+
+    def __init__(self, index, mount, layers):
+        self.index = index
+        self.mount = mount
+        self.layers = layers
+        self.task = None
+        self.layer = None
+        self.num_done = 0           # steps of finished and skipped layers
+        self.num_done_in_task = 0
+
+
+class RenameTaskManager:
+    def __init__(self, rename_list, max_in_flight=None, backend=constants.RENAME_BACKEND_GIO, journal_dir=None,
+                 groups=None):
+        """Renames on different mounts are run concurrently, one layer at a time
+        on each mount. max_in_flight applies to each mount.
+
+        If groups is given, it is the ready list of (mount, layers) tuples for
+        rename_list, as planned by RenamePlan, and replaces planning."""
+        self._planned_groups = groups
+        self._max_in_flight = max_in_flight
+        self._journal_dir = journal_dir
+        self._journal = None
+        self._backend = backend
+        self._task_class = _RENAME_TASK_CLASSES[backend]
+        self._rename_list = list(rename_list)
+        self._groups = []
+        self._num_running_groups = 0
+        self._num_pending_queries = 0
+        self._failed = set()        # RenameInfo objects of failed renames
+        self._started_cycles = set()  # successful temporary steps of broken up cycles
+        self._cycle_entries = {}    # temporary step of a broken up cycle : renames of the cycle
+        self._cancelled = False
+        self._finished = False
+        self._query_cancellable = None
+
+        self._done_cb = None
+        self._progress_cb = None
+        self._layer_cb = None
+        self._successful_renames_list = []
+        self._errors_list = []
+        # previous successful renames, by their current location
+        self._successes_trie = _PathTrie()
+
+        self._num_total = len(self._rename_list)
+    
+    
+    def start(self, done_callback, progress_callback=None, layer_callback=None):
+        """Start renaming.
+
+        layer_callback is called after each layer with the successes and
+        errors of the layer, and the earlier successes whose new uri changed
+        because a directory above them got renamed."""
+        assert self._rename_list
+
+        self._done_cb = done_callback
+        self._progress_cb = progress_callback
+        self._layer_cb = layer_callback
+
+        # file types are usually known from the files model already,
+        # query the remaining ones all at once before planning
+        if self._planned_groups is None:
+            unknown = [el for el in self._rename_list if el.file_type == Gio.FileType.UNKNOWN]
+        else:
+            unknown = []
+        if _file_system_lookups:
+            for el in unknown:
+                fs = _lookup_file_system(el.gfile.get_uri())
+                if fs is not None:
+                    el.file_type = fs.query_file_type(el.gfile.get_uri())
+            unknown = [el for el in unknown if el.file_type == Gio.FileType.UNKNOWN]
+        if not unknown:
+            self._start_tasks()
+            return
+        self._num_pending_queries = len(unknown)
+        self._query_cancellable = Gio.Cancellable()
+        for el in unknown:
+            el.gfile.query_info_async(Gio.FILE_ATTRIBUTE_STANDARD_TYPE, Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS,
+                                      GLib.PRIORITY_DEFAULT, self._query_cancellable, self._query_info_async_cb, el)
+    
+    
+    def cancel(self):
+        """Stop renaming.
+
+        The current layers are cancelled, and no further layers are started.
+        Only cycles whose temporary step is done are still completed, such that
+        no file is left behind under a temporary name."""
+        if self._cancelled or self._finished:
+            return
+        self._cancelled = True
+        if self._num_pending_queries:
+            self._query_cancellable.cancel()
+        else:
+            for group in self._groups:
+                if group.task is not None:
+                    group.task.cancel()
+    
+    
+    def _query_info_async_cb(self, gfile, result, rename_info):
+        try:
+            rename_info.file_type = gfile.query_info_finish(result).get_file_type()
+        except RuntimeError as ee:
+            # stays unknown, and is treated like a regular file
+            _logger.debug("Could not query file type of {0}: {1}".format(gfile.get_uri(), ee.message))
+        self._num_pending_queries -= 1
+        if self._num_pending_queries == 0:
+            if self._cancelled:
+                self._finish()
+            else:
+                self._start_tasks()
+
+
+    def _start_tasks(self):
+        if self._planned_groups is None:
+            groups = _create_rename_groups(self._rename_list, self._backend)
+        else:
+            groups = self._planned_groups
+        self._groups = [_RenameGroup(ii, mount, list(layers)) for ii, (mount, layers) in enumerate(groups)]
+        self._num_total = sum(len(layer) for group in self._groups for layer in group.layers)
+        for el in self._rename_list:
+            if el.cycle is not None:
+                self._cycle_entries.setdefault(el.cycle, []).append(el)
+        if self._journal_dir is not None:
+            try:
+                self._journal = journal.RenameJournal(self._journal_dir)
+            except OSError as ee:
+                _logger.warning("Could not create rename journal: {0}".format(ee.strerror))
+        self._num_running_groups = len(self._groups)
+        for group in self._groups:
+            self._start_next_task(group)
+
+
+    def _start_next_task(self, group):
+        """Start the next non-empty layer of group, or finish the group"""
+        while True:
+            if not group.layers:
+                self._num_running_groups -= 1
+                if self._num_running_groups == 0:
+                    self._finish()
+                return
+            layer = group.layers.pop(0)
+            num_planned = len(layer)
+            # don't attempt renames whose preparing rename failed
+            if self._failed:
+                layer = self._skip_failed_cycles(layer)
+            if self._cancelled:
+                layer = [el for el in layer if el.cycle in self._started_cycles]
+            group.num_done += num_planned - len(layer)
+            if layer:
+                break
+
+        if self._journal is not None:
+            self._journal.begin_layer([_describe_step(el) for el in layer], group.index)
+        group.layer = layer
+        group.task = self._task_class(layer, self._max_in_flight)
+        group.task.start(functools.partial(self._task_done_cb, group), functools.partial(self._task_progress_cb, group))
+        
+
+    def _skip_failed_cycles(self, layer):
+        """Returns layer without the renames of cycles whose temporary step failed.
+
+        The rename back from the temporary name was already reported with the
+        error of the temporary step, the other renames of the cycle get an
+        error of their own."""
+        remaining = []
+        errors = []
+        for el in layer:
+            if el.prerequisite is not None and el.prerequisite in self._failed:
+                continue
+            if el.cycle is not None and el.cycle in self._failed:
+                errors.append(RenameError(el, _("Not renamed, because the circular renaming could not be started")))
+                continue
+            remaining.append(el)
+        if errors:
+            self._failed.update(el.rename_info for el in errors)
+            self._errors_list.append(errors)
+            if self._layer_cb is not None:
+                self._layer_cb([], errors, [])
+        return remaining
+
+
+    def _report_temporary_errors(self, errors):
+        """Returns errors with the errors of temporary steps reported against the
+        rename of the cycle that they belong to, with its user-visible target name"""
+        reported = []
+        for el in errors:
+            if el.rename_info.temporary:
+                # cycles are broken up at their first rename
+                rename_info = self._cycle_entries[el.rename_info][0]
+                error_msg = el.error_msg.replace(el.rename_info.new_display_name, rename_info.new_display_name)
+                el = RenameError(rename_info, error_msg)
+            reported.append(el)
+        return reported
+
+
+    def _task_progress_cb(self, group, num_done, num_total):
+        group.num_done_in_task = num_done
+        if self._progress_cb is not None:
+            self._progress_cb(sum(el.num_done + el.num_done_in_task for el in self._groups), self._num_total)
+
+
+    def _task_done_cb(self, group, successful_renames, errors):
+        group.num_done += len(group.task)
+        group.num_done_in_task = 0
+        self._failed.update(el.rename_info for el in errors)
+        self._started_cycles.update(el.rename_info for el in successful_renames if el.rename_info.temporary)
+        if self._cancelled:
+            # cycle steps of the cancelled layer that were skipped still have to happen
+            handled = {id(el.rename_info) for el in successful_renames}
+            handled.update(id(el.rename_info) for el in errors)
+            skipped = [el for el in group.layer if id(el) not in handled and el.cycle is not None]
+            if skipped:
+                group.num_done -= len(skipped)
+                group.layers.insert(0, skipped)
+
+        # successful renames
+        # move previous renames that are located below a renamed directory.
+        # Detach everything first, as swapped directories move into each other's place.
+        relocated = []
+        detached = [(success, self._detach_previous_successes(success, relocated)) for success in successful_renames]
+        for success, subtree in detached:
+            if subtree is not None:
+                self._successes_trie.graft(success.new_gfile.get_uri(), subtree)
+        for success in successful_renames:
+            self._successes_trie.insert(success.new_gfile.get_uri(), success)
+        errors = self._report_temporary_errors(errors)
+        self._successful_renames_list.append(successful_renames)
+        self._errors_list.append(errors)
+
+        if self._journal is not None:
+            self._journal_layer_outcome(group, successful_renames)
+        if self._layer_cb is not None:
+            self._layer_cb(successful_renames, errors, relocated)
+
+        group.task = None
+        group.layer = None
+        self._start_next_task(group)
+
+
+    def _finish(self):
+        self._finished = True
+        # listings of the renamed directories are outdated now
+        _directory_cache.clear()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self._done_cb is not None:
+            self._done_cb(self._successful_renames_list, self._errors_list)
+
+
+    def _journal_layer_outcome(self, group, successful_renames):
+        # steps that failed or were skipped; exchange partners are recorded with the exchange step itself
+        succeeded = {id(el.rename_info) for el in successful_renames}
+        self._journal.end_layer([ii for ii, el in enumerate(group.layer) if id(el) not in succeeded], group.index)
+
+
+    def _detach_previous_successes(self, success, relocated):
+        """Switch the new uris of previous renames below success' old location to its new location,
+        and append them to relocated.
+
+        Returns the detached subtree of previous renames that has to be grafted
+        at the new location, or None."""
+        old_dir_uri = success.rename_info.gfile.get_uri()
+        subtree = self._successes_trie.pop(old_dir_uri)
+        if subtree is None:
+            return None
+
+        # previous renames to exactly that uri are not below the renamed directory
+        own_items = subtree.items
+        subtree.items = []
+
+        for old_success in _PathTrie.iter_items(subtree):
+            old_uri = old_success.new_gfile.get_uri()
+            rel_path = success.rename_info.gfile.get_relative_path(old_success.new_gfile)
+            old_success.new_gfile = success.new_gfile.resolve_relative_path(rel_path)
+            relocated.append(old_success)
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug("Prefix {0} got renamed; switched new uri from {1} to {2}"
+                              .format(old_dir_uri, old_uri, old_success.new_gfile.get_uri()))
+
+        for item in own_items:
+            self._successes_trie.insert(old_dir_uri, item)
+        return subtree
+
+
+def _create_rename_groups(rename_list, backend):
+    """Returns a list of (mount, layers) tuples.
+
+    Renames on different mounts don't depend on each other, so each mount
+    gets its own layers. If a renamed directory contains the mount point of
+    another group, everything is planned as a single group with mount None."""
+    by_mount = {}
+    for el, mount in zip(rename_list, _get_mount_keys(rename_list)):
+        by_mount.setdefault(mount, []).append(el)
+    if len(by_mount) > 1 and _contains_other_mount(by_mount):
+        by_mount = {None : list(rename_list)}
+    return [(mount, _create_rename_layers(infos, backend)) for mount, infos in by_mount.items()]
+
+
+def _contains_other_mount(by_mount):
+    local_mounts = [mount for mount in by_mount if mount.startswith("/")]
+    for mount, infos in by_mount.items():
+        for el in infos:
+            if el.file_type != Gio.FileType.DIRECTORY:
+                continue
+            path = el.gfile.get_path()
+            if path is None:
+                continue
+            prefix = path.rstrip("/") + "/"
+            if any(other != mount and (other == path or other.startswith(prefix)) for other in local_mounts):
+                return True
+    return False
+
+
+def _create_rename_layers(rename_list, backend):
+    # Create layers of renames which, when executed in order, don't pose
+    # problems to the rename process (for example, don't rename a folder
+    # and then a file in that folder, because the path of that file wouldn't
+    # exist anymore by then.
+    def can_exchange(rename_info_a, rename_info_b):
+        if backend in _EXCHANGE_CHECKS:
+            return _EXCHANGE_CHECKS[backend](rename_info_a, rename_info_b)
+        return (backend in (constants.RENAME_BACKEND_POSIX, constants.RENAME_BACKEND_IO_URING)
+                and syscalls.have_renameat2 and _is_local(rename_info_a.gfile) and _is_local(rename_info_b.gfile))
+    return _plan_rename_layers(list(rename_list), "gbr-%010d--" % os.getpid(), can_exchange)
+
+
+def _describe_step(rename_info):
+    """A [kind, uri, new display name] list, as used by the journal"""
+    kind = journal.STEP_RENAME if rename_info.exchange_with is None else journal.STEP_EXCHANGE
+    return [kind, rename_info.gfile.get_uri(), rename_info.new_display_name]
+
+
+def _get_mount_points():
+    """Returns the list of mount point paths, longest first"""
+    mount_points = []
+    try:
+        with open("/proc/self/mounts", "rb") as ff:
+            for line in ff:
+                fields = line.split()
+                if len(fields) > 1:
+                    # blanks in mount points are escaped as octal numbers
+                    mount_points.append(fields[1].decode("unicode_escape").encode("latin-1"))
+    except OSError:
+        pass
+    mount_points.sort(key=len, reverse=True)
+    return mount_points
+
+
+def _find_mount_point(path, mount_points):
+    """Returns the mount point of path, as a string"""
+    if isinstance(path, str):
+        path = os.fsencode(path)
+    for mount_point in mount_points:
+        prefix = mount_point.rstrip(b"/") + b"/"
+        if path == mount_point or path.startswith(prefix):
+            if mount_point.endswith(b"/gvfs") and path != mount_point:
+                # a single fuse mount holds all gvfs shares, each share is a mount of its own
+                return os.fsdecode(prefix + path[len(prefix):].split(b"/")[0])
+            return os.fsdecode(mount_point)
+    return "/"
+
+
+def _get_mount_keys(rename_infos):
+    """Returns the list of mounts of rename_infos, see RenamePlan.get_mount_counts()"""
+    mounts_by_dir = {}
+    mount_points = None
+    keys = []
+    for el in rename_infos:
+        dir_uri = el.gfile.get_uri().rpartition("/")[0]
+        try:
+            mount = mounts_by_dir[dir_uri]
+        except KeyError:
+            if dir_uri.startswith("file://"):
+                if mount_points is None:
+                    mount_points = _get_mount_points()
+                mount = _find_mount_point(GLib.filename_from_uri(dir_uri + "/")[0], mount_points)
+            else:
+                scheme, sep, rest = dir_uri.partition("://")
+                mount = scheme + sep + rest.partition("/")[0]
+            mounts_by_dir[dir_uri] = mount
+        keys.append(mount)
+    return keys
+
+
+def _split_uri(uri):
+    """Split an uri into its path components, ignoring a trailing slash"""
+    if uri.endswith("/"):
+        uri = uri[:-1]
+    return uri.split("/")
+
+
+class _PathTrieNode:
+    __slots__ = ("children", "items")
+
+    def __init__(self):
+        self.children = {}
+        self.items = []
+
+
+class _PathTrie:
+    """A trie of uris, split at path components. Each node can hold a list of items."""
+
+    def __init__(self):
+        self.root = _PathTrieNode()
+
+
+    def insert(self, uri, item):
+        node = self.root
+        for component in _split_uri(uri):
+            try:
+                node = node.children[component]
+            except KeyError:
+                child = _PathTrieNode()
+                node.children[component] = child
+                node = child
+        node.items.append(item)
+        return node
+
+
+    def pop(self, uri):
+        """Detach and return the subtree at uri, or None if there is no such node"""
+        components = _split_uri(uri)
+        node = self.root
+        for component in components[:-1]:
+            node = node.children.get(component)
+            if node is None:
+                return None
+        return node.children.pop(components[-1], None)
+
+
+    def graft(self, uri, subtree):
+        """Attach subtree at uri, merging it with an already existing node"""
+        components = _split_uri(uri)
+        node = self.root
+        for component in components[:-1]:
+            try:
+                node = node.children[component]
+            except KeyError:
+                child = _PathTrieNode()
+                node.children[component] = child
+                node = child
+
+        stack = [(node, components[-1], subtree)]
+        while stack:
+            parent, component, src = stack.pop()
+            dst = parent.children.get(component)
+            if dst is None:
+                parent.children[component] = src
+            else:
+                dst.items.extend(src.items)
+                stack.extend((dst, key, child) for key, child in src.children.items())
+
+
+    @staticmethod
+    def iter_items(subtree):
+        """Iterate over all items in subtree"""
+        stack = [subtree]
+        while stack:
+            node = stack.pop()
+            yield from node.items
+            stack.extend(node.children.values())
+
+
+    def iter_nodes_postorder(self):
+        """Iterate over all nodes, children before their parents"""
+        stack = [(self.root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if children_done:
+                yield node
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children.values())
+
+
+def _get_rename_layers(rename_list, is_directory):
+    """Partition rename_list into layers that can be executed one after another.
+
+    The first layer holds all non-directories. Then come the directories,
+    deepest first: a directory only appears in a layer after every other
+    directory below it. Within a layer, the order of rename_list is kept.
+    is_directory is a sequence of booleans parallel to rename_list."""
+    # the layer of a directory is the height of its subtree of directories to rename
+    trie = _PathTrie()
+    for ii, el in enumerate(rename_list):
+        if is_directory[ii]:
+            trie.insert(el.gfile.get_uri(), ii)
+
+    level = [0] * len(rename_list)
+    height_below = {}
+    for node in trie.iter_nodes_postorder():
+        # highest layer among the directories below this node, -1 if there are none
+        below = -1
+        for child in node.children.values():
+            below = max(below, height_below.pop(child))
+        if node.items:
+            below += 1
+            for ii in node.items:
+                level[ii] = below + 1
+        height_below[node] = below
+
+    num_layers = max(level, default=-1) + 1
+    layers = [[] for ii in range(num_layers)]
+    for ii, el in enumerate(rename_list):
+        layers[level[ii]].append(el)
+    return [layer for layer in layers if layer]
+
+
+def _strongly_connected_components(nodes, successors):
+    """Tarjan's algorithm, without recursion. successors maps a node to a list of nodes.
+
+    Returns the list of components, each a list of nodes."""
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    for root in nodes:
+        if root in index:
+            continue
+        work = [(root, iter(successors.get(root, ())))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors.get(child, ()))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member is node:
+                            break
+                    components.append(component)
+    return components
+
+
+def _plan_rename_layers(rename_list, tmp_prefix, can_exchange):
+    """Like _get_rename_layers, but resolves renames onto names that are renamed themselves.
+
+    The renames form a graph with an edge from each entry to the entry whose
+    current name it takes. Chains (a->b, b->c) are ordered topologically, such
+    that b->c is done before a->b. Strongly connected components of that graph
+    are the cycles. A cycle of two entries that can_exchange(a, b) accepts is
+    done as one atomic exchange. Every other cycle is broken up by renaming one
+    of its entries to a name with tmp_prefix first. All remaining entries are
+    renamed only once."""
+    order = {el : ii for ii, el in enumerate(rename_list)}
+    # renames are matched by (directory uri, display name) keys, like the checks do,
+    # which saves creating a GFile for every target
+    source_uri = {el : el.gfile.get_uri() for el in rename_list}
+    source_key = {}
+    target_key = {}
+    for el in rename_list:
+        dir_uri = source_uri[el].rpartition("/")[0]
+        source_key[el] = (dir_uri, el.old_display_name)
+        target_key[el] = (dir_uri, el.new_display_name)
+    by_source_key = {source_key[el] : el for el in rename_list}
+    successors = {}
+    for el in rename_list:
+        next_el = by_source_key.get(target_key[el])
+        if next_el is not None and next_el is not el:
+            successors[el] = [next_el]
+
+    # nothing renamed onto another entry's name: plain layering does
+    if not successors:
+        return _get_rename_layers(rename_list, [el.file_type == Gio.FileType.DIRECTORY for el in rename_list])
+
+    # resolve cycles
+    replacements = {}
+    for cycle in _strongly_connected_components(list(successors), successors):
+        if len(cycle) < 2:
+            continue
+        if len(cycle) == 2 and can_exchange(*cycle):
+            first, second = sorted(cycle, key=order.get)
+            first.exchange_with = second
+            replacements[second] = []
+        else:
+            breaker = min(cycle, key=order.get)
+            tmp_step = RenameInfo(breaker.gfile, breaker.old_display_name, tmp_prefix + breaker.new_display_name,
+                                   breaker.row_number, breaker.file_type)
+            tmp_step.temporary = True
+            final_step = RenameInfo(breaker.gfile.get_parent().get_child_for_display_name(tmp_step.new_display_name),
+                                     breaker.old_display_name, breaker.new_display_name, breaker.row_number, breaker.file_type)
+            final_step.prerequisite = tmp_step
+            final_step.cycle = tmp_step
+            for el in cycle:
+                el.cycle = tmp_step
+            replacements[breaker] = [tmp_step, final_step]
+            source_uri[tmp_step] = source_uri[breaker]
+            source_key[tmp_step] = source_key[breaker]
+            source_uri[final_step] = final_step.gfile.get_uri()
+            source_key[final_step] = (source_key[breaker][0], tmp_step.new_display_name)
+            target_key[tmp_step] = None
+            target_key[final_step] = target_key[breaker]
+            order[tmp_step] = order[final_step] = order[breaker]
+    steps = []
+    for el in rename_list:
+        steps.extend(replacements.get(el, (el,)))
+
+    def is_directory(step):
+        return (step.file_type == Gio.FileType.DIRECTORY or
+                (step.exchange_with is not None and step.exchange_with.file_type == Gio.FileType.DIRECTORY))
+
+    # dependencies: a step waits for the step that vacates its target...
+    vacating_step = {}
+    trie = _PathTrie()
+    for step in steps:
+        if step.prerequisite is None:
+            for el in (step, step.exchange_with):
+                if el is not None:
+                    vacating_step[source_key[el]] = step
+                    trie.insert(source_uri[el], (step, el.file_type == Gio.FileType.DIRECTORY))
+    deps = {step : [] for step in steps}
+    for step in steps:
+        other = vacating_step.get(target_key[step])
+        if other is not None and other is not step:
+            deps[step].append(other)
+        if step.prerequisite is not None:
+            deps[step].append(step.prerequisite)
+
+    # ...and a directory waits for all steps below it
+    enclosing_step = {}
+    stack = [(trie.root, None)]
+    while stack:
+        node, enclosing = stack.pop()
+        for step, is_dir in node.items:
+            enclosing_step[step] = enclosing
+            if enclosing is not None:
+                deps[enclosing].append(step)
+            if is_dir:
+                enclosing = step
+        stack.extend((child, enclosing) for child in node.children.values())
+    for step in steps:
+        enclosing = enclosing_step.get(step.prerequisite)
+        if enclosing is not None:
+            deps[enclosing].append(step)
+
+    # longest path layering; as in _get_rename_layers, directories never share the first layer with files
+    dependents = {step : [] for step in steps}
+    num_open_deps = {}
+    for step, step_deps in deps.items():
+        num_open_deps[step] = len(step_deps)
+        for dep in step_deps:
+            dependents[dep].append(step)
+    level = {step : (1 if is_directory(step) else 0) for step in steps}
+    ready = [step for step in steps if num_open_deps[step] == 0]
+    while ready:
+        step = ready.pop()
+        for dependent in dependents[step]:
+            level[dependent] = max(level[dependent], level[step] + 1)
+            num_open_deps[dependent] -= 1
+            if num_open_deps[dependent] == 0:
+                ready.append(dependent)
+    assert not any(num_open_deps.values()), "Unresolved circular dependency in rename plan"
+
+    layers = [[] for ii in range(max(level.values(), default=-1) + 1)]
+    for step in sorted(steps, key=order.get):
+        layers[level[step]].append(step)
+    return [layer for layer in layers if layer]
+
+
+class _RenameWindow:
+    """Number of renames that may be in flight at the same time.
+
+    The window adapts to the observed completion latency: as long as renames
+    complete about as fast as the fastest ones seen so far, the window grows.
+    If latency goes up because the backend (thread pool, network share) is
+    saturated, the window shrinks accordingly."""
+
+    def __init__(self, fixed_size=None):
+        if fixed_size is not None:
+            self.size = max(1, fixed_size)
+        else:
+            self.size = constants.RENAME_IN_FLIGHT_INITIAL
+        self._adaptive = fixed_size is None
+        self._min_latency = None
+        self._avg_latency = None
+
+
+    def update(self, latency):
+        """Register a completed rename that took latency seconds"""
+        if not self._adaptive:
+            return
+
+        # avoid division by zero for very fast completions
+        latency = max(latency, 1e-6)
+        if self._min_latency is None:
+            self._min_latency = self._avg_latency = latency
+        else:
+            self._min_latency = min(self._min_latency, latency)
+            self._avg_latency = 0.9*self._avg_latency + 0.1*latency
+
+        # gradient is 1 when there is no queueing, and goes towards 0 otherwise
+        gradient = self._min_latency / self._avg_latency
+        target = self.size*gradient + math.sqrt(self.size)
+        size = 0.8*self.size + 0.2*target
+        self.size = int(min(constants.RENAME_IN_FLIGHT_MAX, max(constants.RENAME_IN_FLIGHT_MIN, round(size))))
+
+
+class _RenameTask:
+    def __init__(self, task, max_in_flight=None):
+        """task is a list of RenameInfo objects"""
+        self._task = task
+        self._done_cb = None
+        self._progress_cb = None
+
+        self._errors = []             # list of RenameError entries
+        self._successful_renames = [] # list of RenameSuccess entries
+        self._in_flight = {}          # uri -> start time
+        self._window = _RenameWindow(max_in_flight)
+        self._next_index = 0
+        self._cancelled = False
+    
+    
+    def __len__(self):
+        return len(self._task)
+
+
+    def start(self, done_callback, progress_callback=None):
+        """Start rename task"""
+        self._done_cb = done_callback
+        self._progress_cb = progress_callback
+        if not self._task:
+            self._notify_done()
+            return
+        self._fill_window()
+
+
+    def cancel(self):
+        """Cancel ongoing rename task. Renames that didn't start yet are skipped.
+        Those in flight are not cancelled, since GIO may report a rename that
+        already happened on disk as cancelled; they are waited for instead."""
+        self._cancelled = True
+        if not self._in_flight:
+            self._notify_done()
+
+
+    def _fill_window(self):
+        """Start renames until the window is full or no renames are left"""
+        while self._next_index < len(self._task) and len(self._in_flight) < self._window.size:
+            el = self._task[self._next_index]
+            self._next_index += 1
+            self._in_flight[el.gfile.get_uri()] = time.monotonic()
+            el.gfile.set_display_name_async(el.new_display_name, GLib.PRIORITY_DEFAULT, None,
+                                            self._set_display_name_async_cb, el)
+
+
+    def _set_display_name_async_cb(self, gfile, result, rename_info):
+        try:
+            new_gfile = rename_info.gfile.set_display_name_finish(result)
+        except RuntimeError as ee:
+            self._errors.append(RenameError(rename_info, ee.message))
+        else:
+            self._successful_renames.append(RenameSuccess(rename_info, new_gfile))
+        finally:
+            start_time = self._in_flight.pop(rename_info.gfile.get_uri())
+            self._window.update(time.monotonic() - start_time)
+
+            num_done = len(self._successful_renames) + len(self._errors)
+            if self._progress_cb is not None:
+                self._progress_cb(num_done, len(self._task))
+
+            # notify if that was the last rename, otherwise refill the window
+            if self._cancelled:
+                if not self._in_flight:
+                    self._notify_done()
+            elif num_done == len(self._task):
+                self._notify_done()
+            else:
+                self._fill_window()
+
+
+    def _notify_done(self):
+        if self._done_cb is not None:
+            self._done_cb(self._successful_renames, self._errors)
+
+
+def _is_local(gfile):
+    return gfile.has_uri_scheme("file") and gfile.get_path() is not None
+
+
+class _LocalRenameTask:
+    """Base class for tasks that rename local files without GIO's async machinery.
+
+    Subclasses implement _start_local(), and call _local_rename_done() for each
+    processed entry. Entries that _is_handled() refuses, by default those that
+    are not local files, are passed on to a GIO _RenameTask."""
+
+    def __init__(self, task, max_in_flight=None):
+        self._task = task
+        self._max_in_flight = max_in_flight
+        self._done_cb = None
+        self._progress_cb = None
+
+        self._errors = []             # list of RenameError entries
+        self._successful_renames = [] # list of RenameSuccess entries
+        self._num_local = 0
+        self._num_done_local = 0
+        self._num_done_remote = 0
+        self._remote_task = None
+        self._cancelled = False
+
+
+    def __len__(self):
+        return len(self._task)
+
+
+    def start(self, done_callback, progress_callback=None):
+        """Start rename task"""
+        self._done_cb = done_callback
+        self._progress_cb = progress_callback
+
+        local = []
+        remote = []
+        for el in self._task:
+            if self._is_handled(el.gfile):
+                local.append(el)
+            else:
+                remote.append(el)
+
+        self._num_local = len(local)
+        if remote:
+            self._remote_task = _RenameTask(remote, self._max_in_flight)
+            self._remote_task.start(self._remote_done_cb, self._remote_progress_cb)
+        if local:
+            self._start_local(local)
+        elif not remote:
+            self._notify_if_done()
+
+
+    def cancel(self):
+        """Cancel ongoing rename task. Subclasses stop renaming local files, and skip the rest."""
+        self._cancelled = True
+        if self._remote_task is not None:
+            self._remote_task.cancel()
+
+
+    def _start_local(self, entries):
+        raise NotImplementedError
+
+
+    @staticmethod
+    def _is_handled(gfile):
+        return _is_local(gfile)
+
+
+    def _add_local_result(self, rename_info, new_gfile, error_msg=None):
+        if error_msg is None:
+            self._successful_renames.append(RenameSuccess(rename_info, new_gfile))
+        else:
+            self._errors.append(RenameError(rename_info, error_msg))
+
+
+    def _local_rename_done(self, rename_info, new_gfile, error_msg=None):
+        """Register the result of a local entry, and finish if it was the last one"""
+        self._add_local_result(rename_info, new_gfile, error_msg)
+        self._local_step_done()
+
+
+    def _local_step_done(self):
+        self._num_done_local += 1
+        self._report_progress()
+        self._notify_if_done()
+
+
+    def _remote_progress_cb(self, num_done, num_total):
+        self._num_done_remote = num_done
+        self._report_progress()
+
+
+    def _remote_done_cb(self, successful_renames, errors):
+        self._successful_renames.extend(successful_renames)
+        self._errors.extend(errors)
+        self._remote_task = None
+        self._notify_if_done()
+
+
+    def _report_progress(self):
+        if self._progress_cb is not None:
+            self._progress_cb(self._num_done_local + self._num_done_remote, len(self._task))
+
+
+    def _notify_if_done(self):
+        if self._remote_task is None and self._num_done_local == self._num_local and self._done_cb is not None:
+            self._done_cb(self._successful_renames, self._errors)
+
+
+def _get_local_rename_target(rename_info):
+    """Returns a (directory path, old name, new name, new gfile) tuple for a local rename.
+
+    The new name is obtained from GIO, so that the filename encoding matches
+    what set_display_name would use. Raises RuntimeError for invalid names."""
+    new_gfile = rename_info.gfile.get_parent().get_child_for_display_name(rename_info.new_display_name)
+    dirname, old_name = os.path.split(rename_info.gfile.get_path())
+    return dirname, old_name, os.path.basename(new_gfile.get_path()), new_gfile
+
+
+class _PosixRenamer:
+    """Renames local files with renameat, relative to a file descriptor of their directory.
+
+    Keeps the directory of the previous rename open, so feed it entries sorted
+    by directory. Doesn't touch the main loop, and can be used from any thread."""
+
+    def __init__(self):
+        self._dir_path = None
+        self._dir_fd = None
+        self._dir_error = None
+
+
+    def rename(self, rename_info):
+        """Rename one entry. Returns a list of (rename_info, new_gfile, error_msg) results,
+        which has two elements for exchanges."""
+        try:
+            dirname, old_name, new_name, new_gfile = _get_local_rename_target(rename_info)
+        except RuntimeError as ee:
+            return self._failed(rename_info, ee.message)
+
+        if dirname != self._dir_path:
+            self.close()
+            self._dir_path = dirname
+            try:
+                self._dir_fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+            except OSError as ee:
+                self._dir_error = ee.strerror
+        if self._dir_fd is None:
+            return self._failed(rename_info, self._dir_error)
+
+        try:
+            if rename_info.exchange_with is not None:
+                self._exchange(old_name, new_name)
+            else:
+                self._rename_noreplace(old_name, new_name)
+        except OSError as ee:
+            return self._failed(rename_info, ee.strerror)
+
+        results = [(rename_info, new_gfile, None)]
+        if rename_info.exchange_with is not None:
+            results.append((rename_info.exchange_with, rename_info.gfile, None))
+        return results
+
+
+    def rename_batch(self, entries, ring):
+        """Rename entries with a single submission to the syscalls.IoUring ring.
+
+        Returns a list with the results of each entry, like rename()."""
+        entry_results = [None] * len(entries)
+        ops = []
+        submitted = []  # (index, rename info, new gfile) of each op
+        old_inodes = [] # inode at the old name of each exchange op
+        dir_fds = {}    # directory -> file descriptor, or error message
+        try:
+            for ii, el in enumerate(entries):
+                try:
+                    dirname, old_name, new_name, new_gfile = _get_local_rename_target(el)
+                except RuntimeError as ee:
+                    entry_results[ii] = self._failed(el, ee.message)
+                    continue
+                if new_name == old_name and el.exchange_with is None:
+                    entry_results[ii] = [(el, new_gfile, None)]
+                    continue
+                try:
+                    dir_fd = dir_fds[dirname]
+                except KeyError:
+                    try:
+                        dir_fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+                    except OSError as ee:
+                        dir_fd = ee.strerror
+                    dir_fds[dirname] = dir_fd
+                if isinstance(dir_fd, str):
+                    entry_results[ii] = self._failed(el, dir_fd)
+                    continue
+                flags = syscalls.RENAME_EXCHANGE if el.exchange_with is not None else syscalls.RENAME_NOREPLACE
+                ops.append((dir_fd, os.fsencode(old_name), dir_fd, os.fsencode(new_name), flags))
+                submitted.append((ii, el, new_gfile))
+                # to tell whether an exchange happened, should the submission fail
+                old_inodes.append(self._get_inode(dir_fd, old_name) if el.exchange_with is not None else None)
+            try:
+                errnos = ring.renameat_batch(ops)
+            except OSError as ee:
+                # some of the renames may have happened; the others are done with renameat
+                _discard_io_uring(ring, ee)
+                errnos = [self._get_outcome(op, old_inode) for op, old_inode in zip(ops, old_inodes)]
+        finally:
+            for dir_fd in dir_fds.values():
+                if not isinstance(dir_fd, str):
+                    os.close(dir_fd)
+
+        for (ii, el, new_gfile), err in zip(submitted, errnos):
+            if err == 0:
+                entry_results[ii] = [(el, new_gfile, None)]
+                if el.exchange_with is not None:
+                    entry_results[ii].append((el.exchange_with, el.gfile, None))
+            elif err is None or err == errno.EINVAL:
+                # not known to have happened, or the file system doesn't support the rename flags
+                entry_results[ii] = self.rename(el)
+            else:
+                entry_results[ii] = self._failed(el, os.strerror(err))
+        return entry_results
+
+
+    def close(self):
+        if self._dir_fd is not None:
+            os.close(self._dir_fd)
+        self._dir_path = None
+        self._dir_fd = None
+        self._dir_error = None
+
+
+    @classmethod
+    def _get_outcome(cls, op, old_inode):
+        """0 if the rename op of a failed submission evidently happened, None otherwise"""
+        dir_fd, old_name, new_dir_fd, new_name, flags = op
+        if flags == syscalls.RENAME_EXCHANGE:
+            # both names exist either way, but the file at the old name changed
+            inode = cls._get_inode(dir_fd, old_name)
+            return 0 if None not in (inode, old_inode) and inode != old_inode else None
+        if cls._get_inode(dir_fd, old_name) is None and cls._get_inode(new_dir_fd, new_name) is not None:
+            return 0
+        return None
+
+
+    @staticmethod
+    def _get_inode(dir_fd, name):
+        try:
+            return os.stat(name, dir_fd=dir_fd, follow_symlinks=False).st_ino
+        except OSError:
+            return None
+
+
+    @staticmethod
+    def _failed(rename_info, error_msg):
+        """The entry failed; for an exchange, both sides did"""
+        results = [(rename_info, None, error_msg)]
+        if rename_info.exchange_with is not None:
+            results.append((rename_info.exchange_with, None, error_msg))
+        return results
+
+
+    def _rename_noreplace(self, old_name, new_name):
+        """Like set_display_name, never replace an existing file"""
+        if syscalls.have_renameat2 and new_name != old_name:
+            try:
+                syscalls.renameat2(self._dir_fd, old_name, self._dir_fd, new_name, syscalls.RENAME_NOREPLACE)
+            except OSError as ee:
+                # not supported by the file system, do it by hand
+                if ee.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+            else:
+                return
+
+        if new_name != old_name:
+            try:
+                os.lstat(new_name, dir_fd=self._dir_fd)
+            except FileNotFoundError:
+                pass
+            else:
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST))
+        os.rename(old_name, new_name, src_dir_fd=self._dir_fd, dst_dir_fd=self._dir_fd)
+
+
+    def _exchange(self, old_name, new_name):
+        """Swap the files old_name and new_name"""
+        try:
+            syscalls.renameat2(self._dir_fd, old_name, self._dir_fd, new_name, syscalls.RENAME_EXCHANGE)
+        except OSError as ee:
+            if ee.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            # not supported by the file system, swap through a temporary name
+            tmp_name = "gbr-%010d--" % os.getpid() + old_name
+            self._rename_noreplace(old_name, tmp_name)
+            try:
+                self._rename_noreplace(new_name, old_name)
+            except OSError:
+                os.rename(tmp_name, old_name, src_dir_fd=self._dir_fd, dst_dir_fd=self._dir_fd)
+                raise
+            self._rename_noreplace(tmp_name, new_name)
+
+
+def _sorted_by_directory(entries):
+    return sorted(entries, key=lambda el : os.path.dirname(el.gfile.get_path()))
+
+
+class _PosixRenameTask(_LocalRenameTask):
+    """Renames local files with a _PosixRenamer.
+
+    Each directory is opened once per task. The work is split into chunks that
+    run from idle callbacks, so that the main loop stays responsive."""
+
+    _CHUNK_SIZE = 256
+
+    def _start_local(self, entries):
+        self._local_entries = _sorted_by_directory(entries)
+        self._local_index = 0
+        self._renamer = _PosixRenamer()
+        GLib.idle_add(self._rename_chunk)
+
+
+    def _rename_chunk(self):
+        if self._cancelled:
+            self._renamer.close()
+            self._num_local = self._num_done_local
+            self._notify_if_done()
+            return False
+
+        end = min(self._local_index + self._CHUNK_SIZE, len(self._local_entries))
+        while self._local_index < end:
+            el = self._local_entries[self._local_index]
+            self._local_index += 1
+            for result in self._renamer.rename(el):
+                self._add_local_result(*result)
+            self._local_step_done()
+
+        if self._local_index < len(self._local_entries):
+            return True
+        self._renamer.close()
+        return False
+
+
+_io_uring = None
+_io_uring_error = None
+
+def _get_io_uring():
+    """The shared syscalls.IoUring of the main loop, or None if io_uring is not available"""
+    global _io_uring, _io_uring_error
+    if _io_uring is None and _io_uring_error is None:
+        try:
+            _io_uring = syscalls.IoUring(constants.RENAME_IO_URING_ENTRIES)
+        except OSError as ee:
+            _io_uring_error = ee.strerror
+            _logger.info("io_uring is not available, renaming with renameat: {0}".format(ee.strerror))
+    return _io_uring
+
+
+def _discard_io_uring(ring, error):
+    """Stop using ring after a failed submission, its queues are in an unknown state"""
+    global _io_uring, _io_uring_error
+    _logger.warning("io_uring submission failed, renaming with renameat from now on: {0}".format(error.strerror))
+    if ring is _io_uring:
+        _io_uring = None
+        _io_uring_error = error.strerror
+    ring.close()
+
+
+class _IoUringRenameTask(_PosixRenameTask):
+    """Renames local files in batches on an io_uring.
+
+    Each idle callback submits a batch of renames at once, and collects their
+    results. Falls back to renaming like _PosixRenameTask if io_uring is not
+    available."""
+
+    def _rename_chunk(self):
+        ring = _get_io_uring()
+        if ring is None:
+            return _PosixRenameTask._rename_chunk(self)
+
+        if self._cancelled:
+            self._renamer.close()
+            self._num_local = self._num_done_local
+            self._notify_if_done()
+            return False
+
+        end = min(self._local_index + ring.size, len(self._local_entries))
+        entry_results = self._renamer.rename_batch(self._local_entries[self._local_index:end], ring)
+        self._local_index = end
+        for results in entry_results:
+            for result in results:
+                self._add_local_result(*result)
+        self._num_done_local += len(entry_results)
+        self._report_progress()
+        self._notify_if_done()
+
+        if self._local_index < len(self._local_entries):
+            return True
+        self._renamer.close()
+        return False
+
+
+def _get_thread_pool_size(path):
+    """Number of rename threads that suit the storage below path"""
+    try:
+        st_dev = os.stat(path).st_dev
+    except OSError:
+        return constants.RENAME_THREADS_DEFAULT
+    # network and other virtual file systems don't have a block device
+    sysfs_dir = "/sys/dev/block/{0}:{1}".format(os.major(st_dev), os.minor(st_dev))
+    for rotational_file in (os.path.join(sysfs_dir, "queue", "rotational"),
+                            os.path.join(sysfs_dir, "..", "queue", "rotational")):
+        try:
+            with open(rotational_file) as ff:
+                rotational = (ff.read().strip() == "1")
+        except (OSError, ValueError):
+            continue
+        if rotational:
+            return constants.RENAME_THREADS_ROTATIONAL
+        return min(constants.RENAME_THREADS_MAX, 4 * (os.cpu_count() or 1))
+    return constants.RENAME_THREADS_DEFAULT
+
+
+_executors = {}
+
+def _get_executor(num_threads):
+    """Shared thread pools, by size"""
+    try:
+        return _executors[num_threads]
+    except KeyError:
+        executor = concurrent.futures.ThreadPoolExecutor(num_threads)
+        _executors[num_threads] = executor
+        return executor
+
+
+class _ThreadPoolRenameTask(_LocalRenameTask):
+    """Renames local files with blocking calls in a thread pool.
+
+    Worker threads rename chunks of entries with a _PosixRenamer each. Their
+    results are collected, and handed to the main loop in batches by a single
+    idle callback."""
+
+    _MAX_CHUNK_SIZE = 256
+
+    def _start_local(self, entries):
+        entries = _sorted_by_directory(entries)
+        num_threads = _get_thread_pool_size(os.path.dirname(entries[0].gfile.get_path()))
+        executor = _get_executor(num_threads)
+
+        self._results_lock = threading.Lock()
+        self._pending_results = []
+        self._idle_scheduled = False
+
+        # a few chunks per thread, to balance the load
+        chunk_size = max(1, min(self._MAX_CHUNK_SIZE, math.ceil(len(entries) / (4 * num_threads))))
+        for ii in range(0, len(entries), chunk_size):
+            executor.submit(self._rename_chunk_in_thread, entries[ii:ii+chunk_size])
+
+
+    def _rename_chunk_in_thread(self, entries):
+        renamer = _PosixRenamer()
+        try:
+            # entries are skipped with an empty list of results after cancellation
+            step_results = [renamer.rename(el) if not self._cancelled else [] for el in entries]
+        finally:
+            renamer.close()
+        with self._results_lock:
+            self._pending_results.extend(step_results)
+            schedule = not self._idle_scheduled
+            self._idle_scheduled = True
+        if schedule:
+            GLib.idle_add(self._deliver_results)
+
+
+    def _deliver_results(self):
+        """Runs in the main loop"""
+        with self._results_lock:
+            step_results = self._pending_results
+            self._pending_results = []
+            self._idle_scheduled = False
+
+        for results in step_results:
+            for result in results:
+                self._add_local_result(*result)
+        self._num_done_local += len(step_results)
+        self._report_progress()
+        self._notify_if_done()
+        return False
+
+
+_RENAME_TASK_CLASSES = {
+    constants.RENAME_BACKEND_GIO : _RenameTask,
+    constants.RENAME_BACKEND_POSIX : _PosixRenameTask,
+    constants.RENAME_BACKEND_THREADS : _ThreadPoolRenameTask,
+    constants.RENAME_BACKEND_IO_URING : _IoUringRenameTask,
+    }
+
+# backend -> function that tells whether it can exchange two RenameInfo objects in one step
+_EXCHANGE_CHECKS = {}
+
+
+def register_backend(name, task_class, can_exchange=None):
+    """Add a rename backend, for file systems from register_file_system().
+
+    task_class is used like the built-in rename tasks: it is constructed with
+    a list of RenameInfo objects and the in-flight limit, and has start()
+    and cancel(). can_exchange(rename_info_a, rename_info_b) tells whether
+    the backend can swap two files in a single step."""
+    _RENAME_TASK_CLASSES[name] = task_class
+    if can_exchange is not None:
+        _EXCHANGE_CHECKS[name] = can_exchange
@@ -35,6 +35,7 @@ import check
 import constants
 import rename
 import undo
+import journal
 import gtkutils
 import collect
 import config
@@ -126,8 +127,9 @@ class GnomeBulkRenameAppBase:
         treeview.append_column(column)
         # done with columns
         treeview.set_headers_visible(True)
-        # tooltip
-        treeview.set_tooltip_column(constants.FILES_MODEL_COLUMN_TOOLTIP)
+        # tooltip: uri from the model, problems from the checker
+        treeview.set_has_tooltip(True)
+        treeview.connect("query-tooltip", self._on_files_treeview_query_tooltip)
         scrolledwin.add(treeview)
         self._files_treeview = treeview
 
@@ -138,6 +140,17 @@ class GnomeBulkRenameAppBase:
         # checker
         self._checker = None
 
+        # progress bar in the info bar while renaming, and the operation it belongs to
+        self._rename_progress_bar = None
+        self._running_operation = None
+        # the info bar shows the outcome of the last rename, until the next refresh
+        self._showing_rename_result = False
+
+        # roll back renames that were interrupted by a crash, before looking at any files
+        self._journal_dir = os.path.join(config.config_dir, "journal")
+        for path, num_undone, errors in journal.recover(self._journal_dir):
+            self._logger.warning("Rolled back {0} renames of an interrupted operation ({1} errors)".format(num_undone, len(errors)))
+
         # add files
         if uris:
             if recursive:
@@ -191,6 +204,11 @@ class GnomeBulkRenameAppBase:
             valid = self._current_preview.valid
         except AttributeError:
             valid = True
+
+        # rows that get written below, only those have to be checked again
+        dirty_rows = set()
+        handler_id = self._files_model.connect("row-changed",
+                                               lambda model, path, tree_iter : dirty_rows.add(path.get_indices()[0]))
         
         if valid:
             try:
@@ -209,16 +227,43 @@ class GnomeBulkRenameAppBase:
         if not valid:
             for row in self._files_model:
                 row[1] = row[0]
+        self._files_model.disconnect(handler_id)
 
         # markup
         self._current_markup.markup(self._files_model)
         
-        self._checker = check.Checker(self._files_model)
-        self._checker.perform_checks()
+        # the checker only re-checks rows whose preview changed, unless the rows themselves changed
+        if self._checker is None or did_just_rename or model_changed:
+            if self._checker is not None:
+                self._checker.cancel()
+            self._checker = check.Checker(self._files_model, self._on_checks_updated)
+        # only warnings arrive later, so the rename button is decided right away
+        self._checker.perform_checks(dirty_rows)
+        self._showing_rename_result = False
         self._set_info_bar_according_to_problem_level(self._checker.highest_problem_level)
         self._update_rename_button_sensitivity()
         
 
+    def _on_files_treeview_query_tooltip(self, treeview, x, y, keyboard_mode, tooltip):
+        is_row, x, y, model, path, tree_iter = treeview.get_tooltip_context(x, y, keyboard_mode)
+        if not is_row:
+            return False
+        markup = model[tree_iter][constants.FILES_MODEL_COLUMN_TOOLTIP]
+        if self._checker is not None:
+            markup += self._checker.get_tooltip_markup(path.get_indices()[0])
+        tooltip.set_markup(markup)
+        treeview.set_tooltip_row(tooltip, path)
+        return True
+
+
+    def _on_checks_updated(self):
+        """Callback for warnings of existence checks that arrived"""
+        # the progress or the outcome of a rename stays visible
+        if self._running_operation is not None or self._rename_progress_bar is not None or self._showing_rename_result:
+            return
+        self._set_info_bar_according_to_problem_level(self._checker.highest_problem_level)
+
+
     def _filtered_model_row_deleted_cb(self, model, path, combobox):
         # if combobox doesn't have an active path anymore, set the first one
         if combobox.get_active_iter() is None:
@@ -236,7 +281,9 @@ class GnomeBulkRenameAppBase:
     def _on_rename_button_clicked(self, button):
         self._checker.clear_all_warnings_and_errors()
         self._files_info_bar.hide()
-        rename.Rename(self._files_model, len(self._checker.circular_uris) > 0, self._on_rename_completed)
+        self._running_operation = rename.Rename(self._files_model, self._on_rename_completed,
+                                                progress_callback=self._on_rename_progress,
+                                                journal_dir=self._journal_dir)
 
 
     def _on_drag_data_received(self, widget, context, x, y, data, info, timestamp):
@@ -248,14 +295,14 @@ class GnomeBulkRenameAppBase:
 
 
     def _on_files_info_bar_response(self, info_bar, response_id):
+
+        if response_id == constants.FILES_INFO_BAR_RESPONSE_ID_CANCEL_RENAME:
+            if self._running_operation is not None:
+                self._running_operation.cancel()
+            return
         
         if (response_id == constants.FILES_INFO_BAR_RESPONSE_ID_INFO_WARNING) or (response_id == constants.FILES_INFO_BAR_RESPONSE_ID_INFO_ERROR):
-            problems = set()
-            for row in self._files_model:
-                if row[constants.FILES_MODEL_COLUMN_TOOLTIP]:
-                    for entry in row[constants.FILES_MODEL_COLUMN_TOOLTIP].split("\n"):
-                        if entry.startswith("<b>%s" % _("ERROR")) or entry.startswith("<b>%s" % _("WARNING")):
-                            problems.add(entry)
+            problems = self._checker.get_problems_markup() if self._checker is not None else []
             if problems:
                 if response_id == constants.FILES_INFO_BAR_RESPONSE_ID_INFO_WARNING:
                     dlg_type = Gtk.MessageType.WARNING
@@ -312,18 +359,25 @@ class GnomeBulkRenameAppBase:
             if self._is_file_in_model(gfile):
                 continue
             try:
-                fileinfo = gfile.query_info(Gio.FILE_ATTRIBUTE_STANDARD_EDIT_NAME, Gio.FileQueryInfoFlags.NONE, None)
+                fileinfo = gfile.query_info(",".join([Gio.FILE_ATTRIBUTE_STANDARD_EDIT_NAME, Gio.FILE_ATTRIBUTE_STANDARD_TYPE, Gio.FILE_ATTRIBUTE_STANDARD_IS_SYMLINK]),
+                                            Gio.FileQueryInfoFlags.NONE, None)
             except RuntimeError:
                 self._logger.error("Path '%s' could not be accessed, ignoring." %  gfile.get_path())
                 continue
             if fileinfo:
                 filename = fileinfo.get_attribute_as_string(Gio.FILE_ATTRIBUTE_STANDARD_EDIT_NAME)
+                # the rename planner needs the type of the file itself, not of a symlink target
+                if fileinfo.get_is_symlink():
+                    file_type = Gio.FileType.SYMBOLIC_LINK
+                else:
+                    file_type = fileinfo.get_file_type()
                 try:
                     dirname = __get_uri_dirname(gfile)
                 except ValueError:
                     self._logger.error("Cannot add URI because it contains no slash: '%s'" % gfile.get_uri())
                     continue
-                files_to_add.append([filename, "", gfile, "", "", "", "", dirname])
+                files_to_add.append([filename, "", gfile, "", "", "", GLib.markup_escape_text(gfile.get_uri()), dirname,
+                                     file_type])
 
         # add to model
         for file in files_to_add:
@@ -377,7 +431,32 @@ class GnomeBulkRenameAppBase:
             self._files_info_bar.show()
 
 
-    def _set_info_bar_according_to_rename_operation(self, num_renames, num_errors, was_undo):
+    def _on_rename_progress(self, num_done, num_total, rate):
+        """Show rename progress in the info bar"""
+        if self._rename_progress_bar is None:
+            content_area = self._files_info_bar.get_content_area()
+            gtkutils.clear_gtk_container(content_area)
+            gtkutils.clear_gtk_container(self._files_info_bar.get_action_area())
+            self._rename_progress_bar = Gtk.ProgressBar()
+            self._rename_progress_bar.set_show_text(True)
+            content_area.pack_start(self._rename_progress_bar, True, True, 0)
+            self._rename_progress_bar.show()
+            self._files_info_bar.add_button(Gtk.STOCK_CANCEL, constants.FILES_INFO_BAR_RESPONSE_ID_CANCEL_RENAME)
+            self._files_info_bar.set_message_type(Gtk.MessageType.INFO)
+            self._files_info_bar.show()
+        self._rename_progress_bar.set_fraction(num_done / num_total if num_total else 1.)
+        self._rename_progress_bar.set_text(_("Renamed {0} of {1} files ({2:.0f} files/s)").format(num_done, num_total, rate))
+
+
+    def _on_undo_progress(self, undo_action, num_done, num_total, rate):
+        self._running_operation = undo_action
+        self._on_rename_progress(num_done, num_total, rate)
+
+
+    def _set_info_bar_according_to_rename_operation(self, num_renames, num_errors, was_undo, was_cancelled=False):
+        self._rename_progress_bar = None
+        self._running_operation = None
+        self._showing_rename_result = True
 
         content_area = self._files_info_bar.get_content_area()
         gtkutils.clear_gtk_container(content_area)
@@ -386,7 +465,10 @@ class GnomeBulkRenameAppBase:
         
         hbox = Gtk.HBox.new(False, 4)
         
-        if num_errors > 0:
+        if was_cancelled:
+            self._files_info_bar.set_message_type(Gtk.MessageType.WARNING if num_errors > 0 else Gtk.MessageType.INFO)
+            hbox.pack_start(Gtk.Label(label=_("Cancelled after renaming {0} files").format(num_renames)), False, True, 0)
+        elif num_errors > 0:
             hbox.pack_start(Gtk.Image.new_from_stock(Gtk.STOCK_DIALOG_WARNING, Gtk.IconSize.LARGE_TOOLBAR), False, True, 0)
             self._files_info_bar.set_message_type(Gtk.MessageType.WARNING)
             if not was_undo:
@@ -434,9 +516,10 @@ class GnomeBulkRenameAppBase:
         self._update_files_model_tooltips_column()
         undo_action = rename.RenameUndoAction(results)
         undo_action.set_done_callback(self._on_undo_rename_completed)
+        undo_action.set_progress_callback(self._on_undo_progress)
         self._undo.push(undo_action)
         self.refresh(did_just_rename=True)
-        self._set_info_bar_according_to_rename_operation(len(results.successes), len(results.errors), False)
+        self._set_info_bar_according_to_rename_operation(len(results.successes), len(results.errors), False, results.cancelled)
         
         
     def _on_undo_rename_completed(self, results, undo_action):
@@ -446,7 +529,7 @@ class GnomeBulkRenameAppBase:
             undo_action.set_done_callback(self._on_redo_rename_completed)
             self._undo.push_to_redo(undo_action)
         self.refresh(did_just_rename=True)
-        self._set_info_bar_according_to_rename_operation(len(results.successes), len(results.errors), True)
+        self._set_info_bar_according_to_rename_operation(len(results.successes), len(results.errors), True, results.cancelled)
         
 
     def _on_redo_rename_completed(self, results, undo_action):
@@ -456,7 +539,7 @@ class GnomeBulkRenameAppBase:
             undo_action.set_done_callback(self._on_undo_rename_completed)
             self._undo.push_back_to_undo(undo_action)
         self.refresh(did_just_rename=True)
-        self._set_info_bar_according_to_rename_operation(len(results.successes), len(results.errors), False)
+        self._set_info_bar_according_to_rename_operation(len(results.successes), len(results.errors), False, results.cancelled)
 
 
     def _on_undo_button_clicked(self, button):
@@ -464,6 +547,23 @@ class GnomeBulkRenameAppBase:
         self._undo.undo()
 
 
+    def _on_undo_history_changed(self, undo_stack):
+        """Rebuild the menu of the undo history, one "undo to here" item per entry"""
+        if self._undo_history_merge_id is not None:
+            self._uimanager.remove_ui(self._undo_history_merge_id)
+        for action in self._undo_history_action_group.list_actions():
+            self._undo_history_action_group.remove_action(action)
+
+        self._undo_history_merge_id = self._uimanager.new_merge_id()
+        path = "/Menubar/edit/{0}/UndoHistoryItems".format(undo.Undo.UNDO_HISTORY_ACTION_NAME)
+        for ii, description in enumerate(undo_stack.get_undo_history()):
+            name = "undohistory{0}".format(ii)
+            action = Gtk.Action.new(name, description, None, None)
+            action.connect("activate", lambda action, num_actions : self._undo.undo(num_actions), ii + 1)
+            self._undo_history_action_group.add_action(action)
+            self._uimanager.add_ui(self._undo_history_merge_id, path, name, name, Gtk.UIManagerItemType.MENUITEM, False)
+
+
     def _on_redo_button_clicked(self, button):
         self._logger.debug('redo clicked')
         self._undo.redo()
@@ -596,6 +696,10 @@ class GnomeBulkRenameApp(GnomeBulkRenameAppBase):
         <menu action="edit">
             <placeholder name="EditItems"/>
             <menuitem action="%(undoaction)s"/>
+            <menuitem action="%(undoallaction)s"/>
+            <menu action="%(undohistoryaction)s">
+                <placeholder name="UndoHistoryItems"/>
+            </menu>
             <menuitem action="%(redoaction)s"/>
             <separator/>
             <menuitem action="add"/>
@@ -620,6 +724,8 @@ class GnomeBulkRenameApp(GnomeBulkRenameAppBase):
     </toolbar>
     </ui>""" % {
         "undoaction" : undo.Undo.UNDO_ACTION_NAME,
+        "undoallaction" : undo.Undo.UNDO_ALL_ACTION_NAME,
+        "undohistoryaction" : undo.Undo.UNDO_HISTORY_ACTION_NAME,
         "redoaction" : undo.Undo.REDO_ACTION_NAME,
         }
 
@@ -664,6 +770,10 @@ class GnomeBulkRenameApp(GnomeBulkRenameAppBase):
                     config_container.pack_start(inst.get_config_widget(), False, True, 0)
                     config_container.show_all()
                 files_model.set_sort_column_id(sort_id, order)
+                # rows moved
+                if self._checker is not None:
+                    self._checker.cancel()
+                self._checker = None
                 self.refresh()
 
             targets = self._files_treeview.drag_dest_get_target_list()
@@ -704,9 +814,15 @@ class GnomeBulkRenameApp(GnomeBulkRenameAppBase):
                    ]
         self._action_group.add_actions(actions)
         self._action_group.add_action(self._undo.get_undo_action())
+        self._action_group.add_action(self._undo.get_undo_all_action())
+        self._action_group.add_action(self._undo.get_undo_history_action())
         self._action_group.add_action(self._undo.get_redo_action())
         self._uimanager.insert_action_group(self._action_group, -1)
         self._uimanager.add_ui_from_string(self.__ui)
+        self._undo_history_action_group = Gtk.ActionGroup(name = "undohistory")
+        self._uimanager.insert_action_group(self._undo_history_action_group, -1)
+        self._undo_history_merge_id = None
+        self._undo.connect("undo-history-changed", self._on_undo_history_changed)
         self._remove_action = self._action_group.get_action("remove")
         self._remove_action.set_sensitive(False)
         self._clear_action = self._action_group.get_action("clear")
@@ -0,0 +1,219 @@
+# GNOME bulk rename utility
+# Copyright (C) 2010-2012 Holger Berndt <hb@gnome.org>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Write-ahead journal of rename operations.
+
+A journal file holds one JSON record per line. A layer record lists the
+steps of a rename layer before the layer is started, and an outcome record
+lists the steps of that layer that failed. Each step is a list of kind,
+uri of the file, and new display name. Layers of different groups, which
+are independent of each other, may run at the same time, so both records
+carry the number of their group.
+
+The outcome of a layer is written together with the next layer, and both
+are made durable by a single fsync. Journals of finished operations are
+deleted. Journals that are left over from a crashed process are rolled back
+by recover().
+
+A running operation holds an flock() on its journal, which the kernel
+releases when the process dies. recover() only touches journals that it can
+lock itself, so liveness doesn't depend on process ids, which get reused."""
+
+import os
+import json
+import fcntl
+import itertools
+import logging
+
+from gi.repository import Gio
+
+
+STEP_RENAME = "R"
+STEP_EXCHANGE = "X"
+
+_JOURNAL_PREFIX = "rename-"
+
+_logger = logging.getLogger("gnome.bulk-rename.journal")
+
+_journal_counter = itertools.count()
+
+
+class RenameJournal:
+    """Journal of one rename operation"""
+
+    def __init__(self, journal_dir):
+        if not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+        filename = "{0}{1}-{2}".format(_JOURNAL_PREFIX, os.getpid(), next(_journal_counter))
+        self.path = os.path.join(journal_dir, filename)
+        # lock it before recover() can see it
+        tmp_path = os.path.join(journal_dir, "." + filename)
+        self._file = open(tmp_path, "w", encoding="utf-8")
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(tmp_path, self.path)
+        self._pending = []
+
+
+    def begin_layer(self, steps, group=0):
+        """Write a layer of (kind, uri, new display name) steps, and sync
+        the journal before the layer is started."""
+        self._pending.append(json.dumps({"layer" : steps, "group" : group}, ensure_ascii=False))
+        self._commit()
+
+
+    def end_layer(self, failed_indices, group=0):
+        """Record which steps of the current layer of group failed. Buffered
+        until the next layer begins."""
+        self._pending.append(json.dumps({"failed" : sorted(failed_indices), "group" : group}))
+
+
+    def close(self):
+        """The operation finished, and doesn't need recovery"""
+        os.unlink(self.path)
+        self._file.close()
+
+
+    def _commit(self):
+        self._pending.append("")
+        self._file.write("\n".join(self._pending))
+        self._pending = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+def read_journal(path):
+    """Returns the list of (steps, failed indices) layers of a journal.
+
+    The failed indices are None for a layer whose outcome wasn't recorded."""
+    layers = []
+    current_layer = {}  # group -> index of its current layer
+    with open(path, encoding="utf-8") as ff:
+        for line in ff:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # truncated by the crash
+                break
+            group = record.get("group", 0)
+            if "layer" in record:
+                current_layer[group] = len(layers)
+                layers.append((record["layer"], None))
+            elif "failed" in record and group in current_layer:
+                ii = current_layer[group]
+                layers[ii] = (layers[ii][0], set(record["failed"]))
+    return layers
+
+
+def recover(journal_dir):
+    """Roll back the operations of left over journals, which no running process holds locked.
+
+    Returns a list of (journal path, number of undone steps, error messages)
+    tuples, one for each recovered journal."""
+    recovered = []
+    try:
+        filenames = os.listdir(journal_dir)
+    except OSError:
+        return recovered
+
+    for filename in sorted(filenames):
+        if not filename.startswith(_JOURNAL_PREFIX):
+            continue
+        path = os.path.join(journal_dir, filename)
+        lock_file = _lock_journal(path)
+        if lock_file is None:
+            continue
+
+        try:
+            num_undone, errors = roll_back(read_journal(path))
+            for msg in errors:
+                _logger.warning("Recovery of {0}: {1}".format(path, msg))
+            _logger.info("Recovery of {0}: undid {1} renames".format(path, num_undone))
+            os.unlink(path)
+        finally:
+            lock_file.close()
+        recovered.append((path, num_undone, errors))
+    return recovered
+
+
+def roll_back(layers):
+    """Undo the done steps of layers, in reverse order. Returns the number of
+    undone steps, and a list of error messages."""
+    num_undone = 0
+    errors = []
+    for steps, failed in reversed(layers):
+        for ii in reversed(range(len(steps))):
+            if failed is not None and ii in failed:
+                continue
+            kind, uri, new_display_name = steps[ii]
+            gfile = Gio.file_new_for_uri(uri)
+            try:
+                new_gfile = gfile.get_parent().get_child_for_display_name(new_display_name)
+            except RuntimeError as ee:
+                errors.append("{0}: {1}".format(uri, ee.message))
+                continue
+
+            if failed is None:
+                # the layer was interrupted, find out whether the step happened
+                if kind == STEP_EXCHANGE:
+                    errors.append("Unknown state of exchange of {0} and {1}".format(uri, new_gfile.get_uri()))
+                    continue
+                if _exists(gfile) or not _exists(new_gfile):
+                    continue
+
+            try:
+                if kind == STEP_EXCHANGE:
+                    tmp_gfile = gfile.get_parent().get_child("gbr-recover-%010d--" % os.getpid() + gfile.get_basename())
+                    _move(gfile, tmp_gfile)
+                    _move(new_gfile, gfile)
+                    _move(tmp_gfile, new_gfile)
+                else:
+                    _move(new_gfile, gfile)
+            except RuntimeError as ee:
+                errors.append("{0}: {1}".format(new_gfile.get_uri(), ee.message))
+                continue
+            num_undone += 1
+    return num_undone, errors
+
+
+def _move(source, destination):
+    source.move(destination, Gio.FileCopyFlags.NOFOLLOW_SYMLINKS, None, None, None)
+
+
+def _exists(gfile):
+    return gfile.query_file_type(Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS, None) != Gio.FileType.UNKNOWN
+
+
+def _lock_journal(path):
+    """Returns the opened journal at path locked, or None if it is in use or gone"""
+    try:
+        lock_file = open(path, "rb")
+    except OSError:
+        return None
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    # another recovery may have finished with it in the meantime
+    try:
+        same_file = os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path))
+    except OSError:
+        same_file = False
+    if not same_file:
+        lock_file.close()
+        return None
+    return lock_file
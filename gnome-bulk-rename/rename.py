@@ -15,26 +15,99 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-import os
+import time
+import array
 import logging
+import functools
+import collections
 
-from gi.repository import Gio
 from gi.repository import Gtk
+from gi.repository import Gio
 from gi.repository import GLib
 
 import constants
+import engine
 
 
 _logger = logging.getLogger("gnome.bulk-rename.rename") 
 
+
+def create_plan(model, files_to_rename=None, backend=None):
+    """Returns the engine.RenamePlan for renaming the files model.
+
+    files_to_rename and backend are the same as for Rename. The plan can be
+    inspected before it is passed on to Rename."""
+    if backend is None:
+        backend = constants.RENAME_BACKEND_GIO
+    return engine.plan(_get_rename_info_list(model, files_to_rename), backend)
+
+
+def _get_rename_info_list(model, files_to_rename):
+    """Returns a list of engine.RenameInfo entries.
+    
+    If files_to_rename is not None, it must be a list of engine.RenameInfo objects. Only those files
+    will be considered instead of the complete model."""
+    ll = []
+
+    # index the files to rename by uri, so that each row is a single lookup
+    if files_to_rename is not None:
+        files_to_rename_dict = {el.gfile.get_uri() : el for el in files_to_rename}
+
+    for ii, row in enumerate(model):
+        
+        if files_to_rename is not None:
+            # check if that file is also in files_to_rename list. Rows below renamed
+            # directories can be stale, so each file is taken only once.
+            try:
+                rename_info = files_to_rename_dict.pop(row[constants.FILES_MODEL_COLUMN_GFILE].get_uri())
+            except KeyError:
+                continue
+            if rename_info.old_display_name == rename_info.new_display_name:
+                continue
+            rename_info.row_number = ii
+            ll.append(rename_info)
+            
+        else:
+            old_display_name = row[constants.FILES_MODEL_COLUMN_ORIGINAL]
+            new_display_name = row[constants.FILES_MODEL_COLUMN_PREVIEW]
+
+            # skip files that don't change name
+            if old_display_name == new_display_name:
+                continue
+
+            ll.append(engine.RenameInfo(row[constants.FILES_MODEL_COLUMN_GFILE], old_display_name, new_display_name, ii,
+                                        row[constants.FILES_MODEL_COLUMN_FILE_TYPE]))
+    
+    return ll
+
+
 class Rename:
     """Renames a bunch of files asynchronically"""
     
-    def __init__(self, model, two_pass=False, done_callback=None,  files_to_rename=None):
+    def __init__(self, model, done_callback=None,  files_to_rename=None,
+                 progress_callback=None, max_in_flight=None, backend=None, journal_dir=None, plan=None):
         """Constructor starts an async rename operation, and returns immediately.
         
-        If files_to_rename is given, it is a list of RenameInfo objects to be
-        dealt with instead of the whole model."""
+        If files_to_rename is given, it is a list of engine.RenameInfo objects to be
+        dealt with instead of the whole model. Renames onto names of other
+        files in the batch, including circular ones, are planned automatically.
+
+        The files model is updated in batches while the operation proceeds.
+        If progress_callback is given, it is called a few times per second with
+        the number of finished renames, the total number of renames, and the
+        current rate in renames per second.
+        max_in_flight limits the number of renames that are outstanding at the
+        same time. If not given, the limit adapts itself to the observed
+        rename latency.
+
+        backend is one of the constants.RENAME_BACKEND_* values, and defaults
+        to GIO. Backends for local files fall back to GIO for remote uris.
+
+        If journal_dir is given, the operation is recorded in a journal in that
+        directory while it runs, so that it can be rolled back after a crash.
+
+        If plan is given, it is an engine.RenamePlan from create_plan(), which
+        is executed instead of files_to_rename, and determines the backend."""
         
         # disable sorting during rename
         self._sort_column_id = model.get_sort_column_id()
@@ -45,69 +118,109 @@ class Rename:
         self._done_cb = done_callback
         self._num_renames = 0
         self._num_errors = 0
-        
-        self._cancellables = {}
-        
-        if two_pass:
-            self._two_pass_rename(files_to_rename)
+        self._progress_cb = progress_callback
+        self._max_in_flight = max_in_flight
+        if plan is not None:
+            self._backend = plan.backend
         else:
-            self._single_pass_rename(files_to_rename)
+            self._backend = backend if backend is not None else constants.RENAME_BACKEND_GIO
+        self._journal_dir = journal_dir
+        self._manager = None
+
+        # model updates that still have to be applied, as (handler, entry) pairs
+        self._pending_updates = collections.deque()
+        self._updating = False
+        self._manager_done = False
+        self._results = None
+
+        # progress rate
+        self._last_progress_time = None
+        self._last_progress_num_done = 0
+        self._rate = 0.
+        
+        self._rename(files_to_rename, plan)
     
     
     def cancel(self):
-        """Cancels all outstanding operations."""
-        for cancellable in self._cancellables.values():
-            cancellable.cancel()
+        """Stop the operation. Renames that are in flight are finished, as are
+        cycles that were started, and the done callback is called with the results of the part that was done."""
+        if self._manager is not None and not self._results.cancelled:
+            self._results.cancelled = True
+            self._manager.cancel()
     
     
-    def _single_pass_rename(self, files_to_rename):
+    def _rename(self, files_to_rename, plan):
         _logger.debug("Starting rename operation")
         
-        results = RenameResults(self._model, two_pass_rename=False)
+        self._results = RenameResults(self._model, backend=self._backend, journal_dir=self._journal_dir)
         
-        def rename_done_cb(successful_renames, errors):
-            """"Update the model and notify caller"""
-            self._handle_successes(results, successful_renames)
-            self._handle_errors(results, errors)
-            self._restore_original_sorting()
-            self._done_cb(results)
-
         # start rename
-        manager = _RenameTaskManager(self._get_rename_info_list(files_to_rename))
-        manager.start(rename_done_cb)
+        self._last_progress_time = time.monotonic()
+        if plan is not None:
+            self._manager = plan.execute(self._rename_done_cb, self._rename_progress_cb, self._layer_done_cb,
+                                         self._max_in_flight, self._journal_dir)
+        else:
+            rename_list = _get_rename_info_list(self._model, files_to_rename)
+            if not rename_list:
+                # nothing to do, e.g. undoing renames that cancel each other out
+                self._rename_done_cb([], [])
+                return
+            self._manager = engine.RenameTaskManager(rename_list, self._max_in_flight, self._backend, self._journal_dir)
+            self._manager.start(self._rename_done_cb, self._rename_progress_cb, self._layer_done_cb)
 
 
-    def _two_pass_rename(self, files_to_rename):
-        _logger.debug("Starting two-pass rename operation")
-        
-        results = RenameResults(self._model, two_pass_rename=True)
-        
-        prefix = "gbr-%010d--" % os.getpid()
+    def _layer_done_cb(self, successful_renames, errors, relocated_successes):
+        """Queue the model updates of a finished layer"""
+        self._pending_updates.extend((self._handle_success, el) for el in successful_renames)
+        self._pending_updates.extend((self._handle_relocation, el) for el in relocated_successes)
+        self._pending_updates.extend((self._handle_error, el) for el in errors)
+        self._schedule_updates()
 
-        def rename_to_final_done_cb(successful_renames, errors):
-            """"Update the model and notify caller"""
-            self._handle_successes(results, successful_renames)
-            self._handle_errors(results, errors)
+
+    def _rename_done_cb(self, successful_renames_list, errors_list):
+        self._manager_done = True
+        self._manager = None
+        self._schedule_updates()
+
+
+    def _schedule_updates(self):
+        if not self._updating:
+            self._updating = True
+            GLib.idle_add(self._apply_updates)
+
+
+    def _apply_updates(self):
+        """Apply a batch of queued model updates, and notify the caller when all are done"""
+        for ii in range(min(constants.RENAME_MODEL_UPDATE_BATCH_SIZE, len(self._pending_updates))):
+            handler, el = self._pending_updates.popleft()
+            handler(el)
+        if self._pending_updates:
+            return True
+
+        self._updating = False
+        if self._manager_done:
             self._restore_original_sorting()
-            self._done_cb(results)
-        
-        
-        def rename_to_tmp_done_cb(successful_renames_list, errors_list):
-            self._handle_errors(results, errors_list)
-            
-            # all successful renames to tmp names should be scheduled for renaming to the final name
-            rename_to_final_info_list = []
-            for successful_renames in successful_renames_list:
-                for success in successful_renames:
-                    rename_to_final_info_list.append(_RenameInfo(success.new_gfile, success.rename_info.old_display_name,
-                                                                 success.rename_info.new_display_name[len(prefix):],
-                                                                 success.rename_info.row_number))
-            manager = _RenameTaskManager(rename_to_final_info_list)
-            manager.start(rename_to_final_done_cb)
-        
-        # start first rename pass
-        manager = _RenameTaskManager(self._get_rename_info_list(files_to_rename, prefix))
-        manager.start(rename_to_tmp_done_cb)
+            self._results._compact()
+            if self._done_cb is not None:
+                self._done_cb(self._results)
+        return False
+
+
+    def _rename_progress_cb(self, num_done, num_total):
+        now = time.monotonic()
+        elapsed = now - self._last_progress_time
+        if elapsed < constants.RENAME_PROGRESS_INTERVAL and num_done < num_total:
+            return
+        # smoothed rate
+        current_rate = (num_done - self._last_progress_num_done) / elapsed if elapsed > 0 else 0.
+        if self._last_progress_num_done == 0:
+            self._rate = current_rate
+        else:
+            self._rate = 0.5 * self._rate + 0.5 * current_rate
+        self._last_progress_time = now
+        self._last_progress_num_done = num_done
+        if self._progress_cb is not None:
+            self._progress_cb(num_done, num_total, self._rate)
 
 
     def _restore_original_sorting(self):
@@ -115,103 +228,115 @@ class Rename:
             self._model.set_sort_column_id(*self._sort_column_id)
 
 
-    def _get_rename_info_list(self, files_to_rename, prefix=""):
-        """Returns a list of _RenameInfo entries. New display names get an optional prefix.
-        
-        If files_to_rename is not None, it must be a list of _RenameInfo objects. Only those files
-        will be considered instead of the complete model."""
-        ll = []
-        for ii, row in enumerate(self._model):
-            
-            if files_to_rename:
-                # check if that file is also in files_to_rename list
-                try:
-                    rename_info = next(filter(lambda el : row[constants.FILES_MODEL_COLUMN_GFILE].equal(el.gfile), files_to_rename))
-                except StopIteration:
-                    continue
-                if rename_info.old_display_name == rename_info.new_display_name:
-                    continue
-                rename_info.row_number = ii
-                ll.append(rename_info)
-                
-            else:
-                old_display_name = row[constants.FILES_MODEL_COLUMN_ORIGINAL]
-                new_display_name = row[constants.FILES_MODEL_COLUMN_PREVIEW]
-
-                # skip files that don't change name
-                if old_display_name == new_display_name:
-                    continue
-
-                ll.append(_RenameInfo(row[constants.FILES_MODEL_COLUMN_GFILE], old_display_name, new_display_name, ii))
-        
-        if prefix:
-            for el in ll:
-                el.new_display_name = prefix+el.new_display_name
-        
-        return ll
+    def _get_row(self, rename_info):
+        try:
+            return self._model[rename_info.row_number]
+        except IndexError:
+            _logger.error("Model index error during rename: No row number {0}".format(rename_info.row_number))
+            return None
 
 
-    def _handle_successes(self, results, successful_renames_list):
+    def _handle_success(self, el):
         """Update model, and add to results list"""
-        for successful_renames in successful_renames_list:
-            for el in successful_renames:
-                try:
-                    row = self._model[el.rename_info.row_number]
-                except IndexError:
-                    _logger.error("Model index error during rename: No row number {0}".format(el.rename_info.row_number))
-                    continue
-                
-                old_display_name = row[constants.FILES_MODEL_COLUMN_ORIGINAL]
-    
-                row[constants.FILES_MODEL_COLUMN_ORIGINAL] = el.rename_info.new_display_name
-                row[constants.FILES_MODEL_COLUMN_GFILE] = el.new_gfile
-                
-                _logger.info("Renamed file from '{0}' to '{1}' (directory uri: {2})"
-                             .format(old_display_name, el.rename_info.new_display_name,
-                                     row[constants.FILES_MODEL_COLUMN_URI_DIRNAME]))
-                
-                results.successes.append(el)
-
-
-    def _handle_errors(self, results, errors_list):
-        """Mark errors in model, and add to results list"""
-        for errors in errors_list:
-            for el in errors:
-                try:
-                    row = self._model[el.rename_info.row_number]
-                except IndexError:
-                    _logger.error("Model index error during rename: No row number {0}".format(el.rename_info.row_number))
-                    continue
-                
-                old_display_name = row[constants.FILES_MODEL_COLUMN_ORIGINAL]
-                
-                row[constants.FILES_MODEL_COLUMN_ICON_STOCK] = Gtk.STOCK_DIALOG_ERROR
-                row[constants.FILES_MODEL_COLUMN_TOOLTIP] = "<b>{0}: {1}</b> ".format(_("ERROR"), GLib.markup_escape_text(el.error_msg))
-                
-                _logger.warning("Could not rename file from '{0}' to '{1}': '{2}' (directory: {3})"
-                                .format(old_display_name, el.rename_info.new_display_name,
-                                        el.error_msg, row[constants.FILES_MODEL_COLUMN_URI_DIRNAME]))
-            results.errors.extend(errors)
+        # intermediate step of a cycle, the rename to the final name follows
+        if el.rename_info.temporary:
+            return
+        row = self._get_row(el.rename_info)
+        if row is None:
+            return
+
+        old_display_name = row[constants.FILES_MODEL_COLUMN_ORIGINAL]
+
+        row[constants.FILES_MODEL_COLUMN_ORIGINAL] = el.rename_info.new_display_name
+        row[constants.FILES_MODEL_COLUMN_GFILE] = el.new_gfile
+
+        _logger.info("Renamed file from '{0}' to '{1}' (directory uri: {2})"
+                     .format(old_display_name, el.rename_info.new_display_name,
+                             row[constants.FILES_MODEL_COLUMN_URI_DIRNAME]))
+
+        self._results.successes.append(el)
+
+
+    def _handle_relocation(self, el):
+        """A directory above an earlier success got renamed"""
+        if el.rename_info.temporary:
+            return
+        row = self._get_row(el.rename_info)
+        if row is not None:
+            row[constants.FILES_MODEL_COLUMN_GFILE] = el.new_gfile
+
+
+    def _handle_error(self, el):
+        """Mark error in model, and add to results list"""
+        row = self._get_row(el.rename_info)
+        if row is not None:
+            old_display_name = row[constants.FILES_MODEL_COLUMN_ORIGINAL]
+
+            row[constants.FILES_MODEL_COLUMN_ICON_STOCK] = Gtk.STOCK_DIALOG_ERROR
+            row[constants.FILES_MODEL_COLUMN_TOOLTIP] = "<b>{0}: {1}</b> ".format(_("ERROR"), GLib.markup_escape_text(el.error_msg))
+
+            _logger.warning("Could not rename file from '{0}' to '{1}': '{2}' (directory: {3})"
+                            .format(old_display_name, el.rename_info.new_display_name,
+                                    el.error_msg, row[constants.FILES_MODEL_COLUMN_URI_DIRNAME]))
+        self._results.errors.append(el)
 
 
 class RenameUndoAction:
     def __init__(self, rename_results):
         self._rename_results = rename_results
         self._done_cb = None
+        self._progress_cb = None
 
         self._current_renamer = None
         
     def set_done_callback(self, callback):
         self._done_cb = callback
+
+    def set_progress_callback(self, callback):
+        """Called like the progress callback of Rename, with this object as first argument"""
+        self._progress_cb = callback
+
+    def get_description(self):
+        """Short description for the undo history"""
+        return _("Renamed files: {0}").format(len(self._rename_results.successes))
+
+    def cancel(self):
+        """Cancel a running undo or redo"""
+        if self._current_renamer is not None:
+            self._current_renamer.cancel()
     
+    @classmethod
+    def compose(cls, actions):
+        """Returns a single action that undoes actions, oldest first, at once.
+
+        Only files whose name differs from the one before the oldest action
+        are renamed. The callbacks are taken from the most recent action."""
+        newest = actions[-1]
+        results = RenameResults(newest._rename_results.model, newest._rename_results.backend,
+                                newest._rename_results.journal_dir)
+        results.successes = RenameRecords.compose([el._rename_results.successes for el in actions])
+        composed = cls(results)
+        composed.set_done_callback(newest._done_cb)
+        composed.set_progress_callback(newest._progress_cb)
+        return composed
+
+
     def undo(self):
         _logger.debug("Starting undo")
-        self._current_renamer = Rename(self._rename_results.model, self._rename_results.two_pass_rename, self._rename_done_cb, self._get_reversed_rename_info_list())
+        self._start_reversed_rename()
 
 
     def redo(self):
         _logger.debug("Starting redo")
-        self._current_renamer = Rename(self._rename_results.model, self._rename_results.two_pass_rename, self._rename_done_cb, self._get_reversed_rename_info_list())
+        self._start_reversed_rename()
+
+
+    def _start_reversed_rename(self):
+        progress_cb = None
+        if self._progress_cb is not None:
+            progress_cb = functools.partial(self._progress_cb, self)
+        self._current_renamer = Rename(self._rename_results.model, self._rename_done_cb, self._get_reversed_rename_info_list(),
+                                       progress_callback=progress_cb, backend=self._rename_results.backend, journal_dir=self._rename_results.journal_dir)
 
 
     def _rename_done_cb(self, results):
@@ -222,186 +347,139 @@ class RenameUndoAction:
 
 
     def _get_reversed_rename_info_list(self):
-        return [_RenameInfo(el.new_gfile, el.rename_info.new_display_name, el.rename_info.old_display_name, None) for el in self._rename_results.successes]
+        return self._rename_results.successes.get_reversed_rename_infos()
 
 
 class RenameResults:
     """An object representing the results of a rename operation."""
-    def __init__(self, model, two_pass_rename):
+    def __init__(self, model, backend=constants.RENAME_BACKEND_GIO, journal_dir=None):
         self.model = model
-        self.two_pass_rename = two_pass_rename
+        self.backend = backend
+        self.journal_dir = journal_dir
         
-        self.successes = [] # list of _RenameSuccess
-        self.errors = []    # list of _RenameError
+        self.successes = [] # list of engine.RenameSuccess, a RenameRecords object when done
+        self.errors = []    # list of engine.RenameError
+        self.cancelled = False
 
 
-class _RenameInfo:
-    """An object representing information about a rename operation."""
-    
-    def __init__(self, gfile, old_display_name, new_display_name, row_number):
-        self.gfile = gfile
-        self.old_display_name = old_display_name
-        self.new_display_name = new_display_name
-        self.row_number = row_number
-    
-    def __str__(self):
-        return "old/new: {0} - {1}, row {2}, gfile: {3}".format(self.old_display_name, self.new_display_name, self.row_number, self.gfile.get_uri())
+    def _compact(self):
+        """Replace the successes by their compact form, once they don't change anymore"""
+        self.successes = RenameRecords(self.successes)
 
 
-class _RenameError:
-    def __init__(self, rename_info, error_msg):
-        self.rename_info = rename_info
-        self.error_msg = error_msg
+class RenameRecords:
+    """Compact, read-only record of successful renames, for undo.
 
+    Instead of RenameSuccess and GFile objects, the new locations are kept as
+    indices into a list of interned directory uris, and the display names as
+    one string per column. Each record costs a few bytes plus the lengths of
+    its names. GFiles are only created when the renames are reversed."""
 
-class _RenameSuccess:
-    def __init__(self, rename_info, new_gfile):
-        self.rename_info = rename_info
-        self.new_gfile = new_gfile
-    
-    def __str__(self):
-        return "new_gfile: {0}, {1}".format(self.new_gfile.get_uri(), str(self.rename_info))
+    __slots__ = ("_dir_uris", "_dir_indices", "_file_types", "_old_names", "_new_names")
 
+    def __init__(self, successes=()):
+        self._fill((el.new_gfile.get_uri(), el.rename_info.file_type, el.rename_info.old_display_name,
+                    el.rename_info.new_display_name) for el in successes)
 
 
-class _RenameTaskManager:
-    def __init__(self, rename_list):
-        self._tasks = self._create_rename_tasks_list(rename_list)
+    def __len__(self):
+        return len(self._dir_indices)
 
-        self._done_cb = None
-        self._current_task = None
-        self._successful_renames_list = []
-        self._errors_list = []
-    
-    
-    def start(self, done_callback):
-        assert self._tasks
 
-        self._done_cb = done_callback
-        self._start_next_task()
-    
-    
-    def cancel(self):
-        raise NotImplementedError
-    
-    
-    def _start_next_task(self):
-        self._current_task = self._tasks.pop(0)
-        self._current_task.start(self._task_done_cb)
-        
-    
-    def _task_done_cb(self, successful_renames, errors):
-        # successful renames
-        # iterate over previous renames, modifying the path if a new rename is a prefix of an old rename
-        for old_successful_renames in self._successful_renames_list:
-            for old_success in old_successful_renames:
-                for success in successful_renames:
-                    if old_success.new_gfile.has_prefix(success.rename_info.gfile):
-                        old_uri = old_success.new_gfile.get_uri()
-                        rel_path = success.rename_info.gfile.get_relative_path(old_success.new_gfile)
-                        old_success.new_gfile = success.new_gfile.resolve_relative_path(rel_path)
-                        _logger.debug("Prefix {0} got renamed; switched new uri from {1} to {2}"
-                                      .format(success.rename_info.gfile.get_uri(),
-                                              old_uri,
-                                              old_success.new_gfile.get_uri()))
-        self._successful_renames_list.append(successful_renames)
-        self._errors_list.append(errors)
-        
-        if self._tasks:
-            self._start_next_task()
-        else:
-            if self._done_cb is not None:
-                self._done_cb(self._successful_renames_list, self._errors_list)
-                
-    
-    @staticmethod
-    def _create_rename_tasks_list(rename_list):
-        # Create rename tasks which, when executed in order, don't pose
-        # problems to the rename process (for example, don't rename a folder
-        # and then a file in that folder, because the path of that file wouldn't
-        # exist anymore by then.
+    @classmethod
+    def compose(cls, records_list):
+        """Returns the net effect of consecutive RenameRecords, oldest first.
 
-        rename_list = list(rename_list)
+        Each file is recorded once, with its name before the oldest and after
+        the newest operation. Files that end up with their original name are
+        left out."""
+        forward_renames = []
+        entries_list = []
+        for records in records_list:
+            renames, entries = records._get_renames()
+            forward_renames.append(renames)
+            entries_list.append(entries)
 
-        tasks_list = []
-        
-        # first: grab all files, they can't cause any harm
+        net = {}  # current uri -> [file type, original name, current name]
+        for ii, entries in enumerate(entries_list):
+            for uri, file_type, old_name, new_name in entries:
+                # follow the file through the later operations
+                for renames in forward_renames[ii+1:]:
+                    uri = _map_uri(uri, renames)
+                try:
+                    net[uri][2] = new_name
+                except KeyError:
+                    net[uri] = [file_type, old_name, new_name]
+
+        composed = cls()
+        composed._fill((uri, file_type, old_name, new_name)
+                       for uri, (file_type, old_name, new_name) in net.items() if old_name != new_name)
+        return composed
+
+
+    def get_reversed_rename_infos(self):
+        """Returns a list of engine.RenameInfo objects that rename the files back"""
+        return [engine.RenameInfo(gfile, new_name, old_name, None, file_type)
+                for gfile, file_type, old_name, new_name in self._iter_records()]
+
+
+    def _fill(self, records):
+        """Fill from (new uri, file type, old display name, new display name) tuples"""
+        self._dir_uris = []
+        self._dir_indices = array.array("I")
+        self._file_types = array.array("b")
+        dir_index = {}
+        old_names = []
+        new_names = []
+        for uri, file_type, old_name, new_name in records:
+            dir_uri = uri[:uri.rindex("/") + 1]
+            try:
+                index = dir_index[dir_uri]
+            except KeyError:
+                index = dir_index[dir_uri] = len(self._dir_uris)
+                self._dir_uris.append(dir_uri)
+            self._dir_indices.append(index)
+            self._file_types.append(int(file_type))
+            old_names.append(old_name)
+            new_names.append(new_name)
+        # display names can't contain NUL characters
+        self._old_names = "\0".join(old_names)
+        self._new_names = "\0".join(new_names)
+
+
+    def _iter_records(self):
+        """Yields (new gfile, file type, old display name, new display name) tuples"""
+        if not self:
+            return
+        dir_files = [Gio.file_new_for_uri(dir_uri) for dir_uri in self._dir_uris]
+        for index, file_type, old_name, new_name in zip(self._dir_indices, self._file_types,
+                                                        self._old_names.split("\0"), self._new_names.split("\0")):
+            yield (dir_files[index].get_child_for_display_name(new_name), Gio.FileType(file_type), old_name, new_name)
+
+
+    def _get_renames(self):
+        """Returns the renames as a dictionary of old uri -> new last uri component,
+        and the list of (new uri, file type, old display name, new display name) tuples"""
+        backward = {}
         entries = []
-        for ii, el in enumerate(rename_list):
-            if el.gfile.query_file_type(Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS, None) != Gio.FileType.DIRECTORY:
-                entries.append(el)
-                rename_list[ii] = None
-        if entries:
-            tasks_list.append(entries)
-        #condense list
-        rename_list = [el for el in rename_list if el is not None]
-        
-        # next: all directories that are not prefixes of any other directory
-        found_prefix = True
-        while rename_list:
-            entries = []
-            for ii, el in enumerate(rename_list):
-                found_prefix = False
-                if el is None:
-                    continue
-                for jj, el2 in enumerate(rename_list):
-                    
-                    if el2 is None or ii == jj:
-                        continue
-                    
-                    # if el is not a prefix of any other file, it's safe
-                    if el2.gfile.has_prefix(el.gfile) and not el2.gfile.equal(el.gfile):
-                        found_prefix = True
-                        break
-                
-                if not found_prefix:
-                    entries.append(el)
-                    rename_list[ii] = None
-            rename_list = [el for el in rename_list if el is not None]
-            if entries:
-                tasks_list.append(entries)
-                
-        assert len(rename_list) == 0
-        return [_RenameTask(el) for el in tasks_list]
-
-
-class _RenameTask:
-    def __init__(self, task):
-        """task is a list of RenameInfo objects"""
-        self._task = task
-        self._done_cb = None
-
-        self._errors = []             # list of _RenameError entries
-        self._successful_renames = [] # list of _RenameSuccess entries
-        self._cancellables = {}
-        
-    
-    
-    def start(self, done_callback):
-        """Start rename task"""
-        self._done_cb = done_callback
-        for el in self._task:
-            cancellable = Gio.Cancellable()
-            self._cancellables[el.gfile.get_uri()] = cancellable
-            el.gfile.set_display_name_async(el.new_display_name, GLib.PRIORITY_DEFAULT, cancellable,
-                                            self._set_display_name_async_cb, el)
-
-
-    def cancel(self):
-        """Cancel ongoing rename task"""
-        raise NotImplementedError
-
-
-    def _set_display_name_async_cb(self, gfile, result, rename_info):
+        for gfile, file_type, old_name, new_name in self._iter_records():
+            new_uri = gfile.get_uri()
+            old_uri = gfile.get_parent().get_child_for_display_name(old_name).get_uri()
+            backward[new_uri] = old_uri.rpartition("/")[2]
+            entries.append((new_uri, file_type, old_name, new_name))
+        # directories renamed in the same operation are recorded at their new location
+        forward = {_map_uri(new_uri, backward) : new_uri.rpartition("/")[2] for new_uri in backward}
+        return forward, entries
+
+
+def _map_uri(uri, renames):
+    """Apply renames, a dictionary of uri -> new last uri component, to uri and all its parents"""
+    parts = uri.split("/")
+    prefix = parts[0]
+    for ii in range(1, len(parts)):
+        prefix += "/" + parts[ii]
         try:
-            new_gfile = rename_info.gfile.set_display_name_finish(result)
-        except RuntimeError as ee:
-            self._errors.append(_RenameError(rename_info, ee.message))
-        else:
-            self._successful_renames.append(_RenameSuccess(rename_info, new_gfile))
-        finally:
-            # cleanup: get rid of corresponding cancellable
-            del self._cancellables[rename_info.gfile.get_uri()]
-            # notify if that was the last rename (no cancellables left)
-            if not self._cancellables and self._done_cb is not None:
-                self._done_cb(self._successful_renames, self._errors)
+            parts[ii] = renames[prefix]
+        except KeyError:
+            pass
+    return "/".join(parts)
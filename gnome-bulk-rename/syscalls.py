@@ -0,0 +1,216 @@
+# GNOME bulk rename utility
+# Copyright (C) 2010-2012 Holger Berndt <hb@gnome.org>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Linux specific file system calls that Python's os module doesn't offer"""
+
+import os
+import mmap
+import errno
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+
+_logger = logging.getLogger("gnome.bulk-rename.syscalls")
+
+RENAME_NOREPLACE = 1 << 0
+RENAME_EXCHANGE = 1 << 1
+
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        _logger.debug("Could not load the C library")
+        return None
+
+_libc = _load_libc()
+
+try:
+    _renameat2 = _libc.renameat2
+except AttributeError:
+    # no C library, or glibc older than 2.28
+    _renameat2 = None
+else:
+    _renameat2.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+    _renameat2.restype = ctypes.c_int
+
+have_renameat2 = _renameat2 is not None
+
+
+def renameat2(olddirfd, oldpath, newdirfd, newpath, flags=0):
+    """Rename oldpath relative to olddirfd to newpath relative to newdirfd.
+
+    flags is a combination of RENAME_NOREPLACE and RENAME_EXCHANGE. Raises
+    OSError on failure; errno is ENOSYS if renameat2 is not available, and
+    EINVAL if the file system doesn't support the given flags."""
+    if _renameat2 is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    if _renameat2(olddirfd, os.fsencode(oldpath), newdirfd, os.fsencode(newpath), flags) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+# io_uring, see linux/io_uring.h. The syscall numbers are the same on all
+# architectures that have io_uring.
+_NR_IO_URING_SETUP = 425
+_NR_IO_URING_ENTER = 426
+_NR_IO_URING_REGISTER = 427
+
+_IORING_OFF_SQ_RING = 0
+_IORING_OFF_CQ_RING = 0x8000000
+_IORING_OFF_SQES = 0x10000000
+_IORING_ENTER_GETEVENTS = 1 << 0
+_IORING_REGISTER_PROBE = 8
+_IO_URING_OP_SUPPORTED = 1 << 0
+_IORING_OP_RENAMEAT = 35
+
+# opcode, flags, ioprio, fd, off, addr, len, op flags, user data, buf index, personality, splice fd, addr3, pad
+_SQE = struct.Struct("=BBHiQQIIQHHiQQ")
+# user data, res, flags
+_CQE = struct.Struct("=QiI")
+_U32 = struct.Struct("=I")
+
+
+class _IoSqringOffsets(ctypes.Structure):
+    _fields_ = [("head", ctypes.c_uint32), ("tail", ctypes.c_uint32), ("ring_mask", ctypes.c_uint32),
+                ("ring_entries", ctypes.c_uint32), ("flags", ctypes.c_uint32), ("dropped", ctypes.c_uint32),
+                ("array", ctypes.c_uint32), ("resv1", ctypes.c_uint32), ("resv2", ctypes.c_uint64)]
+
+
+class _IoCqringOffsets(ctypes.Structure):
+    _fields_ = [("head", ctypes.c_uint32), ("tail", ctypes.c_uint32), ("ring_mask", ctypes.c_uint32),
+                ("ring_entries", ctypes.c_uint32), ("overflow", ctypes.c_uint32), ("cqes", ctypes.c_uint32),
+                ("flags", ctypes.c_uint32), ("resv1", ctypes.c_uint32), ("resv2", ctypes.c_uint64)]
+
+
+class _IoUringParams(ctypes.Structure):
+    _fields_ = [("sq_entries", ctypes.c_uint32), ("cq_entries", ctypes.c_uint32), ("flags", ctypes.c_uint32),
+                ("sq_thread_cpu", ctypes.c_uint32), ("sq_thread_idle", ctypes.c_uint32),
+                ("features", ctypes.c_uint32), ("wq_fd", ctypes.c_uint32), ("resv", ctypes.c_uint32 * 3),
+                ("sq_off", _IoSqringOffsets), ("cq_off", _IoCqringOffsets)]
+
+
+def _syscall(*args):
+    if _libc is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    ret = _libc.syscall(*[ctypes.c_long(arg) for arg in args])
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+if _libc is not None:
+    _libc.syscall.restype = ctypes.c_long
+
+
+class IoUring:
+    """An io_uring instance that runs batches of renameat operations.
+
+    Raises OSError if io_uring, or its rename operation (Linux 5.11), is not
+    available. Not thread safe.
+
+    The rings are only accessed right before and after io_uring_enter, which
+    orders the accesses, so no memory barriers are needed."""
+
+    def __init__(self, entries):
+        params = _IoUringParams()
+        self._fd = _syscall(_NR_IO_URING_SETUP, entries, ctypes.addressof(params))
+        try:
+            self._check_renameat()
+            sq_off = params.sq_off
+            cq_off = params.cq_off
+            self.size = params.sq_entries
+            self._sq_ring = mmap.mmap(self._fd, sq_off.array + params.sq_entries * 4, offset=_IORING_OFF_SQ_RING)
+            self._cq_ring = mmap.mmap(self._fd, cq_off.cqes + params.cq_entries * _CQE.size, offset=_IORING_OFF_CQ_RING)
+            self._sqes = mmap.mmap(self._fd, params.sq_entries * _SQE.size, offset=_IORING_OFF_SQES)
+        except:
+            os.close(self._fd)
+            raise
+        self._sq_tail_offset = sq_off.tail
+        self._sq_mask = _U32.unpack_from(self._sq_ring, sq_off.ring_mask)[0]
+        self._cq_head_offset = cq_off.head
+        self._cq_tail_offset = cq_off.tail
+        self._cq_mask = _U32.unpack_from(self._cq_ring, cq_off.ring_mask)[0]
+        self._cqes_offset = cq_off.cqes
+        # submission queue entry ii always lives in slot ii
+        for ii in range(params.sq_entries):
+            _U32.pack_into(self._sq_ring, sq_off.array + 4 * ii, ii)
+
+
+    def renameat_batch(self, ops):
+        """Run renameat2 operations at the same time, and wait until all of them are done.
+
+        ops is a list of at most size (olddirfd, oldpath, newdirfd, newpath,
+        flags) tuples, with bytes paths. Returns the list of their errno
+        values, which are 0 for successful renames."""
+        if not ops:
+            return []
+        assert len(ops) <= self.size
+        # all paths in one NUL separated buffer, which lives until the operations are done
+        paths = []
+        for olddirfd, oldpath, newdirfd, newpath, flags in ops:
+            paths.append(oldpath)
+            paths.append(newpath)
+        paths.append(b"")
+        buf = ctypes.create_string_buffer(b"\0".join(paths))
+        address = ctypes.addressof(buf)
+
+        tail = _U32.unpack_from(self._sq_ring, self._sq_tail_offset)[0]
+        for ii, (olddirfd, oldpath, newdirfd, newpath, flags) in enumerate(ops):
+            newpath_address = address + len(oldpath) + 1
+            _SQE.pack_into(self._sqes, ((tail + ii) & self._sq_mask) * _SQE.size, _IORING_OP_RENAMEAT, 0, 0,
+                           olddirfd, newpath_address, address, newdirfd, flags, ii, 0, 0, 0, 0, 0)
+            address = newpath_address + len(newpath) + 1
+        _U32.pack_into(self._sq_ring, self._sq_tail_offset, (tail + len(ops)) & 0xffffffff)
+
+        results = [None] * len(ops)
+        num_submitted = 0
+        num_reaped = 0
+        while num_reaped < len(ops):
+            try:
+                num_submitted += _syscall(_NR_IO_URING_ENTER, self._fd, len(ops) - num_submitted,
+                                          len(ops) - num_reaped, _IORING_ENTER_GETEVENTS, 0, 0)
+            except InterruptedError:
+                pass
+            head = _U32.unpack_from(self._cq_ring, self._cq_head_offset)[0]
+            cq_tail = _U32.unpack_from(self._cq_ring, self._cq_tail_offset)[0]
+            while head != cq_tail:
+                user_data, res, flags = _CQE.unpack_from(self._cq_ring, self._cqes_offset + (head & self._cq_mask) * _CQE.size)
+                results[user_data] = -res if res < 0 else 0
+                head = (head + 1) & 0xffffffff
+                num_reaped += 1
+            _U32.pack_into(self._cq_ring, self._cq_head_offset, head)
+        return results
+
+
+    def close(self):
+        for ring in (self._sq_ring, self._cq_ring, self._sqes):
+            ring.close()
+        os.close(self._fd)
+
+
+    def _check_renameat(self):
+        # struct io_uring_probe, followed by 256 struct io_uring_probe_op
+        probe = ctypes.create_string_buffer(16 + 256 * 8)
+        _syscall(_NR_IO_URING_REGISTER, self._fd, _IORING_REGISTER_PROBE, ctypes.addressof(probe), 256)
+        last_op = probe.raw[0]
+        op_flags = struct.unpack_from("=H", probe.raw, 16 + 8 * _IORING_OP_RENAMEAT + 2)[0]
+        if last_op < _IORING_OP_RENAMEAT or not op_flags & _IO_URING_OP_SUPPORTED:
+            raise OSError(errno.ENOSYS, "io_uring doesn't support renameat")
@@ -25,9 +25,16 @@ class Undo(GObject.GObject):
     Undo-like objects need to implement the undo and redo member functions.
     It doesn't transfer undo objects directly to the redo stack, because
     they are async, and when undo() returns, it's not yet clear if it
-    should go to the redo stack or not."""
+    should go to the redo stack or not.
+
+    Undoing several objects at once needs a compose class method, which
+    takes a list of undo-like objects, oldest first, and returns a single
+    undo-like object with their combined effect. Objects that implement
+    get_description are listed with it in the undo history."""
 
     UNDO_ACTION_NAME = "undoundoactionname"
+    UNDO_ALL_ACTION_NAME = "undoundoallactionname"
+    UNDO_HISTORY_ACTION_NAME = "undoundohistoryactionname"
     REDO_ACTION_NAME = "undoredoactionname"
 
     __gsignals__ = {
@@ -35,6 +42,7 @@ class Undo(GObject.GObject):
                       (GObject.TYPE_BOOLEAN,)),
         "can-redo" : (GObject.SignalFlags.RUN_LAST, None,
                       (GObject.TYPE_BOOLEAN,)),
+        "undo-history-changed" : (GObject.SignalFlags.RUN_LAST, None, ()),
         }
 
     def __init__(self):
@@ -49,6 +57,14 @@ class Undo(GObject.GObject):
         self._undo_action.set_sensitive(False)
         self._undo_action.connect("activate", lambda action, undo : undo(), self.undo)
 
+        self._undo_all_action = Gtk.Action.new(Undo.UNDO_ALL_ACTION_NAME, "Undo All", None, None)
+        self._undo_all_action.set_sensitive(False)
+        self._undo_all_action.connect("activate", lambda action, undo : undo(self.get_undo_depth()), self.undo)
+
+        # menu of the entries of get_undo_history()
+        self._undo_history_action = Gtk.Action.new(Undo.UNDO_HISTORY_ACTION_NAME, "Undo To", None, None)
+        self._undo_history_action.set_sensitive(False)
+
         self._redo_action = Gtk.Action.new(Undo.REDO_ACTION_NAME, "Redo", None, Gtk.STOCK_REDO)
         self._redo_action.set_sensitive(False)
         self._redo_action.connect("activate", lambda action, redo : redo(), self.redo)
@@ -57,6 +73,26 @@ class Undo(GObject.GObject):
     def get_undo_action(self):
         return self._undo_action
 
+    def get_undo_all_action(self):
+        return self._undo_all_action
+
+    def get_undo_history_action(self):
+        return self._undo_history_action
+
+    def get_undo_depth(self):
+        return len(self._undo_stack)
+
+    def get_undo_history(self):
+        """Returns descriptions of the undo stack, most recent first.
+        Undoing up to and including entry ii is undo(ii + 1)."""
+        descriptions = []
+        for ii, action in enumerate(reversed(self._undo_stack)):
+            if hasattr(action, "get_description"):
+                descriptions.append(action.get_description())
+            else:
+                descriptions.append("Step {0}".format(len(self._undo_stack) - ii))
+        return descriptions
+
     def get_redo_action(self):
         return self._redo_action
 
@@ -82,14 +118,24 @@ class Undo(GObject.GObject):
 
         if len(self._undo_stack) == 1:
             self._changed_can_undo(True)
+        self.emit("undo-history-changed")
 
 
-    def undo(self):
-        action = self._undo_stack.pop()
+    def undo(self, num_actions=1):
+        """Undo the num_actions most recent objects in a single step"""
+        assert 0 < num_actions <= len(self._undo_stack)
+        actions = self._undo_stack[-num_actions:]
+        if num_actions == 1:
+            action = actions[0]
+        else:
+            action = type(actions[0]).compose(actions)
         action.undo()
+        # only after the undo started, such that a failure keeps the history
+        del self._undo_stack[-num_actions:]
 
         if not self._undo_stack:
             self._changed_can_undo(False)
+        self.emit("undo-history-changed")
             
 
     def redo(self):
@@ -103,6 +149,8 @@ class Undo(GObject.GObject):
     def _changed_can_undo(self, can_undo):
         self.emit("can-undo", can_undo)
         self._undo_action.set_sensitive(can_undo)
+        self._undo_all_action.set_sensitive(can_undo)
+        self._undo_history_action.set_sensitive(can_undo)
 
     def _changed_can_redo(self, can_redo):
         self.emit("can-redo", can_redo)
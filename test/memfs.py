@@ -0,0 +1,234 @@
+# GNOME bulk rename utility
+# Copyright (C) 2010-2012 Holger Berndt <hb@gnome.org>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""In-memory file system for testing and benchmarking the rename engine.
+
+Each MemoryFileSystem is reachable under its own memory://<name>/ uri, and
+counts as a mount of its own. Importing this module registers the file
+systems and the BACKEND rename backend with the engine: files are renamed
+with that backend, and check() and get_rename_infos() look up existence
+and file types here, so large trees and slow or flaky mounts can be
+simulated without touching the disk."""
+
+import time
+import errno
+import random
+import weakref
+import itertools
+import urllib.parse
+
+from gi.repository import Gio
+from gi.repository import GLib
+
+import engine
+
+
+SCHEME = "memory://"
+BACKEND = "memory"
+
+_file_systems = weakref.WeakValueDictionary()   # name -> MemoryFileSystem
+_name_counter = itertools.count()
+
+
+class MemoryFileSystem:
+    """A tree of directories and regular files.
+
+    Directories are dictionaries of name -> node, regular files are None.
+    Each rename takes latency seconds when run by the engine, and fails with
+    EIO with probability failure_rate."""
+
+    def __init__(self, latency=0., failure_rate=0., seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.num_renames = 0
+        self._random = random.Random(seed)
+        self._root = {}
+        self.name = "mem{0}".format(next(_name_counter))
+        self.uri = "{0}{1}/".format(SCHEME, self.name)
+        _file_systems[self.name] = self
+
+
+    def get_uri(self, path):
+        """Returns the uri of a path like "a/b" relative to the root"""
+        return self.uri + urllib.parse.quote(path.strip("/"))
+
+
+    def add_file(self, path):
+        """Create a regular file and its missing parent directories"""
+        parts = path.strip("/").split("/")
+        self._make_dirs(parts[:-1])[parts[-1]] = None
+
+
+    def add_directory(self, path):
+        """Create a directory and its missing parents"""
+        self._make_dirs(path.strip("/").split("/"))
+
+
+    def exists(self, uri):
+        try:
+            self._lookup(uri)
+        except OSError:
+            return False
+        return True
+
+
+    def query_file_type(self, uri):
+        """Returns the Gio.FileType of uri, UNKNOWN if it doesn't exist"""
+        try:
+            node = self._lookup(uri)
+        except OSError:
+            return Gio.FileType.UNKNOWN
+        return Gio.FileType.DIRECTORY if node is not None else Gio.FileType.REGULAR
+
+
+    def listdir(self, uri):
+        """Returns the sorted names in the directory uri"""
+        node = self._lookup(uri)
+        if node is None:
+            raise NotADirectoryError(errno.ENOTDIR, "Not a directory")
+        return sorted(node)
+
+
+    def rename(self, uri, new_name, exchange=False):
+        """Rename uri within its directory, like renameat2 with RENAME_NOREPLACE,
+        or swap it with new_name if exchange is True. Raises OSError."""
+        self.num_renames += 1
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            raise OSError(errno.EIO, "Injected failure")
+        parent_uri, sep, old_name = uri.rstrip("/").rpartition("/")
+        directory = self._lookup(parent_uri)
+        if directory is None:
+            raise NotADirectoryError(errno.ENOTDIR, "Not a directory")
+        old_name = urllib.parse.unquote(old_name)
+        if old_name not in directory:
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory")
+        if exchange:
+            if new_name not in directory:
+                raise FileNotFoundError(errno.ENOENT, "No such file or directory")
+            directory[old_name], directory[new_name] = directory[new_name], directory[old_name]
+        elif new_name != old_name:
+            if new_name in directory:
+                raise FileExistsError(errno.EEXIST, "File exists")
+            directory[new_name] = directory.pop(old_name)
+
+
+    def _make_dirs(self, parts):
+        node = self._root
+        for part in parts:
+            node = node.setdefault(part, {})
+            if node is None:
+                raise NotADirectoryError(errno.ENOTDIR, "Not a directory")
+        return node
+
+
+    def _lookup(self, uri):
+        if not (uri + "/").startswith(self.uri):
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory")
+        node = self._root
+        for part in uri[len(self.uri):].split("/"):
+            if not part:
+                continue
+            if node is None:
+                raise NotADirectoryError(errno.ENOTDIR, "Not a directory")
+            try:
+                node = node[urllib.parse.unquote(part)]
+            except KeyError:
+                raise FileNotFoundError(errno.ENOENT, "No such file or directory")
+        return node
+
+
+def lookup(uri):
+    """Returns the MemoryFileSystem that uri is on, or None"""
+    if not uri.startswith(SCHEME):
+        return None
+    return _file_systems.get(uri[len(SCHEME):].partition("/")[0])
+
+
+class MemoryRenameTask(engine._LocalRenameTask):
+    """Renames files on MemoryFileSystem objects.
+
+    Each batch of renames takes as long as the largest latency of their file
+    systems, and the batch size is the in-flight window, so a slow mount
+    behaves like a remote one. Without latency, renames run in chunks from
+    idle callbacks, like with the posix backend."""
+
+    _CHUNK_SIZE = 256
+
+    @staticmethod
+    def _is_handled(gfile):
+        return lookup(gfile.get_uri()) is not None
+
+
+    def _start_local(self, entries):
+        self._local_entries = entries
+        self._local_index = 0
+        self._window = engine._RenameWindow(self._max_in_flight)
+        self._start_batch()
+
+
+    def _start_batch(self):
+        end = self._local_index
+        latency = 0.
+        while end < len(self._local_entries) and (latency == 0. or end - self._local_index < self._window.size):
+            latency = max(latency, lookup(self._local_entries[end].gfile.get_uri()).latency)
+            if latency == 0. and end - self._local_index == self._CHUNK_SIZE:
+                break
+            end += 1
+        batch = self._local_entries[self._local_index:end]
+        self._local_index = end
+        if latency > 0.:
+            GLib.timeout_add(int(latency * 1000), self._rename_batch, batch, time.monotonic())
+        else:
+            GLib.idle_add(self._rename_batch, batch, None)
+
+
+    def _rename_batch(self, batch, start_time):
+        if self._cancelled:
+            self._num_local = self._num_done_local
+            self._notify_if_done()
+            return False
+
+        for el in batch:
+            uri = el.gfile.get_uri()
+            try:
+                new_gfile = el.gfile.get_parent().get_child_for_display_name(el.new_display_name)
+                lookup(uri).rename(uri, el.new_display_name, el.exchange_with is not None)
+            except RuntimeError as ee:
+                results = engine._PosixRenamer._failed(el, ee.message)
+            except OSError as ee:
+                results = engine._PosixRenamer._failed(el, ee.strerror)
+            else:
+                results = [(el, new_gfile, None)]
+                if el.exchange_with is not None:
+                    results.append((el.exchange_with, el.gfile, None))
+            for result in results:
+                self._add_local_result(*result)
+            if start_time is not None:
+                self._window.update(time.monotonic() - start_time)
+            self._local_step_done()
+
+        if self._local_index < len(self._local_entries):
+            self._start_batch()
+        return False
+
+
+def _can_exchange(rename_info_a, rename_info_b):
+    return lookup(rename_info_a.gfile.get_uri()) is not None and lookup(rename_info_b.gfile.get_uri()) is not None
+
+
+engine.register_file_system(lookup)
+engine.register_backend(BACKEND, MemoryRenameTask, _can_exchange)
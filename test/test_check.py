@@ -5,6 +5,8 @@ import os.path
 import os
 
 from gi.repository import Gio
+from gi.repository import GLib
+from gi.repository import Gtk
 
 import check
 import constants as c
@@ -172,21 +174,83 @@ class TestChecker(unittest.TestCase):
         self.assertNotEmpty(chk.circular_uris)
         
         self.assertEqual(self._model_problems[1][c.FILES_MODEL_COLUMN_ICON_STOCK], "gtk-dialog-error")
-        self.assertIn("Empty target name", self._model_problems[1][c.FILES_MODEL_COLUMN_TOOLTIP])
+        self.assertIn("Empty target name", chk.get_tooltip_markup(1))
         
         self.assertEqual(self._model_problems[2][c.FILES_MODEL_COLUMN_ICON_STOCK], "gtk-dialog-error")
-        self.assertIn("Slash in target name", self._model_problems[2][c.FILES_MODEL_COLUMN_TOOLTIP])
+        self.assertIn("Slash in target name", chk.get_tooltip_markup(2))
 
         self.assertEqual(self._model_problems[3][c.FILES_MODEL_COLUMN_ICON_STOCK], "gtk-dialog-error")
-        self.assertIn("Double output filepath", self._model_problems[3][c.FILES_MODEL_COLUMN_TOOLTIP])
+        self.assertIn("Double output filepath", chk.get_tooltip_markup(3))
         self.assertEqual(self._model_problems[4][c.FILES_MODEL_COLUMN_ICON_STOCK], "gtk-dialog-error")
-        self.assertIn("Double output filepath", self._model_problems[4][c.FILES_MODEL_COLUMN_TOOLTIP])
+        self.assertIn("Double output filepath", chk.get_tooltip_markup(4))
+        # one line per kind of problem, errors first
+        problems = chk.get_problems_markup()
+        self.assertEqual(len(problems), 3)
+        self.assertIn("Empty target name", problems[1])
         
         chk.clear_all_warnings_and_errors()
         self.assertEqual(self._model_problems[1][c.FILES_MODEL_COLUMN_ICON_STOCK], "")
         self.assertNotIn("Empty target name", self._model_problems[1][c.FILES_MODEL_COLUMN_TOOLTIP])
         
     
+    def test_problem_fixed(self):
+        chk = check.Checker(self._model_problems)
+        chk.perform_checks()
+        self._model_problems[1][c.FILES_MODEL_COLUMN_PREVIEW] = "T1new"
+        chk.perform_checks()
+        self.assertEqual(chk.highest_problem_level, 2)
+        self.assertEqual(self._model_problems[1][c.FILES_MODEL_COLUMN_ICON_STOCK], "")
+        self.assertNotIn("Empty target name", chk.get_tooltip_markup(1))
+        self.assertIn("Slash in target name", chk.get_tooltip_markup(2))
+        self.assertEqual(chk.get_tooltip_markup(2).count("Slash in target name"), 1)
+
+
+    def test_incremental(self):
+        chk = check.Checker(self._model_problems)
+        chk.perform_checks()
+        # the double target goes away for both rows
+        self._model_problems[4][c.FILES_MODEL_COLUMN_PREVIEW] = "T4"
+        chk.perform_checks()
+        self.assertEqual(self._model_problems[3][c.FILES_MODEL_COLUMN_ICON_STOCK], "")
+        self.assertEqual(self._model_problems[4][c.FILES_MODEL_COLUMN_ICON_STOCK], "")
+        # rows that are known to have changed
+        self._model_problems[1][c.FILES_MODEL_COLUMN_PREVIEW] = "T1"
+        self._model_problems[2][c.FILES_MODEL_COLUMN_PREVIEW] = "T3"
+        chk.perform_checks(dirty_rows={1, 2})
+        self.assertEqual(self._model_problems[1][c.FILES_MODEL_COLUMN_ICON_STOCK], "")
+        self.assertEqual(self._model_problems[2][c.FILES_MODEL_COLUMN_ICON_STOCK], "gtk-dialog-error")
+        self.assertIn("Double output filepath", chk.get_tooltip_markup(3))
+        self.assertEqual(chk.highest_problem_level, 2)
+        # rows that were written with their old preview stay as they are
+        self._model_problems[1][c.FILES_MODEL_COLUMN_PREVIEW] = "T1"
+        self._model_problems[2][c.FILES_MODEL_COLUMN_PREVIEW] = "T3"
+        chk.perform_checks(dirty_rows={0, 1, 2})
+        self.assertEqual(self._model_problems[1][c.FILES_MODEL_COLUMN_ICON_STOCK], "")
+        self.assertEqual(self._model_problems[2][c.FILES_MODEL_COLUMN_ICON_STOCK], "gtk-dialog-error")
+        self.assertIn("Double output filepath", chk.get_tooltip_markup(3))
+
+
+    def test_asynchronous_existence_checks(self):
+        def update_cb():
+            updates.append(chk.highest_problem_level)
+            Gtk.main_quit()
+        updates = []
+        chk = check.Checker(self._model_potential_problems, update_callback=update_cb)
+        chk.perform_checks()
+        # results of the first run are outdated
+        self._model_potential_problems[0][c.FILES_MODEL_COLUMN_PREVIEW] = "foo"
+        chk.perform_checks()
+        if chk.existence_checks_pending:
+            GLib.timeout_add_seconds(10, Gtk.main_quit)
+            Gtk.main()
+        self.assertFalse(chk.existence_checks_pending)
+        self.assertEqual(updates, [2])
+        self.assertEqual(chk.highest_problem_level, 2)
+        self.assertEqual(self._model_potential_problems[0][c.FILES_MODEL_COLUMN_ICON_STOCK], "gtk-dialog-error")
+        self.assertIn("Target filename already exists on the filesystem", chk.get_tooltip_markup(1))
+        self.assertEqual(self._model_potential_problems[2][c.FILES_MODEL_COLUMN_ICON_STOCK], "")
+
+
     def test_probable_problem(self):
         chk = check.Checker(self._model_potential_problems)
         chk.perform_checks()
@@ -195,7 +259,7 @@ class TestChecker(unittest.TestCase):
         self.assertEmpty(chk.circular_uris)
 
         self.assertEqual(self._model_potential_problems[1][c.FILES_MODEL_COLUMN_ICON_STOCK], "gtk-dialog-warning")
-        self.assertIn("Target filename already exists on the filesystem", self._model_potential_problems[1][c.FILES_MODEL_COLUMN_TOOLTIP])
+        self.assertIn("Target filename already exists on the filesystem", chk.get_tooltip_markup(1))
 
         chk.clear_all_warnings_and_errors()
         self.assertEqual(self._model_potential_problems[1][c.FILES_MODEL_COLUMN_ICON_STOCK], "")
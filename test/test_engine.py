@@ -0,0 +1,260 @@
+import unittest
+import tempfile
+import shutil
+import os.path
+import os
+import sys
+import errno
+import subprocess
+
+from gi.repository import Gio
+
+import engine
+import memfs
+import constants as c
+
+
+class _PrefixPreview:
+    """Preview-like object that works on rows"""
+
+    def preview(self, model):
+        for row in model:
+            row[1] = "new_" + row[0]
+
+
+class _FailingRing:
+    """io_uring stand-in whose submission fails after the first rename happened"""
+
+    size = 8
+
+    def renameat_batch(self, ops):
+        olddirfd, oldpath, newdirfd, newpath, flags = ops[0]
+        os.rename(oldpath, newpath, src_dir_fd=olddirfd, dst_dir_fd=newdirfd)
+        raise OSError(errno.EBUSY, os.strerror(errno.EBUSY))
+
+    def close(self):
+        pass
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._dir_uri = Gio.file_new_for_path(self._tmp_dir).get_uri() + "/"
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+
+    def _create(self, *names):
+        for name in names:
+            with open(os.path.join(self._tmp_dir, name), "w") as ff:
+                ff.write(name)
+
+
+    def _content(self, name):
+        with open(os.path.join(self._tmp_dir, name)) as ff:
+            return ff.read()
+
+
+    def test_preview(self):
+        self.assertEqual(engine.preview(["a", "b"], str.upper), ["A", "B"])
+        self.assertEqual(engine.preview(["a", "b"], _PrefixPreview()), ["new_a", "new_b"])
+
+
+    def test_check(self):
+        self._create("a", "b", "c", "exists")
+        results = engine.check([(self._dir_uri, "a", ""), (self._dir_uri, "b", "x"), (self._dir_uri, "c", "x"),
+                                (self._dir_uri, "e", "exists"), (self._dir_uri, "d", "exists")])
+        self.assertEqual(results.highest_problem_level, engine.PROBLEM_LEVEL_ERROR)
+        self.assertEqual(sorted(results.problems), [0, 1, 2, 3, 4])
+        self.assertEqual([level for level, msg in results.problems[4]], [engine.PROBLEM_LEVEL_ERROR, engine.PROBLEM_LEVEL_WARNING])
+
+
+    def test_check_circular(self):
+        results = engine.check([(self._dir_uri, "a", "b"), (self._dir_uri, "b", "a")])
+        self.assertEqual(results.highest_problem_level, 0)
+        self.assertEqual(results.circular_uris, {self._dir_uri + "a", self._dir_uri + "b"})
+
+
+    def test_check_index(self):
+        self._create("a", "b", "c", "x")
+        names = ["a", "b", "c", "d"]
+        targets = list(names)
+        index = engine.CheckIndex([(self._dir_uri, name, name) for name in names])
+        self.assertTrue(index.results.all_names_stay_the_same)
+        # updates give the same results as checking from scratch
+        for changes in ({0 : "b", 1 : "a"}, {2 : "x"}, {3 : "a"}, {0 : "", 3 : "d/"}, {0 : "a", 1 : "b", 2 : "c", 3 : "d"}):
+            affected = index.set_targets(changes)
+            self.assertTrue(set(changes) <= affected)
+            for ii, target in changes.items():
+                targets[ii] = target
+            results = engine.check([(self._dir_uri, name, target) for name, target in zip(names, targets)])
+            for attr in ("all_names_stay_the_same", "highest_problem_level", "circular_uris", "problem_rows", "level_counts"):
+                self.assertEqual(getattr(index.results, attr), getattr(results, attr))
+            self.assertEqual({ii : sorted(problems) for ii, problems in index.results.problems.items()},
+                             {ii : sorted(problems) for ii, problems in results.problems.items()})
+
+
+    def test_directory_cache(self):
+        self._create("a")
+        cache = engine._DirectoryCache(monitor=False)
+        self.assertEqual(cache.get_names(self._dir_uri), {"a"})
+        self._create("b")
+        # the directory is looked at again in the next pass only
+        mtime = os.stat(self._tmp_dir).st_mtime + 10
+        os.utime(self._tmp_dir, (mtime, mtime))
+        self.assertEqual(cache.get_names(self._dir_uri), {"a"})
+        cache.new_pass()
+        self.assertEqual(cache.get_names(self._dir_uri), {"a", "b"})
+        self.assertIsNone(cache.get_names(self._dir_uri + "missing/"))
+
+        # renames clear the cache used by check()
+        self.assertEqual(engine.check([(self._dir_uri, "a", "c")]).problems, {})
+        engine.run([(self._tmp_dir, "b", "c")], backend=c.RENAME_BACKEND_POSIX)
+        self.assertEqual(len(engine.check([(self._dir_uri, "a", "c")]).problems), 1)
+
+
+    def test_run(self):
+        self._create("a", "b", "c")
+        results = engine.run([(self._tmp_dir, "a", "b"), (self._tmp_dir, "b", "a"), (self._tmp_dir, "c", "d")],
+                             backend=c.RENAME_BACKEND_POSIX)
+        self.assertEqual((len(results.successes), len(results.errors)), (3, 0))
+        self.assertEqual(sorted(os.listdir(self._tmp_dir)), ["a", "b", "d"])
+        self.assertEqual([self._content(name) for name in ("a", "b", "d")], ["b", "a", "c"])
+
+
+    def test_run_io_uring_submission_fails(self):
+        self._create("a", "b", "c")
+        io_uring, io_uring_error = engine._io_uring, engine._io_uring_error
+        engine._io_uring, engine._io_uring_error = _FailingRing(), None
+        try:
+            results = engine.run([(self._tmp_dir, "a", "x"), (self._tmp_dir, "b", "y"), (self._tmp_dir, "c", "b")],
+                                 backend=c.RENAME_BACKEND_IO_URING)
+            # the ring isn't used anymore
+            self.assertIsNone(engine._get_io_uring())
+        finally:
+            engine._io_uring, engine._io_uring_error = io_uring, io_uring_error
+        self.assertEqual((len(results.successes), len(results.errors)), (3, 0))
+        self.assertEqual(sorted(os.listdir(self._tmp_dir)), ["b", "x", "y"])
+        self.assertEqual([self._content(name) for name in ("x", "y", "b")], ["a", "b", "c"])
+
+
+    def test_run_cycle_temporary_step_fails(self):
+        self._create("a", "b", "c")
+        # occupy the temporary name of the cycle
+        tmp_name = "gbr-%010d--b" % os.getpid()
+        self._create(tmp_name)
+        results = engine.run([(self._tmp_dir, "a", "b"), (self._tmp_dir, "b", "c"), (self._tmp_dir, "c", "a")],
+                             backend=c.RENAME_BACKEND_POSIX)
+        self.assertEqual(results.successes, [])
+        # every rename of the cycle is reported, with its own target name
+        self.assertEqual(sorted((el.rename_info.old_display_name, el.rename_info.new_display_name) for el in results.errors),
+                         [("a", "b"), ("b", "c"), ("c", "a")])
+        self.assertFalse(any(tmp_name in el.error_msg for el in results.errors))
+        self.assertEqual(sorted(os.listdir(self._tmp_dir)), ["a", "b", "c", tmp_name])
+        self.assertEqual([self._content(name) for name in ("a", "b", "c")], ["a", "b", "c"])
+
+
+    def test_run_without_gettext_install(self):
+        # scripts don't install the _ builtin
+        script = ("import engine; "
+                  "results = engine.run([({0!r}, 'a', '')]); "
+                  "print(results.check_results.highest_problem_level)").format(self._tmp_dir)
+        self._create("a")
+        output = subprocess.check_output([sys.executable, "-c", script], cwd=os.path.dirname(engine.__file__),
+                                         universal_newlines=True)
+        self.assertEqual(output.strip(), str(engine.PROBLEM_LEVEL_ERROR))
+        self.assertEqual(os.listdir(self._tmp_dir), ["a"])
+
+
+    def test_run_with_previewer(self):
+        self._create("a", "b")
+        results = engine.run([(self._tmp_dir, "a", "a"), (self._tmp_dir, "b", "b")], previewer=_PrefixPreview())
+        self.assertEqual(results.targets, ["new_a", "new_b"])
+        self.assertEqual(sorted(os.listdir(self._tmp_dir)), ["new_a", "new_b"])
+
+
+    def test_run_refuses_errors(self):
+        self._create("a", "b")
+        results = engine.run([(self._tmp_dir, "a", "x"), (self._tmp_dir, "b", "x")])
+        self.assertEqual(results.check_results.highest_problem_level, engine.PROBLEM_LEVEL_ERROR)
+        self.assertEqual(results.successes, [])
+        self.assertEqual(sorted(os.listdir(self._tmp_dir)), ["a", "b"])
+
+
+    def test_plan(self):
+        self._create("a", "b", "c")
+        infos = engine.get_rename_infos([(self._tmp_dir, "a", "b"), (self._tmp_dir, "b", "a"), (self._tmp_dir, "c", "d")])
+        plan = engine.plan(infos)
+        self.assertEqual(plan.num_renames, 3)
+        self.assertEqual(plan.num_temporary_renames, 1)
+        self.assertEqual(plan.num_steps, 4)
+        self.assertEqual(plan.get_directory_counts(), {self._dir_uri.rstrip("/") : 3})
+        self.assertEqual(sum(plan.get_mount_counts().values()), 3)
+        self.assertIn("3 renames in 4 steps", plan.explain())
+        self.assertEqual(sum(len(layer) for group in plan.to_dict()["groups"] for layer in group["layers"]), 4)
+        # planning doesn't touch the file system
+        self.assertEqual(sorted(os.listdir(self._tmp_dir)), ["a", "b", "c"])
+
+        successes, errors = engine.execute(plan)
+        self.assertEqual((len(successes), len(errors)), (3, 0))
+        self.assertEqual([self._content(name) for name in ("a", "b", "d")], ["b", "a", "c"])
+
+
+    def test_plan_empty(self):
+        results = []
+        self.assertIsNone(engine.plan([]).execute(lambda *args: results.append(args)))
+        self.assertEqual(results, [([], [])])
+
+
+    def test_plan_queries_unknown_file_types(self):
+        os.mkdir(os.path.join(self._tmp_dir, "d"))
+        self._create("d/x")
+        dir_gfile = Gio.file_new_for_path(os.path.join(self._tmp_dir, "d"))
+        infos = [engine.RenameInfo(dir_gfile.get_child("x"), "x", "y", 0), engine.RenameInfo(dir_gfile, "d", "e", 1)]
+        plan = engine.plan(infos)
+        self.assertEqual([el.file_type for el in infos], [Gio.FileType.REGULAR, Gio.FileType.DIRECTORY])
+        # the directory is renamed after the file in it
+        self.assertEqual(plan.num_layers, 2)
+        successes, errors = engine.execute(plan)
+        self.assertEqual((len(successes), len(errors)), (2, 0))
+        self.assertEqual(os.listdir(os.path.join(self._tmp_dir, "e")), ["y"])
+
+
+    def test_find_mount_point(self):
+        mount_points = [b"/run/user/1000/gvfs", b"/home", b"/"]
+        self.assertEqual(engine._find_mount_point("/home/a/b", mount_points), "/home")
+        self.assertEqual(engine._find_mount_point("/homes/a", mount_points), "/")
+        # each gvfs share is a mount of its own
+        self.assertEqual(engine._find_mount_point("/run/user/1000/gvfs/sftp:host=x/a/b", mount_points),
+                         "/run/user/1000/gvfs/sftp:host=x")
+
+
+    def test_run_memory(self):
+        fs = memfs.MemoryFileSystem()
+        for path in ("d/a", "d/b", "d/c", "d/sub dir/x"):
+            fs.add_file(path)
+        dir_uri = fs.get_uri("d")
+        results = engine.run([(dir_uri, "a", "b"), (dir_uri, "b", "a"), (dir_uri, "sub dir", "new dir"),
+                              (fs.get_uri("d/sub dir"), "x", "y")], backend=memfs.BACKEND)
+        self.assertEqual((len(results.successes), len(results.errors)), (4, 0))
+        self.assertEqual(fs.listdir(dir_uri), ["a", "b", "c", "new dir"])
+        self.assertEqual(fs.listdir(fs.get_uri("d/new dir")), ["y"])
+        self.assertEqual(fs.query_file_type(fs.get_uri("d/new dir")), Gio.FileType.DIRECTORY)
+        # existence checks are answered by the memory file system, too
+        results = engine.run([(dir_uri, "a", "c")], backend=memfs.BACKEND)
+        self.assertEqual(results.check_results.highest_problem_level, engine.PROBLEM_LEVEL_WARNING)
+
+
+    def test_run_memory_failures(self):
+        fs = memfs.MemoryFileSystem(latency=0.001, failure_rate=0.5, seed=0)
+        for ii in range(100):
+            fs.add_file("f{0}".format(ii))
+        results = engine.run([(fs.uri, "f{0}".format(ii), "g{0}".format(ii)) for ii in range(100)],
+                             backend=memfs.BACKEND)
+        self.assertEqual(len(results.successes) + len(results.errors), 100)
+        self.assertTrue(results.successes and results.errors)
+        self.assertEqual(len(fs.listdir(fs.uri)), 100)
+        self.assertEqual(sum(name.startswith("g") for name in fs.listdir(fs.uri)), len(results.successes))
@@ -8,6 +8,9 @@ from gi.repository import Gio
 from gi.repository import Gtk
 
 import rename
+import engine
+import undo
+import journal
 import constants as c
 
 import runtests
@@ -91,15 +94,18 @@ class TestRenamer(unittest.TestCase):
         
         self._fail_msg = None
         
-        self._two_pass = False
+        self._circular = False
+
+        self._backend = None
         
 
-    def _add_to_model(self, model, original, preview, filepath):
+    def _add_to_model(self, model, original, preview, filepath, file_type):
         row = [None] * len(c.FILES_MODEL_COLUMNS)
         
         row[c.FILES_MODEL_COLUMN_ORIGINAL] = original
         row[c.FILES_MODEL_COLUMN_PREVIEW] = preview
         row[c.FILES_MODEL_COLUMN_GFILE] = filepath
+        row[c.FILES_MODEL_COLUMN_FILE_TYPE] = file_type
         model.append(row)
         return row
 
@@ -110,7 +116,7 @@ class TestRenamer(unittest.TestCase):
         else:
             path = self._tmp_dir.resolve_relative_path(rel_path)
         filepath = path.resolve_relative_path(original)
-        row = self._add_to_model(model, original, preview, filepath)
+        row = self._add_to_model(model, original, preview, filepath, Gio.FileType.REGULAR)
         
         success = False
         while not success:
@@ -131,7 +137,7 @@ class TestRenamer(unittest.TestCase):
         else:
             path = self._tmp_dir.resolve_relative_path(rel_path)
         filepath = path.resolve_relative_path(original)
-        row = self._add_to_model(model, original, preview, filepath)
+        row = self._add_to_model(model, original, preview, filepath, Gio.FileType.DIRECTORY)
         success = False
         while not success:
             try:
@@ -159,7 +165,7 @@ class TestRenamer(unittest.TestCase):
     def _check_renamed_files(self):
         for mp in self._mapping:
             # check that the target files really exist, and source files are gone
-            if not self._two_pass and not mp.gfile_orig.equal(mp.gfile_prev):
+            if not self._circular and not mp.gfile_orig.equal(mp.gfile_prev):
                 self.assertFalse(mp.gfile_orig.query_exists(None), "File exists, but shouldn't: {0}".format(mp.gfile_orig.get_uri()))
             self.assertTrue(mp.gfile_prev.query_exists(None), "File should exist, but doesn't: {0}".format(mp.gfile_prev.get_uri()))
             
@@ -188,7 +194,7 @@ class TestRenamer(unittest.TestCase):
             
         self._mapping = self._get_mapping(self._model)
         
-        rename.Rename(self._model, two_pass=self._two_pass, done_callback=self._cb_test_rename)
+        rename.Rename(self._model, done_callback=self._cb_test_rename, backend=self._backend)
         Gtk.main()
         self._cond_fail()
 
@@ -199,12 +205,122 @@ class TestRenamer(unittest.TestCase):
         for ii in range(5):
             self._create_and_add_file_to_model(self._model, "Test{0}".format(ii), "Test{0}".format((ii+1)%5))
         self._mapping = self._get_mapping(self._model)
-        self._two_pass = True
-        rename.Rename(self._model, two_pass=self._two_pass, done_callback=self._cb_test_rename)
+        self._circular = True
+        rename.Rename(self._model, done_callback=self._cb_test_rename, backend=self._backend)
         Gtk.main()
         self._cond_fail()
     
     
+    def test_rename_swap(self):
+        # swap names of pairs of files and folders, and rename something into a swapped name
+        self._create_and_add_file_to_model(self._model, "Test0", "Test1")
+        self._create_and_add_file_to_model(self._model, "Test1", "Test0")
+        self._create_and_add_directory_to_model(self._model, "dir_0", "dir_1")
+        self._create_and_add_directory_to_model(self._model, "dir_1", "dir_0")
+        self._create_and_add_file_to_model(self._model, "Test2", "Test3")
+        self._create_and_add_file_to_model(self._model, "Test3", "Test4")
+        self._mapping = self._get_mapping(self._model)
+        self._circular = True
+        rename.Rename(self._model, done_callback=self._cb_test_rename, backend=self._backend)
+        Gtk.main()
+        self._cond_fail()
+
+
+    def _cb_test_rename_cancel(self, results):
+        # the model has to match the files, and no temporary names may be left
+        if not results.cancelled:
+            self._fail_msg = "Rename was not cancelled"
+        for mp, row in zip(self._mapping, self._model):
+            contents = row[c.FILES_MODEL_COLUMN_GFILE].load_contents(None)[1].decode("utf-8").strip()
+            if contents != mp.gfile_orig.get_uri():
+                self._fail_msg = "Row '{0}' doesn't match its file".format(row[c.FILES_MODEL_COLUMN_ORIGINAL])
+        for fileinfo in self._tmp_dir.enumerate_children(Gio.FILE_ATTRIBUTE_STANDARD_NAME, 0, None):
+            if fileinfo.get_name().startswith("gbr-"):
+                self._fail_msg = "Temporary name '{0}' left behind".format(fileinfo.get_name())
+        Gtk.main_quit()
+
+
+    def test_rename_cancel(self):
+        # cancel right away
+        for ii in range(5):
+            self._create_and_add_file_to_model(self._model, "Test{0}".format(ii), "Test{0}".format((ii+1)%5))
+        for ii in range(20):
+            self._create_and_add_file_to_model(self._model, "Other{0}".format(ii), "Renamed{0}".format(ii))
+        self._mapping = self._get_mapping(self._model)
+
+        renamer = rename.Rename(self._model, done_callback=self._cb_test_rename_cancel, backend=self._backend)
+        renamer.cancel()
+        Gtk.main()
+        self._cond_fail()
+
+
+    def test_rename_cancel_cycles_in_flight(self):
+        # cancel as soon as the first steps of the cycles are done, while others are in flight
+        for ii in range(0, 40, 2):
+            self._create_and_add_file_to_model(self._model, "Test{0}".format(ii), "Test{0}".format(ii+1))
+            self._create_and_add_file_to_model(self._model, "Test{0}".format(ii+1), "Test{0}".format(ii))
+        for ii in range(40, 70, 3):
+            for jj in range(3):
+                self._create_and_add_file_to_model(self._model, "Test{0}".format(ii+jj), "Test{0}".format(ii+(jj+1)%3))
+        self._mapping = self._get_mapping(self._model)
+
+        def progress_cb(num_done, num_total, rate):
+            if num_done > 0:
+                renamer.cancel()
+
+        # report every single finished rename
+        progress_interval = c.RENAME_PROGRESS_INTERVAL
+        c.RENAME_PROGRESS_INTERVAL = 0
+        try:
+            renamer = rename.Rename(self._model, done_callback=self._cb_test_rename_cancel, progress_callback=progress_cb,
+                                    max_in_flight=8, backend=self._backend)
+            Gtk.main()
+        finally:
+            c.RENAME_PROGRESS_INTERVAL = progress_interval
+        self._cond_fail()
+
+
+    def test_undo_all_cancelling_renames(self):
+        # a -> b and b -> a undone at once leave nothing to rename
+        def rename_done_cb(results):
+            action = rename.RenameUndoAction(results)
+            action.set_done_callback(undo_done_cb)
+            undo_stack.push(action)
+            Gtk.main_quit()
+
+        def undo_done_cb(results, action):
+            undo_results.append(results)
+            Gtk.main_quit()
+
+        undo_stack = undo.Undo()
+        undo_results = []
+        self._create_and_add_file_to_model(self._model, "a", "b")
+        rename.Rename(self._model, done_callback=rename_done_cb, backend=self._backend)
+        Gtk.main()
+        self._model[0][c.FILES_MODEL_COLUMN_PREVIEW] = "a"
+        rename.Rename(self._model, done_callback=rename_done_cb, backend=self._backend)
+        Gtk.main()
+        self.assertEqual(undo_stack.get_undo_depth(), 2)
+
+        undo_stack.undo(2)
+        Gtk.main()
+        self.assertEqual(len(undo_results), 1)
+        self.assertEqual(len(undo_results[0].successes), 0)
+        self.assertEqual(undo_stack.get_undo_depth(), 0)
+        self.assertEqual(self._model[0][c.FILES_MODEL_COLUMN_ORIGINAL], "a")
+        self.assertTrue(self._tmp_dir.get_child("a").query_exists(None))
+
+
+    def test_rename_empty_plan(self):
+        results = []
+        self._create_and_add_file_to_model(self._model, "a", "a")
+        plan = rename.create_plan(self._model, backend=self._backend)
+        rename.Rename(self._model, done_callback=lambda res: (results.append(res), Gtk.main_quit()), plan=plan)
+        Gtk.main()
+        self.assertEqual(len(results), 1)
+        self.assertEqual((results[0].successes, results[0].errors), ([], []))
+
+
     def test_rename_folders_and_files(self):
         self._create_and_add_directory_to_model(self._model, "dir_1", "renamed_dir_1")
         self._create_and_add_file_to_model(self._model, "file_1", "renamed_file_1")
@@ -213,7 +329,7 @@ class TestRenamer(unittest.TestCase):
 
         self._mapping = self._get_mapping(self._model)
         
-        rename.Rename(self._model, two_pass=self._two_pass, done_callback=self._cb_test_rename)
+        rename.Rename(self._model, done_callback=self._cb_test_rename, backend=self._backend)
         Gtk.main()
         self._cond_fail()
 
@@ -230,7 +346,7 @@ class TestRenamer(unittest.TestCase):
         self._mapping.append(_NameMap(self._model[1]))
         self._mapping.append(_NameMap(self._model[2], self._tmp_dir.resolve_relative_path("renamed_dir_1")))
         
-        rename.Rename(self._model, two_pass=self._two_pass, done_callback=self._cb_test_rename)
+        rename.Rename(self._model, done_callback=self._cb_test_rename, backend=self._backend)
         Gtk.main()
         self._cond_fail()
     
@@ -250,13 +366,280 @@ class TestRenamer(unittest.TestCase):
         self._mapping.append(_NameMap(self._model[3], self._tmp_dir.resolve_relative_path("renamed_dir_1")))
         self._mapping.append(_NameMap(self._model[4], self._tmp_dir.resolve_relative_path("renamed_dir_1/renamed_dir_2")))
         
-        rename.Rename(self._model, two_pass=self._two_pass, done_callback=self._cb_test_rename)
+        rename.Rename(self._model, done_callback=self._cb_test_rename, backend=self._backend)
         Gtk.main()
         self._cond_fail()
     
     
     
+    def test_rename_foldertree_unknown_file_types(self):
+        # file types that are not known in the model are queried before planning
+        self._create_and_add_directory_to_model(self._model, "dir_1", "renamed_dir_1")
+        self._create_and_add_directory_to_model(self._model, "dir_2", "renamed_dir_2", "dir_1")
+        self._create_and_add_file_to_model(self._model, "file_1", "renamed_file_1", "dir_1/dir_2")
+        for row in self._model:
+            row[c.FILES_MODEL_COLUMN_FILE_TYPE] = Gio.FileType.UNKNOWN
+
+        self._mapping = []
+        self._mapping.append(_NameMap(self._model[0]))
+        self._mapping.append(_NameMap(self._model[1], self._tmp_dir.resolve_relative_path("renamed_dir_1")))
+        self._mapping.append(_NameMap(self._model[2], self._tmp_dir.resolve_relative_path("renamed_dir_1/renamed_dir_2")))
+
+        rename.Rename(self._model, done_callback=self._cb_test_rename, backend=self._backend)
+        Gtk.main()
+        self._cond_fail()
+
+
     @unittest.expectedFailure
     def test_rename_remote(self):
         raise NotImplementedError
-    
+
+
+
+class TestRenamerPosix(TestRenamer):
+    """Same tests, with the POSIX backend"""
+
+    def setUp(self):
+        TestRenamer.setUp(self)
+        self._backend = c.RENAME_BACKEND_POSIX
+
+
+class TestRenamerThreads(TestRenamer):
+    """Same tests, with the thread pool backend"""
+
+    def setUp(self):
+        TestRenamer.setUp(self)
+        self._backend = c.RENAME_BACKEND_THREADS
+
+
+class TestRenamerIoUring(TestRenamer):
+    """Same tests, with the io_uring backend, or its fallback"""
+
+    def setUp(self):
+        TestRenamer.setUp(self)
+        self._backend = c.RENAME_BACKEND_IO_URING
+
+
+
+class _InfoStub:
+    def __init__(self, uri):
+        self.gfile = Gio.file_new_for_uri(uri)
+
+
+class TestRenameLayers(unittest.TestCase):
+
+    def _get_layers(self, entries):
+        infos = [_InfoStub(uri) for uri, is_dir in entries]
+        layers = engine._get_rename_layers(infos, [is_dir for uri, is_dir in entries])
+        return [[el.gfile.get_uri() for el in layer] for layer in layers]
+
+
+    def test_files_first(self):
+        layers = self._get_layers([("file:///tmp/a", True), ("file:///tmp/b", False), ("file:///tmp/a/c", False)])
+        self.assertEqual(layers, [["file:///tmp/b", "file:///tmp/a/c"], ["file:///tmp/a"]])
+
+
+    def test_deepest_first(self):
+        # parents are listed before their children on purpose
+        layers = self._get_layers([("file:///tmp/a", True), ("file:///tmp/a/b", True), ("file:///tmp/a/b/c", True),
+                                   ("file:///tmp/x", True), ("file:///tmp/a/d", True)])
+        self.assertEqual(layers, [["file:///tmp/a/b/c", "file:///tmp/x", "file:///tmp/a/d"],
+                                  ["file:///tmp/a/b"],
+                                  ["file:///tmp/a"]])
+
+
+    def test_similar_names_are_no_prefixes(self):
+        layers = self._get_layers([("file:///tmp/ab", True), ("file:///tmp/a", True)])
+        self.assertEqual(layers, [["file:///tmp/ab", "file:///tmp/a"]])
+
+
+class TestRenameRecords(unittest.TestCase):
+
+    def test_reversed_rename_infos(self):
+        successes = []
+        for old, new, file_type in (("a", "b", Gio.FileType.REGULAR), ("d", "e f", Gio.FileType.DIRECTORY),
+                                    ("x", "ä", Gio.FileType.REGULAR)):
+            info = engine.RenameInfo(Gio.file_new_for_uri("file:///tmp/" + old), old, new, 0, file_type)
+            successes.append(engine.RenameSuccess(info, Gio.file_new_for_path("/tmp/dir/" + new)))
+        records = rename.RenameRecords(successes)
+        self.assertEqual(len(records), 3)
+        infos = records.get_reversed_rename_infos()
+        self.assertEqual([(el.gfile.get_uri(), el.old_display_name, el.new_display_name, el.file_type) for el in infos],
+                         [(el.new_gfile.get_uri(), el.rename_info.new_display_name, el.rename_info.old_display_name,
+                           el.rename_info.file_type) for el in successes])
+        self.assertEqual(rename.RenameRecords([]).get_reversed_rename_infos(), [])
+
+
+    def _records(self, *renames):
+        successes = []
+        for old_path, new_path, file_type in renames:
+            gfile = Gio.file_new_for_path(old_path)
+            new_gfile = Gio.file_new_for_path(new_path)
+            info = engine.RenameInfo(gfile, gfile.get_basename(), new_gfile.get_basename(), 0, file_type)
+            successes.append(engine.RenameSuccess(info, new_gfile))
+        return rename.RenameRecords(successes)
+
+
+    def test_compose(self):
+        first = self._records(("/tmp/d/a", "/tmp/d/b", Gio.FileType.REGULAR),
+                              ("/tmp/d/x", "/tmp/d/y", Gio.FileType.REGULAR))
+        # the files are recorded below the renamed directory, and y gets its old name back
+        second = self._records(("/tmp/d/b", "/tmp/e/c", Gio.FileType.REGULAR),
+                               ("/tmp/d/y", "/tmp/e/x", Gio.FileType.REGULAR),
+                               ("/tmp/d", "/tmp/e", Gio.FileType.DIRECTORY))
+        composed = rename.RenameRecords.compose([first, second])
+        self.assertEqual(len(composed), 2)
+        infos = composed.get_reversed_rename_infos()
+        self.assertEqual(sorted((el.gfile.get_path(), el.old_display_name, el.new_display_name) for el in infos),
+                         [("/tmp/e", "e", "d"), ("/tmp/e/c", "c", "a")])
+
+
+
+class _FailingUndoAction:
+    def undo(self):
+        raise RuntimeError("undo failed")
+
+
+class _DescribedUndoAction:
+    def __init__(self, description, undone):
+        self._description = description
+        self._undone = undone
+
+    def get_description(self):
+        return self._description
+
+    def undo(self):
+        self._undone.append(self._description)
+
+    @classmethod
+    def compose(cls, actions):
+        undone = actions[0]._undone
+        return cls("+".join(el._description for el in actions), undone)
+
+
+class TestUndo(unittest.TestCase):
+
+    def test_undo_to_history_entry(self):
+        undone = []
+        changes = []
+        undo_stack = undo.Undo()
+        undo_stack.connect("undo-history-changed", lambda undo_stack : changes.append(undo_stack.get_undo_depth()))
+        for description in ("a", "b", "c"):
+            undo_stack.push(_DescribedUndoAction(description, undone))
+        self.assertEqual(undo_stack.get_undo_history(), ["c", "b", "a"])
+
+        # undo to "b"
+        undo_stack.undo(2)
+        self.assertEqual(undone, ["b+c"])
+        self.assertEqual(undo_stack.get_undo_history(), ["a"])
+        self.assertEqual(changes, [1, 2, 3, 1])
+
+
+    def test_failed_undo_keeps_history(self):
+        undo_stack = undo.Undo()
+        undo_stack.push(_FailingUndoAction())
+        self.assertRaises(RuntimeError, undo_stack.undo)
+        self.assertEqual(undo_stack.get_undo_depth(), 1)
+
+
+
+class TestRenameJournal(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._dir_uri = Gio.file_new_for_path(self._tmp_dir).get_uri()
+        self._journal_dir = os.path.join(self._tmp_dir, "journal")
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+
+    def _create(self, **contents):
+        for name, content in contents.items():
+            with open(os.path.join(self._tmp_dir, name), "w") as ff:
+                ff.write(content)
+
+
+    def _content(self, name):
+        with open(os.path.join(self._tmp_dir, name)) as ff:
+            return ff.read()
+
+
+    def test_roll_back(self):
+        # c -> a -> b -> c through a temporary name, then x -> y was interrupted
+        self._create(a="c", b="a", c="b", y="x")
+        jj = journal.RenameJournal(self._journal_dir)
+        jj.begin_layer([[journal.STEP_RENAME, self._dir_uri + "/c", "tmp"]])
+        jj.end_layer([])
+        jj.begin_layer([[journal.STEP_RENAME, self._dir_uri + "/b", "c"], [journal.STEP_RENAME, self._dir_uri + "/a", "b"]])
+        jj.end_layer([])
+        jj.begin_layer([[journal.STEP_RENAME, self._dir_uri + "/tmp", "a"], [journal.STEP_RENAME, self._dir_uri + "/x", "y"]])
+
+        # journals of running processes are left alone
+        self.assertEqual(journal.recover(self._journal_dir), [])
+
+        num_undone, errors = journal.roll_back(journal.read_journal(jj.path))
+        self.assertEqual(errors, [])
+        self.assertEqual(num_undone, 5)
+        self.assertEqual(sorted(name for name in os.listdir(self._tmp_dir) if name != "journal"), ["a", "b", "c", "x"])
+        for name in ("a", "b", "c", "x"):
+            self.assertEqual(self._content(name), name)
+
+
+    def test_recover(self):
+        self._create(b="a")
+        jj = journal.RenameJournal(self._journal_dir)
+        jj.begin_layer([[journal.STEP_RENAME, self._dir_uri + "/a", "b"]])
+        # the journal only appears under its name while locked
+        self.assertEqual(os.listdir(self._journal_dir), [os.path.basename(jj.path)])
+        self.assertEqual(journal.recover(self._journal_dir), [])
+        # the process crashed, and its process id is in use again
+        jj._file.close()
+
+        self.assertEqual(journal.recover(self._journal_dir), [(jj.path, 1, [])])
+        self.assertEqual(os.listdir(self._journal_dir), [])
+        self.assertEqual(self._content("a"), "a")
+
+
+    def test_failed_steps_are_not_rolled_back(self):
+        self._create(a="a", y="x")
+        jj = journal.RenameJournal(self._journal_dir)
+        jj.begin_layer([[journal.STEP_RENAME, self._dir_uri + "/a", "b"], [journal.STEP_RENAME, self._dir_uri + "/x", "y"]])
+        jj.end_layer([0])
+        jj.begin_layer([])
+
+        num_undone, errors = journal.roll_back(journal.read_journal(jj.path))
+        self.assertEqual((num_undone, errors), (1, []))
+        self.assertEqual(self._content("a"), "a")
+        self.assertEqual(self._content("x"), "x")
+
+
+    def test_interleaved_groups(self):
+        # the outcome of a layer belongs to the layer of the same group
+        self._create(b="a", y="x")
+        jj = journal.RenameJournal(self._journal_dir)
+        jj.begin_layer([[journal.STEP_RENAME, self._dir_uri + "/a", "b"]], 0)
+        jj.begin_layer([[journal.STEP_RENAME, self._dir_uri + "/x", "y"], [journal.STEP_RENAME, self._dir_uri + "/p", "q"]], 1)
+        jj.end_layer([1], 1)
+        jj.end_layer([], 0)
+        jj.begin_layer([], 0)
+
+        layers = journal.read_journal(jj.path)
+        self.assertEqual([failed for steps, failed in layers], [set(), {1}, None])
+        num_undone, errors = journal.roll_back(layers)
+        self.assertEqual((num_undone, errors), (2, []))
+        self.assertEqual(self._content("a"), "a")
+        self.assertEqual(self._content("x"), "x")
+
+
+    def test_rename_removes_journal(self):
+        model = Gtk.ListStore(*c.FILES_MODEL_COLUMNS)
+        self._create(a="a")
+        gfile = Gio.file_new_for_path(os.path.join(self._tmp_dir, "a"))
+        model.append(["a", "b", gfile, "", "", "", "", self._dir_uri + "/", Gio.FileType.REGULAR])
+        results = []
+        rename.Rename(model, done_callback=lambda res: (results.append(res), Gtk.main_quit()), journal_dir=self._journal_dir)
+        Gtk.main()
+        self.assertEqual(len(results[0].successes), 1)
+        self.assertEqual(os.listdir(self._journal_dir), [])